@@ -0,0 +1,536 @@
+"""Offline benchmarks for rhasspy-nlu-hermes.
+
+Builds intent graphs of controlled size from generated sentence templates
+(or loads a sentences.ini), drives NluHermesMqtt.on_message with synthetic
+or replayed queries through a mock MQTT client, and writes a JSON report
+that can be compared against a report from another commit.
+
+Examples:
+
+    python3 benchmarks/benchmark.py --intents 10,100 --slot-values 10,1000 \\
+        --output bench.json
+
+    python3 benchmarks/benchmark.py --compare baseline.json bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import rhasspynlu
+from rhasspyhermes.nlu import NluQuery
+
+_DIR = Path(__file__).parent
+sys.path.insert(0, str(_DIR.parent))
+
+# pylint: disable=wrong-import-position
+from rhasspynlu_hermes import NluHermesMqtt  # noqa: E402
+from rhasspynlu_hermes.compiled import graph_to_compiled  # noqa: E402
+
+_LOGGER = logging.getLogger("benchmark")
+
+REPORT_VERSION = 1
+
+# -----------------------------------------------------------------------------
+
+
+def make_ini(num_intents: int, slot_values: int, nesting: int) -> str:
+    """Generate sentences.ini text.
+
+    Each intent has one template with a slot of slot_values alternatives
+    (shared vocabulary across intents) and nesting levels of nested
+    alternatives with optional words.
+    """
+    values = " | ".join(f"value{j}" for j in range(slot_values))
+    lines: typing.List[str] = []
+
+    for intent_index in range(num_intents):
+        lines.append(f"[Intent{intent_index:04d}]")
+        lines.append(f"values = ({values})")
+        lines.append(
+            f"set the {_nested(intent_index, nesting)} to <values>{{value}} [please]"
+        )
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def _nested(intent_index: int, depth: int) -> str:
+    """Nested alternatives with optional words."""
+    if depth <= 0:
+        return f"thing{intent_index}"
+
+    return (
+        f"(thing{intent_index}x{depth} | "
+        f"{_nested(intent_index, depth - 1)}) [mode{depth}]"
+    )
+
+
+def random_sentence(graph, rng: random.Random) -> str:
+    """Random walk from start to final node, collecting input words."""
+    node = next(n for n, data in graph.nodes(data=True) if data.get("start"))
+    words: typing.List[str] = []
+
+    while not graph.nodes[node].get("final"):
+        next_node, edge_data = rng.choice(list(graph[node].items()))
+        ilabel = edge_data.get("ilabel", "")
+        if ilabel and (not ilabel.startswith("__")):
+            words.append(ilabel)
+
+        node = next_node
+
+    return " ".join(words)
+
+
+def make_queries(
+    graph, count: int, miss_rate: float, seed: int
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Synthetic NluQuery dicts (with miss_rate of them not in the graph)."""
+    rng = random.Random(seed)
+    queries: typing.List[typing.Dict[str, typing.Any]] = []
+
+    for query_index in range(count):
+        if rng.random() < miss_rate:
+            text = " ".join(f"noise{rng.randrange(1000)}" for _ in range(4))
+        else:
+            text = random_sentence(graph, rng)
+
+        queries.append({"input": text, "id": str(query_index), "siteId": "default"})
+
+    return queries
+
+
+def load_queries(queries_path: Path) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Load replayed queries: one hermes/nlu/query JSON payload or text per line."""
+    queries: typing.List[typing.Dict[str, typing.Any]] = []
+    with open(queries_path, "r") as queries_file:
+        for line in queries_file:
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("{"):
+                queries.append(json.loads(line))
+            else:
+                queries.append({"input": line, "siteId": "default"})
+
+    return queries
+
+
+# -----------------------------------------------------------------------------
+
+
+class MockMqttClient:
+    """Stands in for paho MQTT client and counts published messages."""
+
+    def __init__(self):
+        self.messages = 0
+        self.payload_bytes = 0
+        self.topics: typing.Dict[str, int] = {}
+
+    def publish(self, topic: str, payload: typing.Union[str, bytes], *args, **kwargs):
+        """Count message instead of sending it."""
+        self.messages += 1
+        self.payload_bytes += len(payload)
+
+        # Group intent topics by type
+        if topic.startswith("hermes/intent/"):
+            topic = "hermes/intent/#"
+
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+
+    def __getattr__(self, name):
+        # subscribe, etc.
+        return lambda *args, **kwargs: None
+
+
+def percentile(sorted_values: typing.List[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not sorted_values:
+        return 0.0
+
+    rank = max(0, int(round((percent / 100) * len(sorted_values))) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def _drive_queries(
+    hermes: NluHermesMqtt,
+    queries: typing.List[typing.Dict[str, typing.Any]],
+    concurrency: int,
+) -> typing.Tuple[float, typing.List[float]]:
+    """Run queries through on_message like handle_messages_async does.
+
+    Returns (wall seconds, latency seconds per query).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: typing.List[float] = []
+
+    async def run_query(query_dict):
+        async with semaphore:
+            start_time = time.perf_counter()
+            query = NluQuery.from_dict(query_dict)
+            await hermes.publish_all(hermes.on_message(query))
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(run_query(q) for q in queries))
+
+    return time.perf_counter() - start_time, latencies
+
+
+def run_case(case: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """Run one benchmark case and return its results."""
+    if case.get("ini"):
+        ini_text = Path(case["ini"]).read_text()
+    else:
+        ini_text = make_ini(case["intents"], case["slot_values"], case["nesting"])
+
+    start_time = time.perf_counter()
+    graph = rhasspynlu.intents_to_graph(rhasspynlu.parse_ini(ini_text))
+    build_seconds = time.perf_counter() - start_time
+
+    if case.get("queries_file"):
+        queries = load_queries(Path(case["queries_file"]))
+    else:
+        queries = make_queries(
+            graph, case["warmup"] + case["queries"], case["miss_rate"], case["seed"],
+        )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        graph_path = Path(temp_dir) / "intent.pickle.gz"
+        if case["graph_format"] == "compiled":
+            with open(graph_path, "wb") as graph_file:
+                graph_to_compiled(graph, graph_file)
+        else:
+            with open(graph_path, "wb") as graph_file:
+                rhasspynlu.graph_to_gzip_pickle(graph, graph_file)
+
+        graph_bytes = graph_path.stat().st_size
+        num_nodes, num_edges = len(graph), graph.number_of_edges()
+        del graph
+
+        client = MockMqttClient()
+        hermes = NluHermesMqtt(
+            client,
+            graph_path=graph_path,
+            fuzzy=case["fuzzy"],
+            workers=case["workers"],
+            worker_type=case["worker_type"],
+            recognition_cache_size=case["cache_size"],
+        )
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            # Load graph the same way the service does at startup
+            start_time = time.perf_counter()
+            loop.run_until_complete(hermes.load_graph())
+            load_seconds = time.perf_counter() - start_time
+
+            warmup = min(case["warmup"], len(queries))
+            if warmup > 0:
+                loop.run_until_complete(
+                    _drive_queries(hermes, queries[:warmup], case["concurrency"])
+                )
+                client.topics.clear()
+
+            measured = queries[warmup:]
+            wall_seconds, latencies = loop.run_until_complete(
+                _drive_queries(hermes, measured, case["concurrency"])
+            )
+        finally:
+            hermes.recognizer.shutdown()
+            loop.close()
+
+    latencies_ms = sorted(seconds * 1000 for seconds in latencies)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return {
+        "name": case["name"],
+        "params": case,
+        "graph": {
+            "nodes": num_nodes,
+            "edges": num_edges,
+            "file_bytes": graph_bytes,
+            "build_seconds": build_seconds,
+            "load_seconds": load_seconds,
+        },
+        "queries": len(measured),
+        "wall_seconds": wall_seconds,
+        "throughput_qps": (len(measured) / wall_seconds) if wall_seconds > 0 else 0,
+        "latency_ms": {
+            "mean": (sum(latencies_ms) / len(latencies_ms)) if latencies_ms else 0,
+            "p50": percentile(latencies_ms, 50),
+            "p90": percentile(latencies_ms, 90),
+            "p95": percentile(latencies_ms, 95),
+            "p99": percentile(latencies_ms, 99),
+            "max": latencies_ms[-1] if latencies_ms else 0,
+        },
+        "results": {
+            "recognized": client.topics.get("hermes/intent/#", 0),
+            "not_recognized": client.topics.get("hermes/nlu/intentNotRecognized", 0),
+            "errors": client.topics.get("hermes/error/nlu", 0),
+        },
+        "peak_rss_kb": peak_rss_kb,
+        "peak_rss_children_kb": children_rss_kb,
+    }
+
+
+# -----------------------------------------------------------------------------
+
+
+def make_cases(args: argparse.Namespace) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Cases from command-line grid."""
+    common = {
+        "queries": args.queries,
+        "warmup": args.warmup,
+        "miss_rate": args.miss_rate,
+        "seed": args.seed,
+        "fuzzy": not args.no_fuzzy,
+        "workers": args.workers,
+        "worker_type": args.worker_type,
+        "concurrency": args.concurrency,
+        "cache_size": args.recognition_cache_size,
+        "graph_format": args.graph_format,
+        "queries_file": str(args.queries_file) if args.queries_file else None,
+    }
+
+    if args.ini:
+        return [dict(common, name=f"ini:{args.ini.name}", ini=str(args.ini))]
+
+    cases = []
+    for intents, slot_values, nesting in itertools.product(
+        args.intents, args.slot_values, args.nesting
+    ):
+        cases.append(
+            dict(
+                common,
+                name=f"i{intents}-s{slot_values}-n{nesting}",
+                intents=intents,
+                slot_values=slot_values,
+                nesting=nesting,
+            )
+        )
+
+    return cases
+
+
+def git_commit() -> typing.Optional[str]:
+    """Current git commit of repository (if available)."""
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=_DIR, stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return None
+
+
+def compare_reports(
+    baseline: typing.Dict[str, typing.Any],
+    current: typing.Dict[str, typing.Any],
+    max_regression: float,
+) -> bool:
+    """Print per-case changes. Returns False if any case regressed too much."""
+    baseline_cases = {case["name"]: case for case in baseline["cases"]}
+    passed = True
+
+    for case in current["cases"]:
+        old_case = baseline_cases.get(case["name"])
+        if old_case is None:
+            print(f"{case['name']}: not in baseline")
+            continue
+
+        changes = {
+            "throughput_qps": (
+                old_case["throughput_qps"],
+                case["throughput_qps"],
+                True,
+            ),
+            "p95_ms": (old_case["latency_ms"]["p95"], case["latency_ms"]["p95"], False),
+            "load_seconds": (
+                old_case["graph"]["load_seconds"],
+                case["graph"]["load_seconds"],
+                False,
+            ),
+            "peak_rss_kb": (old_case["peak_rss_kb"], case["peak_rss_kb"], False),
+        }
+
+        for metric, (old_value, new_value, higher_is_better) in changes.items():
+            if old_value <= 0:
+                continue
+
+            change = (new_value - old_value) / old_value
+            regression = -change if higher_is_better else change
+            marker = ""
+            if regression > max_regression:
+                marker = " REGRESSION"
+                passed = False
+
+            print(
+                f"{case['name']} {metric}: {old_value:.4g} -> {new_value:.4g} "
+                f"({change:+.1%}){marker}"
+            )
+
+    return passed
+
+
+def _csv_ints(value: str) -> typing.List[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def main():
+    """Main method."""
+    parser = argparse.ArgumentParser(prog="benchmark")
+    parser.add_argument(
+        "--intents",
+        type=_csv_ints,
+        default=[10, 100],
+        help="Comma-separated number of intents (default: 10,100)",
+    )
+    parser.add_argument(
+        "--slot-values",
+        type=_csv_ints,
+        default=[10, 100],
+        help="Comma-separated number of values per slot (default: 10,100)",
+    )
+    parser.add_argument(
+        "--nesting",
+        type=_csv_ints,
+        default=[1],
+        help="Comma-separated depth of nested alternatives (default: 1)",
+    )
+    parser.add_argument("--ini", type=Path, help="Use sentences.ini instead of grid")
+    parser.add_argument(
+        "--queries-file",
+        type=Path,
+        help="Replay queries (one JSON payload or text per line)",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=500,
+        help="Number of synthetic queries (default: 500)",
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=20, help="Unmeasured queries (default: 20)"
+    )
+    parser.add_argument(
+        "--miss-rate",
+        type=float,
+        default=0.1,
+        help="Fraction of synthetic queries not in graph (default: 0.1)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--no-fuzzy", action="store_true", help="Disable fuzzy")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Recognition workers (default: 1)"
+    )
+    parser.add_argument(
+        "--worker-type",
+        choices=["thread", "process"],
+        default="thread",
+        help="Type of recognition worker (default: thread)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Queries in flight at once (default: 1)",
+    )
+    parser.add_argument(
+        "--recognition-cache-size",
+        type=int,
+        default=0,
+        help="Recognition cache size (default: 0)",
+    )
+    parser.add_argument(
+        "--graph-format",
+        choices=["pickle", "compiled"],
+        default="pickle",
+        help="Format of graph file to load (default: pickle)",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run cases in this process (peak RSS is then cumulative)",
+    )
+    parser.add_argument("--output", type=Path, help="Write JSON report to file")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASELINE", "CURRENT"),
+        type=Path,
+        help="Compare two JSON reports instead of running benchmarks",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="Fraction a metric may get worse in --compare (default: 0.1)",
+    )
+    parser.add_argument("--debug", action="store_true", help="Print DEBUG messages")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    if args.compare:
+        baseline = json.loads(args.compare[0].read_text())
+        current = json.loads(args.compare[1].read_text())
+        sys.exit(0 if compare_reports(baseline, current, args.max_regression) else 1)
+
+    report: typing.Dict[str, typing.Any] = {
+        "version": REPORT_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": [],
+    }
+
+    for case in make_cases(args):
+        print(f"Running {case['name']}...", file=sys.stderr)
+        if args.in_process:
+            result = run_case(case)
+        else:
+            # Fresh process per case so peak RSS is per case
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context("spawn")
+            ) as executor:
+                result = executor.submit(run_case, case).result()
+
+        report["cases"].append(result)
+        print(
+            f"{case['name']}: {result['throughput_qps']:.1f} q/s, "
+            f"p95={result['latency_ms']['p95']:.2f}ms, "
+            f"load={result['graph']['load_seconds']:.3f}s, "
+            f"rss={result['peak_rss_kb']}KB",
+            file=sys.stderr,
+        )
+
+    report_json = json.dumps(report, indent=4)
+    if args.output:
+        args.output.write_text(report_json)
+    else:
+        print(report_json)
+
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 """Hermes MQTT server for Rhasspy NLU"""
+import asyncio
+import json
 import logging
+import random
+import time
 import typing
+import weakref
 from pathlib import Path
 
 import networkx as nx
-import rhasspynlu
 from rhasspyhermes.base import Message
 from rhasspyhermes.client import GeneratorType, HermesClient, TopicArgs
 from rhasspyhermes.intent import Intent, Slot, SlotRange
@@ -17,11 +21,42 @@ from rhasspyhermes.nlu import (
     NluTrain,
     NluTrainSuccess,
 )
-from rhasspynlu import Sentence, recognize
+from rhasspynlu import Sentence
 from rhasspynlu.intent import Recognition
 
+from .cache import LruCache
+from .cluster import shared_topic, site_partition
+from .graph import GraphFingerprint, IntentIndex, graph_fingerprint, load_valid_graph
+from .metrics import NluMetrics, TimedConverter
+from .normalize import NormalizedInput, normalize_tokens, query_tokens
+from .numbers import NumberTable
+from .payloads import PayloadType, message_payload, shared_fields
+from .profiles import GraphProfiles, graph_size
+from .scheduler import QueryScheduler
+from .workers import QueueFullError, RecognizerPool
+
 _LOGGER = logging.getLogger("rhasspynlu_hermes")
 
+QueryResultType = typing.Union[
+    NluIntentParsed,
+    typing.Tuple[NluIntent, TopicArgs],
+    NluIntentNotRecognized,
+    NluError,
+]
+
+# Times a query loads its site id/language graph before giving up
+MAX_GRAPH_LOADS = 3
+
+
+class LoadedGraph(typing.NamedTuple):
+    """Graph loaded and indexed off the event loop, ready to swap in."""
+
+    graph: nx.DiGraph
+    intent_index: IntentIndex
+    number_table: typing.Optional[NumberTable]
+    fingerprint: GraphFingerprint
+
+
 # -----------------------------------------------------------------------------
 
 
@@ -38,173 +73,1048 @@ class NluHermesMqtt(HermesClient):
         fuzzy: bool = True,
         replace_numbers: bool = False,
         language: typing.Optional[str] = None,
+        original_slot_ranges: bool = False,
         extra_converters: typing.Optional[
             typing.Dict[str, typing.Callable[..., typing.Any]]
         ] = None,
         failure_token: typing.Optional[str] = None,
         site_ids: typing.Optional[typing.List[str]] = None,
         lang: typing.Optional[str] = None,
+        workers: int = 1,
+        worker_type: str = "thread",
+        max_queued_queries: int = 0,
+        recognition_cache_size: int = 0,
+        recognition_cache_ttl: typing.Optional[float] = None,
+        uncached_converters: typing.Optional[typing.Iterable[str]] = None,
+        metrics: typing.Optional[NluMetrics] = None,
+        trace_sample_rate: float = 0.0,
+        trace_custom_data: bool = False,
+        n_best: typing.Optional[int] = None,
+        confidence_threshold: typing.Optional[float] = None,
+        max_exact_sentences: int = 0,
+        site_graphs: typing.Optional[typing.Dict[str, Path]] = None,
+        lang_graphs: typing.Optional[typing.Dict[str, Path]] = None,
+        max_graph_bytes: int = 0,
+        fair_scheduling: bool = False,
+        max_query_age: typing.Optional[float] = None,
+        expired_query_result: str = "not_recognized",
+        shared_group: typing.Optional[str] = None,
+        partition: typing.Optional[typing.Tuple[int, int]] = None,
     ):
         super().__init__("rhasspynlu_hermes", client, site_ids=site_ids)
 
-        self.subscribe(NluQuery, NluTrain)
+        # Cluster mode.
+        # With a shared group, queries are received through an MQTT shared
+        # subscription so the broker gives each query to one instance.
+        # With a partition (index, count), only queries whose site id hashes
+        # to index are answered.
+        self.shared_group = shared_group
+        self.partition = partition
+
+        if self.shared_group:
+            # Training is still broadcast to every instance
+            self.subscribe(NluTrain)
+            self.subscribed_types.add(NluQuery)
+            self.subscribe_topics(shared_topic(NluQuery.topic(), self.shared_group))
+        else:
+            self.subscribe(NluQuery, NluTrain)
 
         self.graph_path = graph_path
-        self.intent_graph = intent_graph
         self.default_entities = default_entities or {}
         self.word_transform = word_transform
         self.fuzzy = fuzzy
         self.replace_numbers = replace_numbers
         self.language = language
+
+        # If True, slot raw values and ranges are for the original query
+        # input instead of the text matched by rhasspynlu (numbers replaced,
+        # skipped words left out).
+        self.original_slot_ranges = original_slot_ranges
+
+        # Words for numbers used in the graph (filled in when graph is set)
+        self.number_table: typing.Optional[NumberTable] = None
+        if self.replace_numbers:
+            self.number_table = NumberTable(self.language)
+
+        # Number tables for site id/language graphs by key
+        self.number_tables: typing.Dict[str, NumberTable] = {}
+
         self.extra_converters = extra_converters
         self.failure_token = failure_token
         self.lang = lang
 
+        # Optional instrumentation (None when disabled)
+        self.metrics = metrics
+        if self.metrics and self.extra_converters:
+            # Process workers send converter time back with their results
+            self.extra_converters = {
+                name: TimedConverter(converter, self.metrics)
+                for name, converter in self.extra_converters.items()
+            }
+
+        # Runs graph search off the event loop.
+        # Input that exactly matches one of up to max_exact_sentences
+        # sentences is looked up instead of searched.
+        # If n_best or confidence_threshold are set, the search stops early
+        # with up to n_best results instead of finding every best path.
+        self.recognizer = RecognizerPool(
+            workers=workers,
+            worker_type=worker_type,
+            max_queued=max_queued_queries,
+            max_exact_sentences=max_exact_sentences,
+            metrics=self.metrics,
+            word_transform=self.word_transform,
+            fuzzy=self.fuzzy,
+            extra_converters=self.extra_converters,
+            n_best=n_best,
+            confidence_threshold=confidence_threshold,
+        )
+
+        # Optional cache of recognition results.
+        # Results for intents using uncached (non-deterministic) converters
+        # are never stored.
+        self.recognition_cache: typing.Optional[LruCache] = None
+        if recognition_cache_size > 0:
+            self.recognition_cache = LruCache(
+                recognition_cache_size, ttl=recognition_cache_ttl
+            )
+
+        self.uncached_converters: typing.Set[str] = set(uncached_converters or [])
+
+        # Encoded intent and slots of intent messages by message object id,
+        # filled in by query_results so both messages of a query share them
+        # (see message_payload). Entries are removed with their messages.
+        self.payload_fields: typing.Dict[
+            int, typing.Tuple[weakref.ref, PayloadType]
+        ] = {}
+
+        # Fraction of queries (0-1) whose stage timings are logged.
+        # If trace_custom_data is True, traces are also added to the
+        # customData of intent/not recognized messages.
+        self.trace_sample_rate = trace_sample_rate
+        self.trace_custom_data = trace_custom_data
+
+        # Optional scheduler in front of recognition.
+        # Waiting queries are admitted round-robin by site id, with queries
+        # that have an intent filter (session continuations) first. Queries
+        # waiting longer than max_query_age seconds are dropped with an
+        # expired_query_result ("not_recognized" or "error") message.
+        # Queries past max_queued_queries get an error message.
+        self.scheduler: typing.Optional[QueryScheduler] = None
+        if fair_scheduling or (max_query_age is not None):
+            self.scheduler = QueryScheduler(
+                max_active=workers,
+                max_age=max_query_age,
+                max_queued=max_queued_queries,
+            )
+
+        assert expired_query_result in (
+            "not_recognized",
+            "error",
+        ), f"Invalid expired query result: {expired_query_result}"
+        self.expired_query_result = expired_query_result
+
+        if self.metrics:
+            self.metrics.queries_queued.function = self.queries_queued
+            self.metrics.queries_dropped.function = self.queries_dropped
+
+            if self.recognition_cache is not None:
+                cache = self.recognition_cache
+                self.metrics.cache_hits.function = lambda: cache.hits
+                self.metrics.cache_misses.function = lambda: cache.misses
+
+        # Graphs for specific site ids/languages, loaded on first use and
+        # evicted (least recently used) when over max_graph_bytes.
+        self.profiles = GraphProfiles(
+            site_graphs=site_graphs, lang_graphs=lang_graphs, max_bytes=max_graph_bytes
+        )
+
+        if self.metrics:
+            profiles = self.profiles
+            self.metrics.graphs_loaded.function = lambda: len(profiles.loaded)
+            self.metrics.graph_reloads.function = lambda: profiles.reloads
+            self.metrics.graph_evictions.function = lambda: profiles.evictions
+
+        # Fingerprints of graph files by key (None for default graph).
+        # Training with an unchanged file skips loading it again.
+        self.graph_fingerprints: typing.Dict[
+            typing.Optional[str], GraphFingerprint
+        ] = {}
+
+        self.intent_graph = intent_graph
+
+        # Background load of graph_path (shared by all waiting queries)
+        self.graph_load_task: typing.Optional[asyncio.Future] = None
+
+        # Background loads of site id/language graphs by key
+        self.profile_load_tasks: typing.Dict[str, asyncio.Future] = {}
+
+        # Number of times each site id/language graph was trained.
+        # Background loads started before training are dropped.
+        self.profile_trains: typing.Dict[str, int] = {}
+
+        # Serializes graph swaps from training (created in event loop)
+        self.train_lock: typing.Optional[asyncio.Lock] = None
+
+    # -------------------------------------------------------------------------
+
+    @property
+    def intent_graph(self) -> typing.Optional[nx.DiGraph]:
+        """Graph used for intent recognition."""
+        return self.recognizer.graph
+
+    @intent_graph.setter
+    def intent_graph(self, graph: typing.Optional[nx.DiGraph]):
+        """Set graph used for intent recognition."""
+        self.set_graph(graph)
+
+    def set_graph(
+        self,
+        graph: typing.Optional[nx.DiGraph],
+        graph_path: typing.Optional[Path] = None,
+        graph_key: typing.Optional[str] = None,
+        intent_index: typing.Optional[IntentIndex] = None,
+        number_table: typing.Optional[NumberTable] = None,
+        fingerprint: typing.Optional[GraphFingerprint] = None,
+    ):
+        """Swap in a new graph and drop results cached for the old one.
+
+        If graph_key is set, only the graph for that site id/language is
+        replaced and least recently used graphs may be evicted.
+
+        Graphs loaded from files are indexed and have their number words
+        computed off the event loop beforehand (see _load_graph_file);
+        otherwise, intent_index and number_table are built here.
+        The fingerprint of a graph file identifies its contents to process
+        workers and is used to skip reloading unchanged files.
+        """
+        if number_table is not None:
+            if graph_key is None:
+                self.number_table = number_table
+            else:
+                self.number_tables[graph_key] = number_table
+        elif graph is not None:
+            key_number_table = self.graph_number_table(graph_key)
+            if key_number_table is not None:
+                key_number_table.add_graph(graph)
+        elif graph_key is not None:
+            self.number_tables.pop(graph_key, None)
+
+        self.recognizer.set_graph(
+            graph,
+            graph_path=graph_path,
+            graph_key=graph_key,
+            intent_index=intent_index,
+            digest=(fingerprint.digest if fingerprint is not None else None),
+        )
+
+        if fingerprint is not None:
+            self.graph_fingerprints[graph_key] = fingerprint
+        else:
+            self.graph_fingerprints.pop(graph_key, None)
+
+        if graph_key is not None:
+            # Cached results are keyed by graph generation
+            if graph is not None:
+                for evicted_key in self.profiles.add(graph_key, graph_size(graph)):
+                    self.recognizer.set_graph(None, graph_key=evicted_key)
+                    self.graph_fingerprints.pop(evicted_key, None)
+                    self.number_tables.pop(evicted_key, None)
+
+            return
+
+        if self.recognition_cache is not None:
+            self.recognition_cache.clear()
+
+        if self.metrics and (graph is not None):
+            self.metrics.graph_nodes.set(len(graph))
+            self.metrics.graph_edges.set(graph.number_of_edges())
+
+    def load_graph(self) -> asyncio.Future:
+        """Start loading graph_path in the background if not already loading.
+
+        Returns a future that is done when the graph is ready.
+        """
+        if self.graph_load_task is None:
+            self.graph_load_task = asyncio.ensure_future(self._load_graph_path())
+
+        return self.graph_load_task
+
+    async def _load_graph_path(self):
+        """Load graph_path off the event loop."""
+        assert self.graph_path is not None, "No graph path"
+
+        try:
+            start_time = time.perf_counter()
+            loaded = await self._load_graph_file(self.graph_path)
+            self.set_graph(
+                loaded.graph,
+                graph_path=self.graph_path,
+                intent_index=loaded.intent_index,
+                number_table=loaded.number_table,
+                fingerprint=loaded.fingerprint,
+            )
+            await self.recognizer.warm_workers()
+
+            load_seconds = time.perf_counter() - start_time
+            _LOGGER.info("Loaded %s in %s second(s)", self.graph_path, load_seconds)
+
+            if self.metrics:
+                self.metrics.stage_seconds.observe(load_seconds, stage="graph_load")
+        except Exception:
+            _LOGGER.exception("load_graph")
+
+            # Allow next query to retry
+            self.graph_load_task = None
+            raise
+
+    def graph_number_table(
+        self, graph_key: typing.Optional[str] = None
+    ) -> typing.Optional[NumberTable]:
+        """Number table for a graph key (None if numbers aren't replaced).
+
+        Language graphs get a table for their language. Other graphs use
+        the default language.
+        """
+        if (graph_key is None) or (not self.replace_numbers):
+            return self.number_table
+
+        number_table = self.number_tables.get(graph_key)
+        if number_table is None:
+            language = self.language
+            if graph_key.startswith(GraphProfiles.lang_key("")):
+                language = graph_key[len(GraphProfiles.lang_key("")) :]
+
+            number_table = NumberTable(language)
+            self.number_tables[graph_key] = number_table
+
+        return number_table
+
+    async def _load_graph_file(
+        self,
+        graph_path: Path,
+        fingerprint: typing.Optional[GraphFingerprint] = None,
+        graph_key: typing.Optional[str] = None,
+    ) -> LoadedGraph:
+        """Load, validate, and index a graph file off the event loop."""
+        loop = asyncio.get_running_loop()
+
+        if fingerprint is None:
+            # Fingerprint first so a change during load is noticed later
+            fingerprint = await loop.run_in_executor(
+                None, graph_fingerprint, graph_path
+            )
+
+        graph, intent_index, number_table = await loop.run_in_executor(
+            None,
+            self._load_indexed_graph,
+            graph_path,
+            self.graph_number_table(graph_key),
+        )
+
+        return LoadedGraph(graph, intent_index, number_table, fingerprint)
+
+    def _load_indexed_graph(
+        self, graph_path: Path, number_table: typing.Optional[NumberTable] = None
+    ) -> typing.Tuple[nx.DiGraph, IntentIndex, typing.Optional[NumberTable]]:
+        """Load, validate, and index a graph file (runs in executor).
+
+        Words for the numbers in the graph are added to a copy of the number
+        table if one is given.
+        """
+        graph = load_valid_graph(graph_path)
+        if number_table is not None:
+            number_table = number_table.with_graph(graph)
+
+        return graph, self.recognizer.index_graph(graph), number_table
+
+    def load_profile_graph(self, graph_key: str) -> asyncio.Future:
+        """Start loading the graph for a site id/language if not already loading.
+
+        Returns a future that is done when the graph is ready.
+        """
+        load_task = self.profile_load_tasks.get(graph_key)
+        if load_task is None:
+            load_task = asyncio.ensure_future(self._load_profile_graph(graph_key))
+            self.profile_load_tasks[graph_key] = load_task
+
+        return load_task
+
+    async def _load_profile_graph(self, graph_key: str):
+        """Load graph for a site id/language off the event loop."""
+        graph_path = self.profiles.graph_paths[graph_key]
+        trains = self.profile_trains.get(graph_key, 0)
+
+        try:
+            start_time = time.perf_counter()
+            loaded = await self._load_graph_file(graph_path, graph_key=graph_key)
+            if trains != self.profile_trains.get(graph_key, 0):
+                # Retrained while loading (possibly the same file)
+                _LOGGER.debug(
+                    "Dropped stale load of %s (key=%s)", graph_path, graph_key
+                )
+                return
+
+            self.set_graph(
+                loaded.graph,
+                graph_path=graph_path,
+                graph_key=graph_key,
+                intent_index=loaded.intent_index,
+                number_table=loaded.number_table,
+                fingerprint=loaded.fingerprint,
+            )
+            await self.recognizer.warm_workers(graph_key)
+
+            load_seconds = time.perf_counter() - start_time
+            _LOGGER.info(
+                "Loaded %s for %s in %s second(s)", graph_path, graph_key, load_seconds
+            )
+
+            if self.metrics:
+                self.metrics.stage_seconds.observe(load_seconds, stage="graph_load")
+        except Exception:
+            _LOGGER.exception("load_profile_graph")
+            raise
+        finally:
+            self.profile_load_tasks.pop(graph_key, None)
+
     # -------------------------------------------------------------------------
 
     async def handle_query(
         self, query: NluQuery
-    ) -> typing.AsyncIterable[
-        typing.Union[
-            NluIntentParsed,
-            typing.Tuple[NluIntent, TopicArgs],
-            NluIntentNotRecognized,
-            NluError,
-        ]
-    ]:
-        """Do intent recognition."""
-        original_input = query.input
+    ) -> typing.AsyncIterable[QueryResultType]:
+        """Do intent recognition (after waiting for scheduler, if enabled)."""
+        trace = self.start_trace(query)
+
+        if self.scheduler is None:
+            async for result in self._handle_query(query, trace):
+                yield result
 
+            return
+
+        start_time = time.perf_counter()
         try:
-            if not self.intent_graph and self.graph_path and self.graph_path.is_file():
-                # Load graph from file
-                _LOGGER.debug("Loading %s", self.graph_path)
-                with open(self.graph_path, mode="rb") as graph_file:
-                    self.intent_graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
-
-            if self.intent_graph:
-
-                def intent_filter(intent_name: str) -> bool:
-                    """Filter out intents."""
-                    if query.intent_filter:
-                        return intent_name in query.intent_filter
-                    return True
-
-                # Replace digits with words
-                if self.replace_numbers:
-                    # Have to assume whitespace tokenization
-                    words = rhasspynlu.replace_numbers(
-                        query.input.split(), self.language
-                    )
-                    query.input = " ".join(words)
+            admitted = await self.scheduler.acquire(
+                query.site_id, priority=bool(query.intent_filter)
+            )
+        except QueueFullError as e:
+            _LOGGER.warning("Dropped query %s from %s (%s)", query.id, query.site_id, e)
+            yield self.query_error(query, query.input, e, trace)
+            return
+
+        self.end_stage("queue", start_time, trace)
 
-                input_text = query.input
+        if not admitted:
+            yield self.query_expired(query, trace)
+            return
 
-                # Fix casing for output event
-                if self.word_transform:
-                    input_text = self.word_transform(input_text)
+        try:
+            async for result in self._handle_query(query, trace):
+                yield result
+        finally:
+            self.scheduler.release()
+
+    async def _handle_query(
+        self, query: NluQuery, trace: typing.Optional[typing.Dict[str, typing.Any]]
+    ) -> typing.AsyncIterable[QueryResultType]:
+        """Recognize intent for an admitted query."""
+        original_input = query.input
+        normalized: typing.Optional[NormalizedInput] = None
 
-                if self.failure_token and (self.failure_token in query.input.split()):
+        try:
+            graph_key = self.graph_key(query)
+            await self.wait_for_graph(trace, graph_key)
+
+            if self.has_graph(graph_key):
+                normalized = self.normalize_query(query, trace, graph_key)
+
+                if normalized.has_failure_token:
                     # Failure token was found in input
                     recognitions = []
                 else:
-                    # Pass in raw query input so raw values will be correct
-                    recognitions = recognize(
+                    # Pass in raw query input so raw values will be correct.
+                    # Search runs in a worker so other queries aren't blocked.
+                    start_time = time.perf_counter()
+                    recognitions = await self.recognize(
                         query.input,
-                        self.intent_graph,
-                        intent_filter=intent_filter,
-                        word_transform=self.word_transform,
-                        fuzzy=self.fuzzy,
-                        extra_converters=self.extra_converters,
+                        intent_names=query.intent_filter,
+                        stats=(trace["search"] if trace else None),
+                        tokens=normalized.tokens,
+                        graph_key=graph_key,
                     )
+
+                    self.end_stage("recognize", start_time, trace)
             else:
                 _LOGGER.error("No intent graph loaded")
                 recognitions = []
 
-            if NluHermesMqtt.is_success(recognitions):
-                # Use first recognition only.
-                recognition = recognitions[0]
-                assert recognition is not None
-                assert recognition.intent is not None
+            for result in self.query_results(
+                query, original_input, recognitions, trace, normalized=normalized
+            ):
+                yield result
+        except Exception as e:
+            _LOGGER.exception("handle_query")
+            yield self.query_error(query, original_input, e, trace)
 
-                intent = Intent(
-                    intent_name=recognition.intent.name,
-                    confidence_score=recognition.intent.confidence,
-                )
-                slots = [
+    def owns_query(self, query: NluQuery) -> bool:
+        """True if this instance should answer query (partition mode)."""
+        if self.partition is None:
+            return True
+
+        index, count = self.partition
+        return site_partition(query.site_id, count) == index
+
+    def graph_key(self, query: NluQuery) -> typing.Optional[str]:
+        """Key of site id/language graph for query (None for default graph)."""
+        if not self.profiles:
+            return None
+
+        return self.profiles.query_key(query.site_id, query.lang or self.lang)
+
+    def has_graph(self, graph_key: typing.Optional[str] = None) -> bool:
+        """True if graph for key is loaded."""
+        return self.recognizer.get_index(graph_key) is not None
+
+    async def wait_for_graph(self, trace=None, graph_key: typing.Optional[str] = None):
+        """Wait for graph to load (started at startup or by first query)."""
+        if graph_key is not None:
+            if not self.profiles.is_loaded(graph_key):
+                start_time = time.perf_counter()
+
+                # Loading another graph may evict this one before the
+                # query resumes, so load again until it's there.
+                for _ in range(MAX_GRAPH_LOADS):
+                    await self.load_profile_graph(graph_key)
+                    if self.profiles.is_loaded(graph_key):
+                        break
+
+                self.end_stage("graph_wait", start_time, trace)
+        elif not self.intent_graph and self.graph_path and self.graph_path.is_file():
+            start_time = time.perf_counter()
+            await self.load_graph()
+            self.end_stage("graph_wait", start_time, trace)
+
+    def normalize_query(
+        self,
+        query: NluQuery,
+        trace: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        graph_key: typing.Optional[str] = None,
+    ) -> NormalizedInput:
+        """Tokenize query input and replace digits with words.
+
+        Numbers are replaced using the number table of the query's graph.
+        Query input is updated in place if numbers are replaced.
+        """
+        start_time = time.perf_counter()
+        number_table = self.graph_number_table(graph_key)
+        normalized = normalize_tokens(
+            query_tokens(query),
+            number_table=number_table,
+            failure_token=self.failure_token,
+        )
+
+        if number_table is not None:
+            query.input = normalized.text
+
+        self.end_stage("normalize", start_time, trace)
+
+        return normalized
+
+    def query_results(
+        self,
+        query: NluQuery,
+        original_input: str,
+        recognitions: typing.List[Recognition],
+        trace: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        normalized: typing.Optional[NormalizedInput] = None,
+    ) -> typing.Iterable[QueryResultType]:
+        """Messages to publish for recognition results of a query.
+
+        If original_slot_ranges is True and normalized is given, slot raw
+        ranges and values are for the original input instead of the text
+        matched by rhasspynlu.
+        """
+        if NluHermesMqtt.is_success(recognitions):
+            # Use first recognition only.
+            recognition = recognitions[0]
+            assert recognition is not None
+            assert recognition.intent is not None
+
+            start_time = time.perf_counter()
+            intent = Intent(
+                intent_name=recognition.intent.name,
+                confidence_score=recognition.intent.confidence,
+            )
+            slots = []
+            for e in recognition.entities:
+                raw_start, raw_end, raw_value = e.raw_start, e.raw_end, e.raw_value
+                if self.original_slot_ranges and (normalized is not None):
+                    raw_span = normalized.matched_span(
+                        recognition.raw_tokens,
+                        e.raw_start,
+                        e.raw_end,
+                        raw_text=original_input,
+                    )
+
+                    if raw_span is not None:
+                        raw_start, raw_end = raw_span
+                        raw_value = original_input[raw_start:raw_end]
+
+                slots.append(
                     Slot(
                         entity=(e.source or e.entity),
                         slot_name=e.entity,
                         confidence=1.0,
                         value=e.value_dict,
-                        raw_value=e.raw_value,
+                        raw_value=raw_value,
                         range=SlotRange(
                             start=e.start,
                             end=e.end,
-                            raw_start=e.raw_start,
-                            raw_end=e.raw_end,
+                            raw_start=raw_start,
+                            raw_end=raw_end,
                         ),
                     )
-                    for e in recognition.entities
-                ]
+                )
 
-                if query.custom_entities:
-                    # Copy user-defined entities
-                    for entity_name, entity_value in query.custom_entities.items():
-                        slots.append(
-                            Slot(
-                                entity=entity_name,
-                                confidence=1.0,
-                                value={"value": entity_value},
-                            )
+            if query.custom_entities:
+                # Copy user-defined entities
+                for entity_name, entity_value in query.custom_entities.items():
+                    slots.append(
+                        Slot(
+                            entity=entity_name,
+                            confidence=1.0,
+                            value={"value": entity_value},
                         )
+                    )
 
-                # intentParsed
-                yield NluIntentParsed(
-                    input=recognition.text,
-                    id=query.id,
+            # Intent and slots are encoded once for both messages
+            payload_fields: typing.Optional[PayloadType] = None
+            try:
+                payload_fields = shared_fields(intent, slots)
+            except TypeError:
+                # Value that only dataclass conversion can encode
+                pass
+
+            self.end_stage("slots", start_time, trace)
+            custom_data = self.finish_trace(
+                trace, query.custom_data, intent=recognition.intent.name
+            )
+
+            # intentParsed
+            intent_parsed = NluIntentParsed(
+                input=recognition.text,
+                id=query.id,
+                site_id=query.site_id,
+                session_id=query.session_id,
+                intent=intent,
+                slots=slots,
+            )
+            self.set_payload_fields(intent_parsed, payload_fields)
+            yield intent_parsed
+
+            # intent
+            nlu_intent = NluIntent(
+                input=recognition.text,
+                id=query.id,
+                site_id=query.site_id,
+                session_id=query.session_id,
+                intent=intent,
+                slots=slots,
+                asr_tokens=[NluIntent.make_asr_tokens(recognition.tokens)],
+                asr_confidence=query.asr_confidence,
+                raw_input=original_input,
+                wakeword_id=query.wakeword_id,
+                lang=(query.lang or self.lang),
+                custom_data=custom_data,
+            )
+            self.set_payload_fields(nlu_intent, payload_fields)
+            yield (nlu_intent, {"intent_name": recognition.intent.name})
+
+            if self.metrics:
+                self.metrics.results.inc(
+                    result="intent",
+                    intent=recognition.intent.name,
                     site_id=query.site_id,
-                    session_id=query.session_id,
-                    intent=intent,
-                    slots=slots,
                 )
+        else:
+            # Not recognized
+            yield NluIntentNotRecognized(
+                input=query.input,
+                id=query.id,
+                site_id=query.site_id,
+                session_id=query.session_id,
+                custom_data=self.finish_trace(trace, query.custom_data),
+            )
 
-                # intent
-                yield (
-                    NluIntent(
-                        input=recognition.text,
-                        id=query.id,
-                        site_id=query.site_id,
-                        session_id=query.session_id,
-                        intent=intent,
-                        slots=slots,
-                        asr_tokens=[NluIntent.make_asr_tokens(recognition.tokens)],
-                        asr_confidence=query.asr_confidence,
-                        raw_input=original_input,
-                        wakeword_id=query.wakeword_id,
-                        lang=(query.lang or self.lang),
-                        custom_data=query.custom_data,
-                    ),
-                    {"intent_name": recognition.intent.name},
-                )
-            else:
-                # Not recognized
-                yield NluIntentNotRecognized(
-                    input=query.input,
-                    id=query.id,
-                    site_id=query.site_id,
-                    session_id=query.session_id,
-                    custom_data=query.custom_data,
+            if self.metrics:
+                self.metrics.results.inc(
+                    result="not_recognized", intent="", site_id=query.site_id
                 )
-        except Exception as e:
-            _LOGGER.exception("handle_query")
-            yield NluError(
+
+    def query_expired(
+        self,
+        query: NluQuery,
+        trace: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> typing.Union[NluIntentNotRecognized, NluError]:
+        """Result for a query dropped after waiting too long in queue."""
+        if self.metrics:
+            self.metrics.results.inc(result="expired", intent="", site_id=query.site_id)
+
+        _LOGGER.warning(
+            "Dropped query %s from %s (waited over %s second(s))",
+            query.id,
+            query.site_id,
+            self.scheduler.max_age if self.scheduler else None,
+        )
+
+        if self.expired_query_result == "error":
+            self.finish_trace(trace, None, error="query expired")
+            return NluError(
                 site_id=query.site_id,
                 session_id=query.session_id,
-                error=str(e),
-                context=original_input,
+                error="query expired",
+                context=query.input,
+            )
+
+        return NluIntentNotRecognized(
+            input=query.input,
+            id=query.id,
+            site_id=query.site_id,
+            session_id=query.session_id,
+            custom_data=self.finish_trace(trace, query.custom_data, expired=True),
+        )
+
+    def query_error(
+        self,
+        query: NluQuery,
+        original_input: str,
+        error: Exception,
+        trace: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> NluError:
+        """Error message for a failed query."""
+        if self.metrics:
+            self.metrics.results.inc(result="error", intent="", site_id=query.site_id)
+
+        self.finish_trace(trace, None, error=str(error))
+
+        return NluError(
+            site_id=query.site_id,
+            session_id=query.session_id,
+            error=str(error),
+            context=original_input,
+        )
+
+    # -------------------------------------------------------------------------
+
+    async def recognize_batch(
+        self,
+        queries: typing.Iterable[NluQuery],
+        alternatives: typing.Optional[typing.List[typing.List[Recognition]]] = None,
+    ) -> typing.List[typing.List[QueryResultType]]:
+        """Do intent recognition for many queries at once.
+
+        Returns the messages handle_query would yield for each query, in order.
+        Recognition is done once per distinct input and intent filter, and
+        recognitions are spread across all workers.
+
+        If alternatives is given, the recognitions after the first (see
+        n_best) are added to it for each successful query ([] otherwise).
+        """
+        queries = list(queries)
+        original_inputs = [query.input for query in queries]
+        results: typing.List[typing.List[QueryResultType]] = [[] for _ in queries]
+
+        try:
+            await self.wait_for_graph()
+        except Exception as e:
+            _LOGGER.exception("recognize_batch")
+            return [
+                [self.query_error(query, original_input, e)]
+                for query, original_input in zip(queries, original_inputs)
+            ]
+
+        # (input, intent filter, graph key) -> indexes of queries
+        jobs: typing.Dict[
+            typing.Tuple[
+                str, typing.Optional[typing.FrozenSet[str]], typing.Optional[str]
+            ],
+            typing.List[int],
+        ] = {}
+        normalized_inputs: typing.List[typing.Optional[NormalizedInput]] = [
+            None for _ in queries
+        ]
+        recognitions: typing.List[typing.List[Recognition]] = [[] for _ in queries]
+
+        for query_index, query in enumerate(queries):
+            try:
+                graph_key = self.graph_key(query)
+                if (graph_key is None) and (not self.intent_graph):
+                    _LOGGER.error("No intent graph loaded")
+                    continue
+
+                normalized = self.normalize_query(query, graph_key=graph_key)
+                normalized_inputs[query_index] = normalized
+                if not normalized.has_failure_token:
+                    intent_names = (
+                        frozenset(query.intent_filter) if query.intent_filter else None
+                    )
+                    jobs.setdefault(
+                        (normalized.text, intent_names, graph_key), []
+                    ).append(query_index)
+            except Exception as e:
+                _LOGGER.exception("recognize_batch")
+                results[query_index] = [
+                    self.query_error(query, original_inputs[query_index], e)
+                ]
+
+        semaphore = asyncio.Semaphore(self.recognizer.max_in_flight)
+
+        async def run_job(job_key, query_indexes):
+            input_text, _, graph_key = job_key
+            intent_filter = queries[query_indexes[0]].intent_filter
+            normalized = normalized_inputs[query_indexes[0]]
+            assert normalized is not None
+            tokens = normalized.tokens
+
+            async with semaphore:
+                # Site id/language graph may not be loaded yet (or evicted)
+                await self.wait_for_graph(graph_key=graph_key)
+                intent_index = self.recognizer.get_index(graph_key)
+
+                job_recognitions = await self.recognize(
+                    input_text,
+                    intent_names=intent_filter,
+                    tokens=tokens,
+                    graph_key=graph_key,
+                )
+
+                for query_index in query_indexes:
+                    recognitions[query_index] = job_recognitions
+
+                    if (query_index != query_indexes[-1]) and (
+                        not self.is_cacheable(job_recognitions, intent_index)
+                    ):
+                        # Don't share results from non-deterministic converters
+                        await self.wait_for_graph(graph_key=graph_key)
+                        job_recognitions = await self.recognize(
+                            input_text,
+                            intent_names=intent_filter,
+                            tokens=tokens,
+                            graph_key=graph_key,
+                        )
+
+        # Jobs with the same graph and intent filter run together to reuse
+        # loaded and filtered graphs
+        sorted_jobs = sorted(
+            jobs.items(),
+            key=lambda job: (job[0][2] or "", sorted(job[0][1]) if job[0][1] else []),
+        )
+        job_results = await asyncio.gather(
+            *(run_job(job_key, indexes) for job_key, indexes in sorted_jobs),
+            return_exceptions=True,
+        )
+
+        for (_, query_indexes), job_result in zip(sorted_jobs, job_results):
+            if isinstance(job_result, Exception):
+                _LOGGER.error("recognize_batch: %s", job_result)
+                for query_index in query_indexes:
+                    results[query_index] = [
+                        self.query_error(
+                            queries[query_index],
+                            original_inputs[query_index],
+                            job_result,
+                        )
+                    ]
+
+        for query_index, query in enumerate(queries):
+            if results[query_index]:
+                # Error
+                continue
+
+            try:
+                results[query_index] = list(
+                    self.query_results(
+                        query,
+                        original_inputs[query_index],
+                        recognitions[query_index],
+                        normalized=normalized_inputs[query_index],
+                    )
+                )
+            except Exception as e:
+                _LOGGER.exception("recognize_batch")
+                results[query_index] = [
+                    self.query_error(query, original_inputs[query_index], e)
+                ]
+
+        if alternatives is not None:
+            alternatives.extend(
+                query_recognitions[1:]
+                if NluHermesMqtt.is_success(query_recognitions)
+                else []
+                for query_recognitions in recognitions
             )
 
+        return results
+
+    # -------------------------------------------------------------------------
+
+    def queries_queued(self) -> int:
+        """Queries waiting for the scheduler or a recognition worker."""
+        queued = self.recognizer.queued
+        if self.scheduler is not None:
+            queued += self.scheduler.waiting
+
+        return queued
+
+    def queries_dropped(self) -> int:
+        """Queries dropped by the scheduler or a full recognition queue."""
+        dropped = self.recognizer.dropped
+        if self.scheduler is not None:
+            dropped += self.scheduler.dropped
+
+        return dropped
+
+    def start_trace(
+        self, query: NluQuery
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """Start a trace if this query is sampled (None otherwise)."""
+        if (self.trace_sample_rate <= 0) or (random.random() >= self.trace_sample_rate):
+            return None
+
+        return {
+            "id": query.id,
+            "siteId": query.site_id,
+            "startTime": time.perf_counter(),
+            "stages": {},
+            "search": {},
+        }
+
+    def end_stage(
+        self,
+        stage: str,
+        start_time: float,
+        trace: typing.Optional[typing.Dict[str, typing.Any]],
+    ):
+        """Record seconds since start_time for a stage in metrics and trace."""
+        seconds = time.perf_counter() - start_time
+
+        if self.metrics:
+            self.metrics.stage_seconds.observe(seconds, stage=stage)
+
+        if trace is not None:
+            trace["stages"][stage] = seconds
+
+    def finish_trace(
+        self,
+        trace: typing.Optional[typing.Dict[str, typing.Any]],
+        custom_data: typing.Optional[str],
+        **fields,
+    ) -> typing.Optional[str]:
+        """Log a finished trace and return custom data to send with the result.
+
+        The trace is added to custom data as "nluTrace" only when
+        trace_custom_data is enabled and custom data is empty or a JSON object.
+        """
+        if trace is None:
+            return custom_data
+
+        trace.update(fields)
+        trace["totalSeconds"] = time.perf_counter() - trace.pop("startTime")
+        _LOGGER.info("trace %s", json.dumps(trace))
+
+        if not self.trace_custom_data:
+            return custom_data
+
+        if not custom_data:
+            return json.dumps({"nluTrace": trace})
+
+        try:
+            custom_dict = json.loads(custom_data)
+        except ValueError:
+            return custom_data
+
+        if not isinstance(custom_dict, dict):
+            # Don't change non-object custom data
+            return custom_data
+
+        custom_dict["nluTrace"] = trace
+        return json.dumps(custom_dict)
+
+    # -------------------------------------------------------------------------
+
+    async def recognize(
+        self,
+        input_text: str,
+        intent_names: typing.Optional[typing.List[str]] = None,
+        stats: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        tokens: typing.Optional[typing.List[str]] = None,
+        graph_key: typing.Optional[str] = None,
+    ) -> typing.List[Recognition]:
+        """Recognize intents from (number-replaced) input text, using the cache.
+
+        If tokens are given, they are searched instead of input_text.
+        If stats is given, search stats (or cached=True) are stored in it.
+        If graph_key is given, the site id/language graph is used.
+        """
+        if tokens is None:
+            tokens = input_text.split()
+
+        if self.recognition_cache is None:
+            return await self.recognizer.recognize(
+                tokens, intent_names=intent_names, stats=stats, graph_key=graph_key
+            )
+
+        # Input is not case-transformed since raw values keep the input casing
+        generation = self.recognizer.get_generation(graph_key)
+        cache_key = (
+            tuple(tokens),
+            frozenset(intent_names) if intent_names else None,
+            self.fuzzy,
+            graph_key,
+            generation,
+        )
+
+        recognitions = self.recognition_cache.get(cache_key)
+        if recognitions is None:
+            intent_index = self.recognizer.get_index(graph_key)
+            recognitions = await self.recognizer.recognize(
+                tokens, intent_names=intent_names, stats=stats, graph_key=graph_key
+            )
+
+            if (
+                generation == self.recognizer.get_generation(graph_key)
+            ) and self.is_cacheable(recognitions, intent_index):
+                self.recognition_cache.put(cache_key, recognitions)
+        elif stats is not None:
+            stats["cached"] = True
+
+        _LOGGER.debug(
+            "Recognition cache: %s hit(s), %s miss(es), %s entries",
+            self.recognition_cache.hits,
+            self.recognition_cache.misses,
+            len(self.recognition_cache),
+        )
+
+        return recognitions
+
+    def is_cacheable(
+        self,
+        recognitions: typing.List[Recognition],
+        intent_index: typing.Optional[IntentIndex],
+    ) -> bool:
+        """False if recognized intents may use uncached converters."""
+        if (not self.uncached_converters) or (intent_index is None):
+            return True
+
+        for recognition in recognitions:
+            if recognition.intent and (
+                self.uncached_converters
+                & intent_index.intent_converters(recognition.intent.name)
+            ):
+                return False
+
+        return True
+
     # -------------------------------------------------------------------------
 
     @staticmethod
@@ -227,11 +1137,14 @@ class NluHermesMqtt(HermesClient):
     ) -> typing.AsyncIterable[
         typing.Union[typing.Tuple[NluTrainSuccess, TopicArgs], NluError]
     ]:
-        """Transform sentences to intent graph"""
+        """Transform sentences to intent graph.
+
+        Site ids (or languages) with their own graph only retrain that graph.
+        A graph file that hasn't changed since it was loaded is not loaded again.
+        """
         try:
-            _LOGGER.debug("Loading %s", train.graph_path)
-            with open(train.graph_path, mode="rb") as graph_file:
-                self.intent_graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
+            graph_key = self.profiles.train_key(site_id) if self.profiles else None
+            await self.reload_graph(Path(train.graph_path), graph_key)
 
             yield (NluTrainSuccess(id=train.id), {"site_id": site_id})
         except Exception as e:
@@ -240,6 +1153,167 @@ class NluHermesMqtt(HermesClient):
                 site_id=site_id, session_id=train.id, error=str(e), context=train.id
             )
 
+    async def reload_graph(
+        self, graph_path: Path, graph_key: typing.Optional[str] = None
+    ) -> bool:
+        """Load graph from a file unless it's the same file and content as before.
+
+        Returns True if the graph was loaded.
+        """
+        if self.train_lock is None:
+            self.train_lock = asyncio.Lock()
+
+        async with self.train_lock:
+            # Load and validate off the event loop so queries keep running
+            # against the current graph.
+            start_time = time.perf_counter()
+            loop = asyncio.get_running_loop()
+
+            fingerprint: typing.Optional[GraphFingerprint] = None
+            old_fingerprint = self.graph_fingerprints.get(graph_key)
+            if old_fingerprint is not None:
+                fingerprint = await loop.run_in_executor(
+                    None, graph_fingerprint, graph_path, old_fingerprint
+                )
+
+                if (fingerprint.path == old_fingerprint.path) and (
+                    fingerprint.digest == old_fingerprint.digest
+                ):
+                    # Same file, possibly touched or rewritten with same content
+                    _LOGGER.debug("Graph unchanged: %s (key=%s)", graph_path, graph_key)
+                    self.graph_fingerprints[graph_key] = fingerprint
+                    return False
+
+            loaded = await self._load_graph_file(
+                graph_path, fingerprint, graph_key=graph_key
+            )
+
+            # Swap in new graph. Queries already in a worker finish with the
+            # graph they started on; process workers load the new graph before
+            # training is done.
+            if graph_key is not None:
+                self.profiles.graph_paths[graph_key] = graph_path
+                self.profile_trains[graph_key] = (
+                    self.profile_trains.get(graph_key, 0) + 1
+                )
+
+            self.set_graph(
+                loaded.graph,
+                graph_path=graph_path,
+                graph_key=graph_key,
+                intent_index=loaded.intent_index,
+                number_table=loaded.number_table,
+                fingerprint=loaded.fingerprint,
+            )
+            await self.recognizer.warm_workers(graph_key)
+
+            load_seconds = time.perf_counter() - start_time
+            _LOGGER.debug(
+                "Loaded %s in %s second(s) (key=%s, generation=%s)",
+                graph_path,
+                load_seconds,
+                graph_key,
+                self.recognizer.generation,
+            )
+
+            if self.metrics:
+                self.metrics.stage_seconds.observe(load_seconds, stage="graph_load")
+
+        return True
+
+    async def watch_graphs(self, interval: float):
+        """Reload graphs in the background when their files change on disk.
+
+        Files of loaded graphs are checked every interval seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+
+            for graph_key, fingerprint in list(self.graph_fingerprints.items()):
+                try:
+                    if await self.reload_graph(Path(fingerprint.path), graph_key):
+                        _LOGGER.info(
+                            "Reloaded changed graph %s (key=%s)",
+                            fingerprint.path,
+                            graph_key,
+                        )
+                except Exception:
+                    # File may be partially written; try again next time
+                    _LOGGER.exception("watch_graphs")
+
+    # -------------------------------------------------------------------------
+
+    def set_payload_fields(
+        self,
+        message: typing.Union[NluIntentParsed, NluIntent],
+        payload_fields: typing.Optional[PayloadType],
+    ):
+        """Store encoded intent and slots of an intent message until it is gone."""
+        if payload_fields is None:
+            return
+
+        key = id(message)
+        all_fields = self.payload_fields
+
+        def forget(message_ref: weakref.ref):
+            # Another message may have been stored with the same id since
+            entry = all_fields.get(key)
+            if (entry is not None) and (entry[0] is message_ref):
+                del all_fields[key]
+
+        all_fields[key] = (weakref.ref(message, forget), payload_fields)
+
+    def message_payload(self, message: Message) -> PayloadType:
+        """Payload for a message with intent and slots encoded by query_results."""
+        shared: typing.Optional[PayloadType] = None
+        entry = self.payload_fields.get(id(message))
+        if (entry is not None) and (entry[0]() is message):
+            shared = entry[1]
+
+        return message_payload(message, shared=shared)
+
+    def publish(self, message: Message, **topic_args):
+        """Publish a Hermes message to MQTT (timed when metrics are enabled)."""
+        if not self.metrics:
+            self._publish(message, **topic_args)
+            return
+
+        with self.metrics.stage_seconds.time(stage="publish"):
+            self._publish(message, **topic_args)
+
+    def _publish(self, message: Message, **topic_args):
+        """Publish intent messages with fast payloads, others with HermesClient."""
+        if not isinstance(message, (NluIntentParsed, NluIntent)):
+            super().publish(message, **topic_args)
+            return
+
+        try:
+            topic = message.topic(**topic_args)
+            payload = self.message_payload(message)
+
+            self.logger.debug("-> %s", message)
+            self.logger.debug("Publishing %s bytes(s) to %s", len(payload), topic)
+
+            self.mqtt_client.publish(topic, payload)
+        except Exception:
+            self.logger.exception(
+                "publish (message=%s, topic_args=%s)",
+                message.__class__.__name__,
+                topic_args,
+            )
+
+    async def publish_metrics(self, topic: str, interval: float):
+        """Publish metrics as JSON to an MQTT topic every interval seconds."""
+        assert self.metrics is not None, "Metrics are disabled"
+
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                self.mqtt_client.publish(topic, json.dumps(self.metrics.to_dict()))
+            except Exception:
+                _LOGGER.exception("publish_metrics")
+
     # -------------------------------------------------------------------------
 
     async def on_message(
@@ -251,8 +1325,23 @@ class NluHermesMqtt(HermesClient):
     ) -> GeneratorType:
         """Received message from MQTT broker."""
         if isinstance(message, NluQuery):
-            async for query_result in self.handle_query(message):
-                yield query_result
+            if not self.owns_query(message):
+                _LOGGER.debug(
+                    "Skipping query %s from %s (other partition)",
+                    message.id,
+                    message.site_id,
+                )
+                return
+
+            if self.metrics:
+                self.metrics.queries_in_flight.inc()
+
+            try:
+                async for query_result in self.handle_query(message):
+                    yield query_result
+            finally:
+                if self.metrics:
+                    self.metrics.queries_in_flight.dec()
         elif isinstance(message, NluTrain):
             assert site_id, "Missing site_id"
             async for train_result in self.handle_train(message, site_id=site_id):
@@ -1,15 +1,30 @@
 """Hermes MQTT service for rhasspynlu"""
 import argparse
 import asyncio
+import contextlib
+import json
 import logging
+import os
+import sys
 import typing
 from pathlib import Path
 
 import paho.mqtt.client as mqtt
 import rhasspyhermes.cli as hermes_cli
+from rhasspyhermes.nlu import NluIntent, NluQuery
+from rhasspynlu.intent import Recognition
 
 from . import NluHermesMqtt
-from .utils import load_converters
+from .cluster import parse_partition
+from .metrics import NluMetrics
+from .stream import result_to_json, run_stdio, run_unix_socket
+from .utils import (
+    TIMEOUT_ACTIONS,
+    close_converters,
+    load_converters,
+    load_entry_point_converters,
+)
+from .workers import WORKER_TYPES
 
 _LOGGER = logging.getLogger("rhasspynlu_hermes")
 
@@ -19,7 +34,40 @@ _LOGGER = logging.getLogger("rhasspynlu_hermes")
 def main():
     """Main method."""
     parser = argparse.ArgumentParser(prog="rhasspy-nlu-hermes")
-    parser.add_argument("--intent-graph", help="Path to intent graph (gzipped pickle)")
+    parser.add_argument(
+        "--intent-graph", help="Path to intent graph (gzipped pickle or compiled)"
+    )
+    parser.add_argument(
+        "--site-graph",
+        nargs=2,
+        action="append",
+        metavar=("SITE_ID", "GRAPH"),
+        help="Path to intent graph for a site id (loaded on first use)",
+    )
+    parser.add_argument(
+        "--lang-graph",
+        nargs=2,
+        action="append",
+        metavar=("LANG", "GRAPH"),
+        help="Path to intent graph for a language (loaded on first use)",
+    )
+    parser.add_argument(
+        "--max-graph-memory",
+        type=float,
+        default=0,
+        help="Evict least recently used site id/language graphs above this many MB (approximate, 0 = no limit)",
+    )
+    parser.add_argument(
+        "--watch-graph-interval",
+        type=float,
+        default=0,
+        help="Seconds between checks for changed graph files, which are reloaded in the background (0 = disable, default: 0)",
+    )
+    parser.add_argument(
+        "--preload-graph",
+        action="store_true",
+        help="Load intent graph in the background at startup instead of on first query",
+    )
     parser.add_argument(
         "--casing",
         choices=["upper", "lower", "ignore"],
@@ -34,17 +82,163 @@ def main():
         action="store_true",
         help="Replace digits with words in queries (75 -> seventy five)",
     )
+    parser.add_argument(
+        "--original-slot-ranges",
+        action="store_true",
+        help="Slot raw values and ranges refer to the original query input (e.g., 75 instead of seventy five)",
+    )
     parser.add_argument(
         "--language", help="Language/locale used for number replacement (default: en)"
     )
+    parser.add_argument(
+        "--max-exact-sentences",
+        type=int,
+        default=0,
+        help="Index sentences for exact matching if graph has at most this many (0 = disable, default: 0)",
+    )
+    parser.add_argument(
+        "--n-best",
+        type=int,
+        help="Stop graph search after this many intents (best first) instead of searching the whole graph. Intents after the first are only written out with --batch (as alternatives)",
+    )
+    parser.add_argument(
+        "--confidence-threshold",
+        type=float,
+        help="Stop graph search at the first result with at least this confidence (0-1)",
+    )
     parser.add_argument(
         "--converters-dir",
-        help="Path to custom converter directory with executable scripts",
+        help="Path to custom converter directory with executable scripts or Python modules",
+    )
+    parser.add_argument(
+        "--converter-timeout",
+        type=float,
+        help="Seconds before an external converter program is killed (default: none)",
+    )
+    parser.add_argument(
+        "--converter-timeout-action",
+        choices=TIMEOUT_ACTIONS,
+        default="error",
+        help="Fail query or pass input values through when a converter times out (default: error)",
+    )
+    parser.add_argument(
+        "--converter-cache-size",
+        type=int,
+        default=1000,
+        help="Number of outputs cached for each pure converter (default: 1000)",
+    )
+    parser.add_argument(
+        "--converter-cache-ttl",
+        type=float,
+        help="Seconds before a cached converter output expires (default: never)",
     )
     parser.add_argument(
         "--failure-token", help="Always fail to recognize if token is present"
     )
     parser.add_argument("--lang", help="Set lang in hotword detected message")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of recognition workers (0 = run on event loop, default: 1, or CPU count with --batch)",
+    )
+    parser.add_argument(
+        "--worker-type",
+        choices=WORKER_TYPES,
+        help="Type of recognition workers (default: thread, or process with --batch)",
+    )
+    parser.add_argument(
+        "--max-queued-queries",
+        type=int,
+        default=100,
+        help="Maximum queries waiting for a worker before errors are returned (0 = no limit, default: 100)",
+    )
+    parser.add_argument(
+        "--fair-scheduling",
+        action="store_true",
+        help="Admit waiting queries round-robin by site id, with intent filtered (session) queries first",
+    )
+    parser.add_argument(
+        "--max-query-age",
+        type=float,
+        help="Drop queries that wait longer than this many seconds to be recognized (enables --fair-scheduling)",
+    )
+    parser.add_argument(
+        "--expired-query-result",
+        choices=["not-recognized", "error"],
+        default="not-recognized",
+        help="Message sent for dropped queries (default: not-recognized)",
+    )
+    parser.add_argument(
+        "--shared-group",
+        help="Receive queries through an MQTT shared subscription ($share/GROUP/hermes/nlu/query) so each query goes to one instance in the group",
+    )
+    parser.add_argument(
+        "--partition",
+        type=parse_partition,
+        help="Only answer queries for site ids in partition INDEX/COUNT (e.g., 0/3) for brokers without shared subscriptions",
+    )
+
+    parser.add_argument(
+        "--recognition-cache-size",
+        type=int,
+        default=0,
+        help="Number of recognition results to cache (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "--recognition-cache-ttl",
+        type=float,
+        help="Seconds before a cached recognition result expires (default: never)",
+    )
+    parser.add_argument(
+        "--uncached-converter",
+        action="append",
+        default=[],
+        help="Name of a non-deterministic converter whose intents are never cached",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this HTTP port"
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="Host for metrics HTTP server (default: 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=0,
+        help="Seconds between publishing metrics to MQTT (default: 0, disabled)",
+    )
+    parser.add_argument(
+        "--metrics-topic",
+        default="rhasspy/nlu/metrics",
+        help="MQTT topic for metrics (default: rhasspy/nlu/metrics)",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        type=float,
+        default=0,
+        help="Fraction of queries (0-1) to log stage timings for (default: 0)",
+    )
+    parser.add_argument(
+        "--trace-custom-data",
+        action="store_true",
+        help="Add query traces to customData of intent/not recognized messages",
+    )
+
+    parser.add_argument(
+        "--batch",
+        help="Recognize NluQuery JSON lines from file (- for stdin) and exit instead of connecting to MQTT (queries for other --site-id or --partition values are skipped)",
+    )
+    parser.add_argument(
+        "--batch-output",
+        default="-",
+        help="File to write result messages as JSON lines with --batch (default: stdout)",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Handle NluQuery JSON lines from stdin (-) or a Unix socket path instead of connecting to MQTT",
+    )
 
     hermes_cli.add_hermes_args(parser)
 
@@ -53,14 +247,39 @@ def main():
     hermes_cli.setup_logging(args)
     _LOGGER.debug(args)
 
+    # Batch recognition uses all cores
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if args.batch else 1
+
+    if args.worker_type is None:
+        args.worker_type = "process" if args.batch else "thread"
+
+    if args.batch:
+        args.max_queued_queries = 0
+
     # Convert to Paths
     if args.intent_graph:
         args.intent_graph = Path(args.intent_graph)
 
-    extra_converters = None
+    # Converters from installed packages, then converters directory
+    extra_converters = load_entry_point_converters()
     if args.converters_dir:
         args.converters_dir = Path(args.converters_dir)
-        extra_converters = load_converters(args.converters_dir)
+        extra_converters.update(
+            load_converters(
+                args.converters_dir,
+                timeout=args.converter_timeout,
+                on_timeout=args.converter_timeout_action,
+                cache_size=args.converter_cache_size,
+                cache_ttl=args.converter_cache_ttl,
+            )
+        )
+
+    metrics: typing.Optional[NluMetrics] = None
+    if (args.metrics_port is not None) or (args.metrics_interval > 0):
+        metrics = NluMetrics()
+        if args.metrics_port is not None:
+            metrics.serve(args.metrics_port, host=args.metrics_host)
 
     # Listen for messages
     client = mqtt.Client()
@@ -70,25 +289,173 @@ def main():
         word_transform=get_word_transform(args.casing),
         replace_numbers=args.replace_numbers,
         language=args.language,
+        original_slot_ranges=args.original_slot_ranges,
         fuzzy=(not args.no_fuzzy),
-        extra_converters=extra_converters,
+        extra_converters=(extra_converters or None),
         failure_token=args.failure_token,
         site_ids=args.site_id,
         lang=args.lang,
+        workers=args.workers,
+        worker_type=args.worker_type,
+        max_queued_queries=args.max_queued_queries,
+        recognition_cache_size=args.recognition_cache_size,
+        recognition_cache_ttl=args.recognition_cache_ttl,
+        uncached_converters=args.uncached_converter,
+        metrics=metrics,
+        trace_sample_rate=args.trace_sample_rate,
+        trace_custom_data=args.trace_custom_data,
+        n_best=args.n_best,
+        max_exact_sentences=args.max_exact_sentences,
+        confidence_threshold=args.confidence_threshold,
+        site_graphs={
+            site_id: Path(graph_path) for site_id, graph_path in args.site_graph or []
+        },
+        lang_graphs={
+            lang: Path(graph_path) for lang, graph_path in args.lang_graph or []
+        },
+        max_graph_bytes=int(args.max_graph_memory * 1024 * 1024),
+        fair_scheduling=args.fair_scheduling,
+        max_query_age=args.max_query_age,
+        expired_query_result=args.expired_query_result.replace("-", "_"),
+        shared_group=args.shared_group,
+        partition=args.partition,
     )
 
+    if args.batch or args.stream:
+        try:
+            if args.batch:
+                run_batch(hermes, args.batch, args.batch_output)
+            else:
+                run_stream(hermes, args.stream)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            hermes.recognizer.shutdown()
+
+            if extra_converters:
+                close_converters(extra_converters)
+
+        return
+
     _LOGGER.debug("Connecting to %s:%s", args.host, args.port)
     hermes_cli.connect(client, args)
     client.loop_start()
 
     try:
         # Run event loop
-        asyncio.run(hermes.handle_messages_async())
+        asyncio.run(
+            run(
+                hermes,
+                preload_graph=args.preload_graph,
+                watch_graph_interval=args.watch_graph_interval,
+                metrics_topic=args.metrics_topic,
+                metrics_interval=args.metrics_interval,
+            )
+        )
     except KeyboardInterrupt:
         pass
     finally:
         _LOGGER.debug("Shutting down")
         client.loop_stop()
+        hermes.recognizer.shutdown()
+
+        if extra_converters:
+            close_converters(extra_converters)
+
+
+# -----------------------------------------------------------------------------
+
+
+async def run(
+    hermes: NluHermesMqtt,
+    preload_graph: bool = False,
+    watch_graph_interval: float = 0,
+    metrics_topic: str = "rhasspy/nlu/metrics",
+    metrics_interval: float = 0,
+):
+    """Handle MQTT messages, optionally loading the intent graph in the background."""
+    if preload_graph and hermes.graph_path:
+        hermes.load_graph()
+
+    if watch_graph_interval > 0:
+        asyncio.ensure_future(hermes.watch_graphs(watch_graph_interval))
+
+    if hermes.metrics and (metrics_interval > 0):
+        asyncio.ensure_future(hermes.publish_metrics(metrics_topic, metrics_interval))
+
+    await hermes.handle_messages_async()
+
+
+def run_stream(hermes: NluHermesMqtt, source: str):
+    """Handle NluQuery JSON lines from stdin (-) or a Unix socket."""
+    max_in_flight = hermes.recognizer.max_in_flight
+    if source == "-":
+        asyncio.run(run_stdio(hermes, max_in_flight=max_in_flight))
+    else:
+        asyncio.run(run_unix_socket(hermes, source, max_in_flight=max_in_flight))
+
+
+def run_batch(hermes: NluHermesMqtt, input_path: str, output_path: str):
+    """Recognize NluQuery JSON lines and write result messages as JSON lines.
+
+    Each output line has the MQTT topic and payload that would have been
+    published for a query on the live path. As on the live path, queries for
+    other site ids or partitions are skipped.
+
+    With n_best, intent lines also have the other recognized intents (best
+    first) in "alternatives".
+    """
+    queries: typing.List[NluQuery] = []
+    with _open_batch_file(input_path, "r", sys.stdin) as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                query = NluQuery.from_dict(json.loads(line))
+            except Exception as e:
+                _LOGGER.error("Invalid query on line %s: %s", line_number, e)
+                continue
+
+            if hermes.valid_site_id(query.site_id) and hermes.owns_query(query):
+                queries.append(query)
+            else:
+                _LOGGER.debug("Skipping query on line %s", line_number)
+
+    _LOGGER.debug("Recognizing %s query(s)", len(queries))
+    alternatives: typing.List[typing.List[Recognition]] = []
+    results = asyncio.run(hermes.recognize_batch(queries, alternatives=alternatives))
+
+    with _open_batch_file(output_path, "w", sys.stdout) as output_file:
+        for query_results, query_alternatives in zip(results, alternatives):
+            for result in query_results:
+                extra: typing.Optional[typing.Dict[str, typing.Any]] = None
+                message = result[0] if isinstance(result, tuple) else result
+                if query_alternatives and isinstance(message, NluIntent):
+                    extra = {
+                        "alternatives": [
+                            {
+                                "intentName": recognition.intent.name,
+                                "confidenceScore": recognition.intent.confidence,
+                                "input": recognition.text,
+                            }
+                            for recognition in query_alternatives
+                            if recognition.intent is not None
+                        ]
+                    }
+
+                print(result_to_json(result, extra, hermes=hermes), file=output_file)
+
+
+def _open_batch_file(
+    path: str, mode: str, std_file: typing.IO[str]
+) -> typing.ContextManager[typing.IO[str]]:
+    """Open file for batch input/output (std_file is left open for -)."""
+    if path == "-":
+        return contextlib.nullcontext(std_file)
+
+    return open(path, mode)
 
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,58 @@
+"""Size-bounded caches for rhasspy-nlu-hermes"""
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+# -----------------------------------------------------------------------------
+
+
+class LruCache:
+    """Thread-safe least-recently-used cache with optional time to live."""
+
+    def __init__(self, max_size: int, ttl: typing.Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (time added, value)
+        self.entries: "OrderedDict[typing.Hashable, typing.Tuple[float, typing.Any]]" = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable, default: typing.Any = None) -> typing.Any:
+        """Get cached value or default (counts as a hit or miss)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                added_time, value = entry
+                if (self.ttl is None) or ((time.monotonic() - added_time) < self.ttl):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                # Expired
+                del self.entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key: typing.Hashable, value: typing.Any):
+        """Add value to cache, evicting least recently used entries."""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries (counters are kept)."""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
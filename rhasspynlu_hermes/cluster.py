@@ -0,0 +1,39 @@
+"""Sharing NLU queries between several service instances.
+
+With a shared subscription group, the MQTT broker delivers each query to
+exactly one instance in the group (MQTT 5 and Mosquitto 1.6+). For brokers
+without shared subscriptions, every instance receives every query and
+only answers the queries for site ids in its own partition.
+
+Training messages are still received by all instances.
+"""
+import typing
+import zlib
+
+SHARED_PREFIX = "$share"
+
+# -----------------------------------------------------------------------------
+
+
+def shared_topic(topic: str, group: str) -> str:
+    """MQTT shared subscription topic for a group."""
+    assert group and ("/" not in group), f"Invalid shared group: {group}"
+    return f"{SHARED_PREFIX}/{group}/{topic}"
+
+
+def site_partition(site_id: str, num_partitions: int) -> int:
+    """Partition (0 to num_partitions - 1) for a site id.
+
+    Uses a stable hash so all instances agree on the partition.
+    """
+    return zlib.crc32(site_id.encode()) % num_partitions
+
+
+def parse_partition(value: str) -> typing.Tuple[int, int]:
+    """Parse INDEX/COUNT into a (index, count) partition."""
+    index_str, count_str = value.split("/", maxsplit=1)
+    index, count = int(index_str), int(count_str)
+    if (count < 1) or not (0 <= index < count):
+        raise ValueError(f"Invalid partition: {value}")
+
+    return (index, count)
@@ -0,0 +1,266 @@
+"""Compact, memory-mapped intent graph format.
+
+Layout (native byte order, all integers are unsigned 32-bit):
+
+* header: magic, node count, edge count, string count
+* node flags (1 byte per node, padded to 4 bytes): 1 = start, 2 = final
+* node words (string index per node)
+* edge offsets per node (CSR, node count + 1)
+* edge targets, input labels, output labels (string indexes)
+* string offsets (string count + 1) followed by UTF-8 string data
+
+String index 0 is always the empty string. Node ids are preserved, so
+recognition results match the original networkx graph.
+"""
+import argparse
+import mmap
+import struct
+import sys
+import typing
+from array import array
+from pathlib import Path
+
+import networkx as nx
+import rhasspynlu
+
+MAGIC = b"RNLUGRF1"
+_HEADER = struct.Struct("=8sIII")
+
+FLAG_START = 1
+FLAG_FINAL = 2
+
+# -----------------------------------------------------------------------------
+
+
+def is_compiled_graph(graph_path: typing.Union[str, Path]) -> bool:
+    """True if file is in compiled graph format."""
+    with open(graph_path, "rb") as graph_file:
+        return graph_file.read(len(MAGIC)) == MAGIC
+
+
+def graph_to_compiled(graph: nx.DiGraph, out_file: typing.BinaryIO):
+    """Write networkx intent graph in compiled format."""
+    num_nodes = len(graph)
+    assert set(graph.nodes) == set(range(num_nodes)), "Nodes must be 0..n-1"
+
+    strings: typing.Dict[str, int] = {"": 0}
+
+    def intern(value: typing.Optional[str]) -> int:
+        value = value or ""
+        index = strings.get(value)
+        if index is None:
+            index = len(strings)
+            strings[value] = index
+
+        return index
+
+    flags = bytearray(num_nodes)
+    words = array("I", [0] * num_nodes)
+    offsets = array("I", [0])
+    targets = array("I")
+    ilabels = array("I")
+    olabels = array("I")
+
+    for node in range(num_nodes):
+        node_data = graph.nodes[node]
+        if node_data.get("start"):
+            flags[node] |= FLAG_START
+
+        if node_data.get("final"):
+            flags[node] |= FLAG_FINAL
+
+        words[node] = intern(node_data.get("word"))
+
+        # Edge order is preserved so search order is unchanged
+        for next_node, edge_data in graph[node].items():
+            targets.append(next_node)
+            ilabels.append(intern(edge_data.get("ilabel")))
+            olabels.append(intern(edge_data.get("olabel")))
+
+        offsets.append(len(targets))
+
+    string_offsets = array("I", [0])
+    string_data = bytearray()
+    for value in strings:
+        string_data.extend(value.encode())
+        string_offsets.append(len(string_data))
+
+    out_file.write(_HEADER.pack(MAGIC, num_nodes, len(targets), len(strings)))
+    out_file.write(flags)
+    out_file.write(bytes(_padding(num_nodes)))
+
+    for values in (words, offsets, targets, ilabels, olabels, string_offsets):
+        out_file.write(values.tobytes())
+
+    out_file.write(string_data)
+
+
+def _padding(num_bytes: int) -> int:
+    """Bytes needed to align to 4 bytes."""
+    return (4 - (num_bytes % 4)) % 4
+
+
+# -----------------------------------------------------------------------------
+
+
+class CompiledGraph:
+    """Read-only intent graph backed by a memory-mapped compiled file.
+
+    Implements the parts of the networkx.DiGraph API used by rhasspynlu
+    recognition: len(graph), graph.nodes(data=True) and graph[node].
+    """
+
+    def __init__(self, buffer: typing.Union[bytes, mmap.mmap]):
+        self.buffer = buffer
+        magic, self.num_nodes, self.num_edges, num_strings = _HEADER.unpack_from(
+            buffer, 0
+        )
+        assert magic == MAGIC, "Not a compiled graph"
+
+        view = memoryview(buffer)
+        offset = _HEADER.size
+
+        self.flags = view[offset : offset + self.num_nodes]
+        offset += self.num_nodes + _padding(self.num_nodes)
+
+        def take(count: int) -> memoryview:
+            nonlocal offset
+            values = view[offset : offset + (4 * count)].cast("I")
+            offset += 4 * count
+            return values
+
+        self.words = take(self.num_nodes)
+        self.edge_offsets = take(self.num_nodes + 1)
+        self.targets = take(self.num_edges)
+        self.ilabels = take(self.num_edges)
+        self.olabels = take(self.num_edges)
+        string_offsets = take(num_strings + 1)
+
+        # Interned string table
+        string_data = bytes(view[offset : offset + string_offsets[num_strings]])
+        self.strings: typing.List[str] = [
+            string_data[string_offsets[i] : string_offsets[i + 1]].decode()
+            for i in range(num_strings)
+        ]
+
+    @classmethod
+    def load(cls, graph_path: typing.Union[str, Path]) -> "CompiledGraph":
+        """Memory-map a compiled graph file (pages are shared between processes)."""
+        with open(graph_path, "rb") as graph_file:
+            buffer = mmap.mmap(graph_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(buffer)
+
+    def __len__(self) -> int:
+        return self.num_nodes
+
+    def __getitem__(self, node: int) -> "_Adjacency":
+        return _Adjacency(self, node)
+
+    def nodes(self, data: bool = False):
+        """Node view (with attribute dicts if data is True)."""
+        if data:
+            return _NodeDataView(self)
+
+        return range(self.num_nodes)
+
+    def node_data(self, node: int) -> typing.Dict[str, typing.Any]:
+        """Attributes of a node."""
+        node_data: typing.Dict[str, typing.Any] = {}
+        flags = self.flags[node]
+        if flags & FLAG_START:
+            node_data["start"] = True
+
+        if flags & FLAG_FINAL:
+            node_data["final"] = True
+
+        word_index = self.words[node]
+        if word_index:
+            node_data["word"] = self.strings[word_index]
+
+        return node_data
+
+    def edge_data(self, edge_index: int) -> typing.Dict[str, str]:
+        """Attributes of an edge."""
+        return {
+            "ilabel": self.strings[self.ilabels[edge_index]],
+            "olabel": self.strings[self.olabels[edge_index]],
+        }
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes in graph."""
+        return self.num_nodes
+
+    def number_of_edges(self) -> int:
+        """Number of edges in graph."""
+        return self.num_edges
+
+
+class _NodeDataView:
+    """graph.nodes(data=True) for a compiled graph."""
+
+    def __init__(self, graph: CompiledGraph):
+        self.graph = graph
+
+    def __len__(self) -> int:
+        return self.graph.num_nodes
+
+    def __getitem__(self, node: int) -> typing.Dict[str, typing.Any]:
+        return self.graph.node_data(node)
+
+    def __iter__(self):
+        for node in range(self.graph.num_nodes):
+            yield (node, self.graph.node_data(node))
+
+
+class _Adjacency:
+    """graph[node] for a compiled graph."""
+
+    def __init__(self, graph: CompiledGraph, node: int):
+        self.graph = graph
+        self.start = graph.edge_offsets[node]
+        self.end = graph.edge_offsets[node + 1]
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __iter__(self):
+        return (self.graph.targets[i] for i in range(self.start, self.end))
+
+    def __getitem__(self, next_node: int) -> typing.Dict[str, str]:
+        for edge_index in range(self.start, self.end):
+            if self.graph.targets[edge_index] == next_node:
+                return self.graph.edge_data(edge_index)
+
+        raise KeyError(next_node)
+
+    def items(self):
+        """(next node, edge data) pairs in original order."""
+        for edge_index in range(self.start, self.end):
+            yield (self.graph.targets[edge_index], self.graph.edge_data(edge_index))
+
+
+# -----------------------------------------------------------------------------
+
+
+def main():
+    """Convert a gzipped pickle intent graph to compiled format."""
+    parser = argparse.ArgumentParser(prog="rhasspynlu_hermes.compiled")
+    parser.add_argument("graph", help="Path to intent graph (gzipped pickle)")
+    parser.add_argument("output", help="Path to write compiled graph")
+    args = parser.parse_args()
+
+    with open(args.graph, "rb") as graph_file:
+        graph = rhasspynlu.gzip_pickle_to_graph(graph_file)
+
+    with open(args.output, "wb") as out_file:
+        graph_to_compiled(graph, out_file)
+
+    print(
+        f"Compiled {len(graph)} node(s), {graph.number_of_edges()} edge(s) to {args.output}",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Exact sentence lookup for intent graphs.
+
+Every sentence of a (finite) intent graph is enumerated once when the graph
+is loaded. Input that matches a sentence exactly is recognized from the
+stored path with rhasspynlu's path_to_recognition, skipping graph search.
+"""
+import logging
+import time
+import typing
+from array import array
+
+from rhasspynlu.fsticuffs import path_to_recognition
+from rhasspynlu.intent import Recognition, RecognitionResult
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+# (intent name, source node of each edge, bit mask of edges that consume a token,
+#  True if path has non-tag output)
+ExactPath = typing.Tuple[str, array, int, bool]
+
+# -----------------------------------------------------------------------------
+
+
+class ExactIndex:
+    """Sentences of an intent graph mapped to their graph paths.
+
+    If the graph has more than max_sentences sentences, the index is left
+    empty and every lookup misses.
+    """
+
+    def __init__(
+        self,
+        graph: typing.Any,
+        start_node: typing.Optional[int] = None,
+        word_transform: typing.Optional[typing.Callable[[str], str]] = None,
+        max_sentences: int = 100000,
+    ):
+        self.word_transform = word_transform or (lambda s: s)
+        self.max_sentences = max_sentences
+
+        # words -> paths in breadth-first search order
+        self.sentences: typing.Dict[typing.Tuple[str, ...], typing.List[ExactPath]] = {}
+        self.is_complete = False
+
+        if start_node is None:
+            start_node = next(
+                (n for n, data in graph.nodes(data=True) if data.get("start")), None
+            )
+
+        if start_node is not None:
+            start_time = time.perf_counter()
+            self.is_complete = self._add_sentences(graph, start_node)
+            _LOGGER.debug(
+                "Indexed %s exact sentence(s) in %s second(s) (complete=%s)",
+                len(self.sentences),
+                time.perf_counter() - start_time,
+                self.is_complete,
+            )
+
+            if not self.is_complete:
+                self.sentences.clear()
+
+    def _add_sentences(self, graph: typing.Any, start_node: int) -> bool:
+        """Enumerate all paths from start to final nodes (False if too many)."""
+        n_data = graph.nodes(data=True)
+        num_paths = 0
+
+        # words -> [(edge indexes, source nodes, token mask, has output, intent)]
+        paths_by_key: typing.Dict[
+            typing.Tuple[str, ...], typing.List[typing.Tuple[typing.Any, ...]]
+        ] = {}
+
+        # (node, edge indexes, words, source nodes, token mask, has output, intent)
+        node_stack: typing.List[typing.Tuple[typing.Any, ...]] = [
+            (start_node, (), (), (), 0, False, "")
+        ]
+
+        while node_stack:
+            (
+                node,
+                edge_indexes,
+                words,
+                nodes,
+                mask,
+                has_output,
+                intent,
+            ) = node_stack.pop()
+
+            if n_data[node].get("final", False) and words:
+                num_paths += 1
+                if num_paths > self.max_sentences:
+                    return False
+
+                paths_by_key.setdefault(words, []).append(
+                    (edge_indexes, nodes, mask, has_output, intent)
+                )
+
+            for edge_index, (next_node, edge_data) in enumerate(graph[node].items()):
+                ilabel = edge_data.get("ilabel") or ""
+                olabel = edge_data.get("olabel") or ""
+                next_words = words
+                next_mask = mask
+                next_has_output = has_output
+                next_intent = intent
+
+                if olabel[:9] == "__label__":
+                    next_intent = olabel[9:]
+                elif olabel and (olabel[:2] != "__"):
+                    next_has_output = True
+
+                if ilabel:
+                    next_words = words + (self.word_transform(ilabel),)
+                    next_mask = mask | (1 << len(nodes))
+
+                node_stack.append(
+                    (
+                        next_node,
+                        edge_indexes + (edge_index,),
+                        next_words,
+                        nodes + (node,),
+                        next_mask,
+                        next_has_output,
+                        next_intent,
+                    )
+                )
+
+        for words, paths in paths_by_key.items():
+            # Same order as breadth-first search
+            paths.sort(key=lambda path: (len(path[0]), path[0]))
+            self.sentences[words] = [
+                (intent, array("I", nodes), mask, has_output)
+                for _, nodes, mask, has_output, intent in paths
+            ]
+
+        return True
+
+    def __len__(self) -> int:
+        return len(self.sentences)
+
+    def lookup(
+        self,
+        tokens: typing.List[str],
+        intent_names: typing.Optional[typing.Iterable[str]] = None,
+    ) -> typing.List[ExactPath]:
+        """Paths whose words exactly match tokens (optionally only for intents)."""
+        paths = self.sentences.get(tuple(self.word_transform(t) for t in tokens), [])
+        if intent_names:
+            allowed_names = set(intent_names)
+            paths = [path for path in paths if path[0] in allowed_names]
+
+        return paths
+
+    def recognize(
+        self,
+        tokens: typing.Union[str, typing.List[str]],
+        graph: typing.Any,
+        intent_names: typing.Optional[typing.Iterable[str]] = None,
+        fuzzy: bool = True,
+        converters: typing.Optional[
+            typing.Dict[str, typing.Callable[..., typing.Any]]
+        ] = None,
+        extra_converters: typing.Optional[
+            typing.Dict[str, typing.Callable[..., typing.Any]]
+        ] = None,
+    ) -> typing.Optional[typing.List[Recognition]]:
+        """Recognitions for exactly matching input, or None if graph search is needed.
+
+        Input matching sentences from more than one intent is left to graph
+        search, which decides the order of results across intents.
+        """
+        start_time = time.perf_counter()
+
+        if isinstance(tokens, str):
+            # Assume whitespace separation
+            tokens = tokens.split()
+
+        paths = self.lookup(tokens, intent_names=intent_names)
+        if fuzzy:
+            # Fuzzy search ignores paths without output
+            paths = [path for path in paths if path[3]]
+
+        if (not paths) or any(path[0] != paths[0][0] for path in paths):
+            return None
+
+        recognitions: typing.List[Recognition] = []
+        for _, nodes, mask, _ in paths:
+            # Same path format as graph search: (source node, matching tokens)
+            node_path = []
+            token_index = 0
+            for edge_index, node in enumerate(nodes):
+                if mask & (1 << edge_index):
+                    node_path.append((node, [tokens[token_index]]))
+                    token_index += 1
+                else:
+                    node_path.append((node, []))
+
+            result, recognition = path_to_recognition(
+                node_path,
+                graph,
+                converters=converters,
+                extra_converters=extra_converters,
+            )
+
+            if result == RecognitionResult.SUCCESS:
+                assert recognition is not None
+                recognition.recognize_seconds = time.perf_counter() - start_time
+                recognitions.append(recognition)
+
+        return recognitions
@@ -0,0 +1,275 @@
+"""Intent graph loading for rhasspy-nlu-hermes"""
+import hashlib
+import logging
+import os
+import threading
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+import networkx as nx
+import rhasspynlu
+from rhasspynlu.jsgf_graph import get_start_end_nodes
+
+from .compiled import CompiledGraph, is_compiled_graph
+from .exact import ExactIndex
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+# -----------------------------------------------------------------------------
+
+
+def load_graph(
+    graph_path: typing.Union[str, Path]
+) -> typing.Union[nx.DiGraph, CompiledGraph]:
+    """Load intent graph from a file (gzipped pickle or compiled)."""
+    _LOGGER.debug("Loading %s", graph_path)
+    if is_compiled_graph(graph_path):
+        return CompiledGraph.load(graph_path)
+
+    with open(graph_path, mode="rb") as graph_file:
+        return rhasspynlu.gzip_pickle_to_graph(graph_file)
+
+
+def validate_graph(graph: typing.Any) -> typing.Union[nx.DiGraph, CompiledGraph]:
+    """Check that graph can be used for recognition. Returns graph."""
+    if not isinstance(graph, (nx.DiGraph, CompiledGraph)):
+        raise ValueError(f"Expected a directed graph, got {type(graph)}")
+
+    start_node, end_node = get_start_end_nodes(graph)
+    if start_node is None:
+        raise ValueError("Graph has no start node")
+
+    if end_node is None:
+        raise ValueError("Graph has no final node")
+
+    return graph
+
+
+def load_valid_graph(
+    graph_path: typing.Union[str, Path]
+) -> typing.Union[nx.DiGraph, CompiledGraph]:
+    """Load intent graph from a file and validate it."""
+    return validate_graph(load_graph(graph_path))
+
+
+# -----------------------------------------------------------------------------
+
+
+class GraphFingerprint(typing.NamedTuple):
+    """Identifies the contents of a graph file."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    digest: str
+
+
+def graph_fingerprint(
+    graph_path: typing.Union[str, Path],
+    previous: typing.Optional[GraphFingerprint] = None,
+) -> GraphFingerprint:
+    """Fingerprint a graph file.
+
+    The file is only read (and hashed) if its path, size, or modification
+    time differ from the previous fingerprint.
+    """
+    path_str = os.path.abspath(graph_path)
+    stat = os.stat(path_str)
+
+    if (
+        (previous is not None)
+        and (previous.path == path_str)
+        and (previous.size == stat.st_size)
+        and (previous.mtime_ns == stat.st_mtime_ns)
+    ):
+        return previous
+
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path_str, "rb") as graph_file:
+        header = graph_file.read(8)
+        if header[:2] == b"\x1f\x8b":
+            # Skip gzip modification time so rewritten identical graphs match
+            header = header[:4]
+
+        file_hash.update(header)
+        for chunk in iter(lambda: graph_file.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+
+    return GraphFingerprint(
+        path=path_str,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        digest=file_hash.hexdigest(),
+    )
+
+
+# -----------------------------------------------------------------------------
+
+
+class IntentIndex:
+    """Intent graph with start edges indexed by intent name.
+
+    Filtered views only contain the start edges of allowed intents, so the
+    search never enters other intents. Views are cached per filter set.
+
+    If max_exact_sentences > 0, sentences are also indexed for exact lookup
+    (see exact.ExactIndex).
+    """
+
+    def __init__(
+        self,
+        graph: typing.Any,
+        max_cached_filters: int = 128,
+        max_exact_sentences: int = 0,
+        word_transform: typing.Optional[typing.Callable[[str], str]] = None,
+    ):
+        self.graph = graph
+        self.max_cached_filters = max_cached_filters
+        self.start_node: typing.Optional[int] = next(
+            (node for node, data in graph.nodes(data=True) if data.get("start")), None
+        )
+
+        # intent name -> [(intent node, edge data)]
+        self.intent_edges: typing.Dict[
+            str, typing.List[typing.Tuple[int, typing.Dict[str, typing.Any]]]
+        ] = {}
+
+        if self.start_node is not None:
+            for next_node, edge_data in graph[self.start_node].items():
+                olabel = edge_data.get("olabel") or ""
+                if olabel[:9] == "__label__":
+                    self.intent_edges.setdefault(olabel[9:], []).append(
+                        (next_node, edge_data)
+                    )
+
+        # frozenset of intent names -> filtered view
+        self.filtered_graphs: "OrderedDict[typing.FrozenSet[str], FilteredGraph]" = (
+            OrderedDict()
+        )
+        self.filtered_lock = threading.Lock()
+
+        # intent name -> names of converters used in intent
+        self.converters_by_intent: typing.Dict[str, typing.Set[str]] = {}
+
+        self.exact_index: typing.Optional[ExactIndex] = None
+        if (max_exact_sentences > 0) and (self.start_node is not None):
+            self.exact_index = ExactIndex(
+                graph,
+                start_node=self.start_node,
+                word_transform=word_transform,
+                max_sentences=max_exact_sentences,
+            )
+
+    def intent_converters(self, intent_name: str) -> typing.Set[str]:
+        """Names of converters that may be used when recognizing an intent."""
+        converter_names = self.converters_by_intent.get(intent_name)
+        if converter_names is not None:
+            return converter_names
+
+        converter_names = set()
+        node_stack = [
+            next_node for next_node, _ in self.intent_edges.get(intent_name, [])
+        ]
+        visited_nodes: typing.Set[int] = set(node_stack)
+
+        # Walk intent's part of the graph
+        while node_stack:
+            node = node_stack.pop()
+            for next_node, edge_data in self.graph[node].items():
+                olabel = edge_data.get("olabel") or ""
+                if olabel[:11] == "__convert__":
+                    converter_names.add(olabel[11:].split(",", maxsplit=1)[0])
+
+                if next_node not in visited_nodes:
+                    visited_nodes.add(next_node)
+                    node_stack.append(next_node)
+
+        self.converters_by_intent[intent_name] = converter_names
+        return converter_names
+
+    @property
+    def is_indexed(self) -> bool:
+        """True if intents were found on start edges."""
+        return bool(self.intent_edges)
+
+    def filter(self, intent_names: typing.Optional[typing.Iterable[str]]) -> typing.Any:
+        """Get graph limited to intent names (whole graph if None).
+
+        Graphs without a start node can't be filtered and are returned whole.
+        """
+        if (not intent_names) or (self.start_node is None):
+            return self.graph
+
+        key = frozenset(intent_names)
+        with self.filtered_lock:
+            filtered_graph = self.filtered_graphs.get(key)
+            if filtered_graph is not None:
+                self.filtered_graphs.move_to_end(key)
+                return filtered_graph
+
+        # Keep original edge order for identical search order
+        allowed_nodes = {
+            next_node
+            for intent_name in key
+            for next_node, _ in self.intent_edges.get(intent_name, [])
+        }
+        start_edges = {
+            next_node: edge_data
+            for next_node, edge_data in self.graph[self.start_node].items()
+            if next_node in allowed_nodes
+        }
+        filtered_graph = FilteredGraph(self.graph, self.start_node, start_edges)
+
+        with self.filtered_lock:
+            self.filtered_graphs[key] = filtered_graph
+            while len(self.filtered_graphs) > self.max_cached_filters:
+                self.filtered_graphs.popitem(last=False)
+
+        return filtered_graph
+
+
+class FilteredGraph:
+    """View of an intent graph with replaced start node edges."""
+
+    def __init__(
+        self,
+        graph: typing.Any,
+        start_node: int,
+        start_edges: typing.Dict[int, typing.Dict[str, typing.Any]],
+    ):
+        self.graph = graph
+        self.start_node = start_node
+        self.start_edges = start_edges
+
+    def __len__(self) -> int:
+        return len(self.graph)
+
+    def __getitem__(self, node: int) -> typing.Any:
+        if node == self.start_node:
+            return self.start_edges
+
+        return self.graph[node]
+
+    def nodes(self, *args, **kwargs):
+        """Nodes of underlying graph."""
+        return self.graph.nodes(*args, **kwargs)
+
+
+class CountingGraph:
+    """View of an intent graph that counts node expansions during search."""
+
+    def __init__(self, graph: typing.Any):
+        self.graph = graph
+        self.nodes_explored = 0
+
+    def __len__(self) -> int:
+        return len(self.graph)
+
+    def __getitem__(self, node: int) -> typing.Any:
+        self.nodes_explored += 1
+        return self.graph[node]
+
+    def nodes(self, *args, **kwargs):
+        """Nodes of underlying graph."""
+        return self.graph.nodes(*args, **kwargs)
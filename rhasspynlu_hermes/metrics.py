@@ -0,0 +1,354 @@
+"""Prometheus-style metrics for rhasspy-nlu-hermes"""
+import logging
+import os
+import threading
+import time
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+LabelsType = typing.Tuple[typing.Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Converter seconds recorded in a process worker, sent back with its results
+_WORKER_CONVERTER_SECONDS: typing.List[float] = []
+
+# -----------------------------------------------------------------------------
+
+
+def _labels_key(labels: typing.Dict[str, typing.Any]) -> LabelsType:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: LabelsType) -> str:
+    if not labels:
+        return ""
+
+    label_strs = [
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in labels
+    ]
+
+    return "{" + ",".join(label_strs) + "}"
+
+
+class Metric:
+    """Base class for metrics with labels."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+
+    def samples(self) -> typing.Iterable[typing.Tuple[str, LabelsType, float]]:
+        """(name, labels, value) for each sample."""
+        return []
+
+    def render(self) -> str:
+        """Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """JSON-friendly dict of samples."""
+        return {
+            "type": self.metric_type,
+            "samples": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for name, labels, value in self.samples()
+            ],
+        }
+
+
+class Counter(Metric):
+    """Value that only increases, or is read from a function that only increases."""
+
+    metric_type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        function: typing.Optional[typing.Callable[[], float]] = None,
+    ):
+        super().__init__(name, description)
+        self.values: typing.Dict[LabelsType, float] = {}
+        self.function = function
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase counter."""
+        key = _labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Value that can go up and down, or is read from a function."""
+
+    metric_type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        function: typing.Optional[typing.Callable[[], float]] = None,
+    ):
+        super().__init__(name, description)
+        self.values: typing.Dict[LabelsType, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        """Set gauge value."""
+        with self.lock:
+            self.values[_labels_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase gauge value."""
+        key = _labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """Decrease gauge value."""
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description)
+        self.buckets = sorted(buckets)
+
+        # labels -> (bucket counts, sum, count)
+        self.values: typing.Dict[LabelsType, typing.List[typing.Any]] = {}
+
+    def observe(self, value: float, **labels):
+        """Add an observed value."""
+        key = _labels_key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self.values[key] = entry
+
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    entry[0][i] += 1
+
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels) -> "_Timer":
+        """Context manager that observes elapsed seconds."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (bucket_counts, value_sum, value_count) in self.values.items():
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    samples.append(
+                        (
+                            f"{self.name}_bucket",
+                            key + (("le", str(upper_bound)),),
+                            bucket_count,
+                        )
+                    )
+
+                samples.append(
+                    (f"{self.name}_bucket", key + (("le", "+Inf"),), value_count)
+                )
+                samples.append((f"{self.name}_sum", key, value_sum))
+                samples.append((f"{self.name}_count", key, value_count))
+
+        return samples
+
+
+class _Timer:
+    """Times a block of code for a histogram."""
+
+    def __init__(self, histogram: Histogram, labels: typing.Dict[str, typing.Any]):
+        self.histogram = histogram
+        self.labels = labels
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start_time, **self.labels)
+
+
+# -----------------------------------------------------------------------------
+
+
+class NluMetrics:
+    """All metrics collected by the NLU service."""
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "nlu_stage_seconds",
+            "Seconds spent in each processing stage "
+            "(queue, graph_load, graph_wait, normalize, recognize, converter, "
+            "slots, publish)",
+        )
+        self.results = Counter(
+            "nlu_results_total", "Query results by type, intent and site id"
+        )
+        self.queries_in_flight = Gauge(
+            "nlu_queries_in_flight", "Queries currently being processed"
+        )
+        self.queries_queued = Gauge(
+            "nlu_queries_queued", "Queries waiting for a recognition worker"
+        )
+        self.queries_dropped = Counter(
+            "nlu_queries_dropped_total",
+            "Queries dropped because the queue was full or they waited too long",
+        )
+        self.graph_nodes = Gauge("nlu_graph_nodes", "Nodes in intent graph")
+        self.graph_edges = Gauge("nlu_graph_edges", "Edges in intent graph")
+        self.cache_hits = Counter(
+            "nlu_recognition_cache_hits_total", "Recognition cache hits"
+        )
+        self.cache_misses = Counter(
+            "nlu_recognition_cache_misses_total", "Recognition cache misses"
+        )
+        self.graphs_loaded = Gauge(
+            "nlu_graphs_loaded", "Site id/language intent graphs currently loaded"
+        )
+        self.graph_reloads = Counter(
+            "nlu_graph_reloads_total", "Site id/language intent graphs loaded again"
+        )
+        self.graph_evictions = Counter(
+            "nlu_graph_evictions_total",
+            "Site id/language intent graphs evicted from memory",
+        )
+
+    @property
+    def all_metrics(self) -> typing.List[Metric]:
+        """All metrics in a stable order."""
+        return [
+            self.stage_seconds,
+            self.results,
+            self.queries_in_flight,
+            self.queries_queued,
+            self.queries_dropped,
+            self.graph_nodes,
+            self.graph_edges,
+            self.cache_hits,
+            self.cache_misses,
+            self.graphs_loaded,
+            self.graph_reloads,
+            self.graph_evictions,
+        ]
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format."""
+        return "\n".join(metric.render() for metric in self.all_metrics) + "\n"
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """All metrics as a JSON-friendly dict."""
+        return {metric.name: metric.to_dict() for metric in self.all_metrics}
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve metrics over HTTP in a background thread."""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """Responds with metrics text for any path."""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Handle GET request"""
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Don't log each request"""
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        _LOGGER.debug("Serving metrics at http://%s:%s", host, port)
+
+        return server
+
+
+class TimedConverter:
+    """Records time spent in a converter.
+
+    Time spent in a process worker is kept until the worker sends it back
+    with its results (see take_worker_converter_seconds).
+    """
+
+    def __init__(
+        self, converter: typing.Callable[..., typing.Any], metrics: NluMetrics
+    ):
+        self.converter = converter
+        self.metrics = metrics
+        self.name = getattr(converter, "name", "")
+
+        # Process with the metrics
+        self.pid = os.getpid()
+
+    def __call__(self, *args, **kwargs):
+        if self.pid == os.getpid():
+            with self.metrics.stage_seconds.time(stage="converter"):
+                return self.converter(*args, **kwargs)
+
+        start_time = time.perf_counter()
+        try:
+            return self.converter(*args, **kwargs)
+        finally:
+            _WORKER_CONVERTER_SECONDS.append(time.perf_counter() - start_time)
+
+    def close(self):
+        """Close wrapped converter"""
+        close = getattr(self.converter, "close", None)
+        if close is not None:
+            close()
+
+
+def take_worker_converter_seconds() -> typing.List[float]:
+    """Remove and return converter seconds recorded in this process worker."""
+    converter_seconds = list(_WORKER_CONVERTER_SECONDS)
+    _WORKER_CONVERTER_SECONDS.clear()
+
+    return converter_seconds
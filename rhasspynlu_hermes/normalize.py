@@ -0,0 +1,151 @@
+"""Query input normalization (tokenize once, replace numbers, find failure token)"""
+import typing
+from dataclasses import dataclass
+
+from .numbers import NumberTable
+
+# -----------------------------------------------------------------------------
+
+
+@dataclass
+class NormalizedInput:
+    """Tokens of a query input, ready for recognition."""
+
+    raw_tokens: typing.List[str]
+    """Tokens of the original input."""
+
+    tokens: typing.List[str]
+    """Tokens after number replacement (searched in the intent graph)."""
+
+    raw_indexes: typing.List[int]
+    """Index in raw_tokens of the token that produced each token."""
+
+    has_failure_token: bool = False
+    """True if the failure token is in tokens."""
+
+    @property
+    def text(self) -> str:
+        """Normalized input text (whitespace separated tokens)."""
+        return " ".join(self.tokens)
+
+    def raw_span(
+        self, start_index: int, end_index: int, raw_text: typing.Optional[str] = None
+    ) -> typing.Tuple[int, int]:
+        """Character offsets in the original input of tokens[start:end].
+
+        If raw_text (the original input) is not given, assumes original tokens
+        were separated by a single space.
+        """
+        raw_start = self.raw_indexes[start_index]
+        raw_end = self.raw_indexes[end_index - 1] + 1
+
+        if raw_text is None:
+            start = sum(len(t) + 1 for t in self.raw_tokens[:raw_start])
+            end = start + len(" ".join(self.raw_tokens[raw_start:raw_end]))
+
+            return (start, end)
+
+        # Find each original token in the original input
+        token_starts: typing.List[int] = []
+        offset = 0
+        for raw_token in self.raw_tokens[:raw_end]:
+            offset = raw_text.index(raw_token, offset)
+            token_starts.append(offset)
+            offset += len(raw_token)
+
+        return (token_starts[raw_start], offset)
+
+    def matched_span(
+        self,
+        matched_tokens: typing.List[str],
+        start: int,
+        end: int,
+        raw_text: typing.Optional[str] = None,
+    ) -> typing.Optional[typing.Tuple[int, int]]:
+        """Character offsets in the original input of a range of matched tokens.
+
+        matched_tokens are the tokens consumed by a recognition, in order
+        (Recognition.raw_tokens). Tokens skipped by fuzzy recognition are not
+        in them. start and end are character offsets in the matched tokens
+        separated by spaces (e.g., Entity.raw_start and raw_end).
+
+        Returns None if the range can't be found in tokens.
+        """
+        # Index in tokens of each matched token
+        indexes: typing.List[int] = []
+        token_index = 0
+        for matched_token in matched_tokens:
+            while (token_index < len(self.tokens)) and (
+                self.tokens[token_index] != matched_token
+            ):
+                token_index += 1
+
+            if token_index >= len(self.tokens):
+                return None
+
+            indexes.append(token_index)
+            token_index += 1
+
+        # Matched tokens that overlap start:end
+        first_index: typing.Optional[int] = None
+        last_index: typing.Optional[int] = None
+        offset = 0
+        for matched_index, matched_token in enumerate(matched_tokens):
+            token_end = offset + len(matched_token)
+            if (first_index is None) and (start < token_end):
+                first_index = matched_index
+
+            if end > offset:
+                last_index = matched_index
+
+            offset = token_end + 1
+
+        if (first_index is None) or (last_index is None) or (last_index < first_index):
+            return None
+
+        try:
+            return self.raw_span(
+                indexes[first_index], indexes[last_index] + 1, raw_text=raw_text
+            )
+        except ValueError:
+            # Original token not in raw text
+            return None
+
+
+def query_tokens(query: typing.Any) -> typing.List[str]:
+    """Tokens of query input.
+
+    NluQuery has no ASR tokens, so whitespace tokenization is assumed.
+    """
+    return query.input.split()
+
+
+def normalize_tokens(
+    raw_tokens: typing.List[str],
+    number_table: typing.Optional[NumberTable] = None,
+    failure_token: typing.Optional[str] = None,
+) -> NormalizedInput:
+    """Replace numbers and look for failure token in a single pass over tokens."""
+    tokens: typing.List[str] = []
+    raw_indexes: typing.List[int] = []
+    has_failure_token = False
+
+    for raw_index, raw_token in enumerate(raw_tokens):
+        number_words = (
+            number_table.number_words(raw_token) if number_table is not None else None
+        )
+
+        if number_words is None:
+            number_words = [raw_token]
+
+        for word in number_words:
+            tokens.append(word)
+            raw_indexes.append(raw_index)
+            has_failure_token = has_failure_token or (word == failure_token)
+
+    return NormalizedInput(
+        raw_tokens=raw_tokens,
+        tokens=tokens,
+        raw_indexes=raw_indexes,
+        has_failure_token=has_failure_token,
+    )
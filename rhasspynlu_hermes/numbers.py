@@ -0,0 +1,112 @@
+"""Precomputed number to words replacement"""
+import logging
+import time
+import typing
+
+from rhasspynlu.numbers import NUMBER_PATTERN, number_to_words
+
+from .compiled import CompiledGraph
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+# -----------------------------------------------------------------------------
+
+
+def graph_number_range(graph: typing.Any) -> typing.Optional[typing.Tuple[int, int]]:
+    """Smallest and largest number in graph labels (None if no numbers)."""
+    if isinstance(graph, CompiledGraph):
+        # Every label is in the string table
+        labels: typing.Iterable[str] = graph.strings
+    else:
+        labels = (
+            label
+            for _, _, edge_data in graph.edges(data=True)
+            for label in (edge_data.get("ilabel"), edge_data.get("olabel"))
+            if label
+        )
+
+    numbers = [int(label) for label in labels if NUMBER_PATTERN.match(label)]
+    if not numbers:
+        return None
+
+    return (min(numbers), max(numbers))
+
+
+class NumberTable:
+    """Words for numbers in a language, computed ahead of time.
+
+    Numbers outside of the table are converted on each use.
+    """
+
+    def __init__(self, language: typing.Optional[str] = None, max_size: int = 10000):
+        self.language = language or "en"
+        self.max_size = max_size
+
+        # number text -> words
+        self.words: typing.Dict[str, typing.List[str]] = {}
+
+    def add_range(self, min_number: int, max_number: int):
+        """Add words for numbers from min to max (inclusive), up to max_size."""
+        start_time = time.perf_counter()
+        num_added = 0
+
+        for number in range(min_number, max_number + 1):
+            if len(self.words) >= self.max_size:
+                _LOGGER.warning(
+                    "Number table is full (max size=%s, range=%s..%s)",
+                    self.max_size,
+                    min_number,
+                    max_number,
+                )
+                break
+
+            number_text = str(number)
+            if number_text not in self.words:
+                self.words[number_text] = number_to_words(
+                    number, language=self.language
+                )
+                num_added += 1
+
+        _LOGGER.debug(
+            "Added %s number(s) in %s second(s)",
+            num_added,
+            time.perf_counter() - start_time,
+        )
+
+    def add_graph(self, graph: typing.Any):
+        """Add words for the range of numbers used in an intent graph."""
+        number_range = graph_number_range(graph)
+        if number_range is not None:
+            self.add_range(*number_range)
+
+    def with_graph(self, graph: typing.Any) -> "NumberTable":
+        """Copy of this table with words added for an intent graph.
+
+        This table is left unchanged, so the copy can be built off the event
+        loop and swapped in when ready.
+        """
+        table = NumberTable(self.language, max_size=self.max_size)
+        table.words = dict(self.words)
+        table.add_graph(graph)
+
+        return table
+
+    def number_words(self, token: str) -> typing.Optional[typing.List[str]]:
+        """Words for a number token (None if token is not a number)."""
+        number_words = self.words.get(token)
+        if (number_words is None) and NUMBER_PATTERN.match(token):
+            number_words = number_to_words(int(token), language=self.language)
+
+        return number_words
+
+    def replace(self, tokens: typing.Iterable[str]) -> typing.List[str]:
+        """Replace numbers with words (75 hats -> seventy five hats)."""
+        words: typing.List[str] = []
+        for token in tokens:
+            number_words = self.number_words(token)
+            if number_words is None:
+                words.append(token)
+            else:
+                words.extend(number_words)
+
+        return words
@@ -0,0 +1,147 @@
+"""Fast JSON payloads for intent messages.
+
+NluIntentParsed and NluIntent for the same query share their intent and
+slots. Those can be encoded once (see shared_fields) and spliced into both
+payloads instead of going through dataclass conversion for each message.
+orjson is used when installed.
+"""
+import json
+import types
+import typing
+
+from rhasspyhermes.base import Message
+from rhasspyhermes.intent import Intent, Slot
+from rhasspyhermes.nlu import AsrToken, NluIntent, NluIntentParsed
+
+orjson: typing.Optional[types.ModuleType]
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PayloadType = typing.Union[str, bytes]
+
+# -----------------------------------------------------------------------------
+
+
+def dumps(obj: typing.Any) -> PayloadType:
+    """Encode JSON (bytes if orjson is installed)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def intent_to_dict(intent: Intent) -> typing.Dict[str, typing.Any]:
+    """JSON dict for an intent (same as intent.to_dict())."""
+    return {
+        "intentName": intent.intent_name,
+        "confidenceScore": intent.confidence_score,
+    }
+
+
+def slot_to_dict(slot: Slot) -> typing.Dict[str, typing.Any]:
+    """JSON dict for a slot (same as slot.to_dict())."""
+    slot_range = slot.range
+    return {
+        "entity": slot.entity,
+        "value": slot.value,
+        "slotName": slot.slot_name,
+        "rawValue": slot.raw_value,
+        "confidence": slot.confidence,
+        "range": (
+            {
+                "start": slot_range.start,
+                "end": slot_range.end,
+                "rawStart": slot_range.raw_start,
+                "rawEnd": slot_range.raw_end,
+            }
+            if slot_range is not None
+            else None
+        ),
+    }
+
+
+def asr_token_to_dict(token: AsrToken) -> typing.Dict[str, typing.Any]:
+    """JSON dict for an ASR token (same as token.to_dict())."""
+    token_time = token.time
+    return {
+        "value": token.value,
+        "confidence": token.confidence,
+        "rangeStart": token.range_start,
+        "rangeEnd": token.range_end,
+        "time": (
+            {"start": token_time.start, "end": token_time.end}
+            if token_time is not None
+            else None
+        ),
+    }
+
+
+def shared_fields(
+    intent: Intent, slots: typing.Optional[typing.List[Slot]]
+) -> PayloadType:
+    """Encoded intent and slots fields for intent messages.
+
+    Raises TypeError if a value can't be encoded.
+    """
+    return dumps(
+        {
+            "intent": intent_to_dict(intent),
+            "slots": [slot_to_dict(slot) for slot in (slots or [])],
+        }
+    )[1:-1]
+
+
+def message_payload(
+    message: Message, shared: typing.Optional[PayloadType] = None
+) -> PayloadType:
+    """Payload for a message, using the fast path for intent messages.
+
+    shared is the message's encoded intent and slots (see shared_fields),
+    which is computed here if not given.
+    """
+    if not isinstance(message, (NluIntentParsed, NluIntent)):
+        return message.payload()
+
+    fields: typing.Dict[str, typing.Any] = {
+        "input": message.input,
+        "siteId": message.site_id,
+        "id": message.id,
+        "sessionId": message.session_id,
+    }
+
+    if isinstance(message, NluIntent):
+        fields.update(
+            {
+                "customData": message.custom_data,
+                "asrTokens": (
+                    [
+                        [asr_token_to_dict(token) for token in tokens]
+                        for tokens in message.asr_tokens
+                    ]
+                    if message.asr_tokens is not None
+                    else None
+                ),
+                "asrConfidence": message.asr_confidence,
+                "rawInput": message.raw_input,
+                "wakewordId": message.wakeword_id,
+                "lang": message.lang,
+            }
+        )
+
+    try:
+        if shared is None:
+            shared = shared_fields(message.intent, message.slots)
+
+        head = dumps(fields)[:-1]
+    except TypeError:
+        # Value that only dataclass conversion can encode
+        return message.payload()
+
+    if isinstance(head, bytes):
+        assert isinstance(shared, bytes)
+        return head + b"," + shared + b"}"
+
+    assert isinstance(shared, str)
+    return head + "," + shared + "}"
@@ -0,0 +1,139 @@
+"""Intent graphs per site id or language"""
+import logging
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+from .compiled import CompiledGraph
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+# Approximate memory used by each node and edge of a networkx intent graph
+GRAPH_ITEM_BYTES = 500
+
+# -----------------------------------------------------------------------------
+
+
+def graph_size(graph: typing.Any) -> int:
+    """Approximate bytes of memory used by an intent graph."""
+    if isinstance(graph, CompiledGraph):
+        # Memory-mapped file
+        return len(graph.buffer)
+
+    return (len(graph) + graph.number_of_edges()) * GRAPH_ITEM_BYTES
+
+
+class GraphProfiles:
+    """Maps site ids and languages to intent graph files.
+
+    Keys of loaded graphs are kept in least recently used order. When the
+    total size of loaded graphs goes over max_bytes (0 for no limit), the
+    least recently used graphs are evicted and will be reloaded on next use.
+    """
+
+    def __init__(
+        self,
+        site_graphs: typing.Optional[typing.Dict[str, Path]] = None,
+        lang_graphs: typing.Optional[typing.Dict[str, Path]] = None,
+        max_bytes: int = 0,
+    ):
+        self.max_bytes = max_bytes
+
+        # key -> graph path
+        self.graph_paths: typing.Dict[str, Path] = {}
+        for site_id, graph_path in (site_graphs or {}).items():
+            self.graph_paths[GraphProfiles.site_key(site_id)] = Path(graph_path)
+
+        for lang, graph_path in (lang_graphs or {}).items():
+            self.graph_paths[GraphProfiles.lang_key(lang)] = Path(graph_path)
+
+        # key -> approximate size of loaded graph (least recently used first)
+        self.loaded: "OrderedDict[str, int]" = OrderedDict()
+
+        # Keys that have been loaded before
+        self.seen: typing.Set[str] = set()
+
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def site_key(site_id: str) -> str:
+        """Graph key for a site id."""
+        return f"site:{site_id}"
+
+    @staticmethod
+    def lang_key(lang: str) -> str:
+        """Graph key for a language."""
+        return f"lang:{lang}"
+
+    def __bool__(self) -> bool:
+        return bool(self.graph_paths)
+
+    @property
+    def loaded_bytes(self) -> int:
+        """Approximate size of all loaded graphs."""
+        return sum(self.loaded.values())
+
+    def query_key(
+        self, site_id: typing.Optional[str], lang: typing.Optional[str]
+    ) -> typing.Optional[str]:
+        """Key of graph for a query (site id first, then language).
+
+        Returns None if the default graph should be used.
+        """
+        if site_id:
+            key = GraphProfiles.site_key(site_id)
+            if key in self.graph_paths:
+                return key
+
+        if lang:
+            key = GraphProfiles.lang_key(lang)
+            if key in self.graph_paths:
+                return key
+
+        return None
+
+    def train_key(self, site_id: str) -> typing.Optional[str]:
+        """Key of graph retrained for a site id (None for default graph).
+
+        A site id with its own graph retrains that graph. Otherwise, a site id
+        that names a language with its own graph retrains the language graph.
+        """
+        return self.query_key(site_id, site_id)
+
+    def is_loaded(self, key: str) -> bool:
+        """True if graph for key is loaded (marks it as recently used)."""
+        if key not in self.loaded:
+            return False
+
+        self.loaded.move_to_end(key)
+        return True
+
+    def add(self, key: str, size: int) -> typing.List[str]:
+        """Record a loaded graph. Returns keys of graphs to evict."""
+        self.loaded.pop(key, None)
+        self.loaded[key] = size
+
+        self.loads += 1
+        if key in self.seen:
+            self.reloads += 1
+
+        self.seen.add(key)
+
+        evicted_keys: typing.List[str] = []
+        if self.max_bytes > 0:
+            while (self.loaded_bytes > self.max_bytes) and (len(self.loaded) > 1):
+                evicted_key, _ = self.loaded.popitem(last=False)
+                evicted_keys.append(evicted_key)
+                self.evictions += 1
+
+        if evicted_keys:
+            _LOGGER.debug(
+                "Evicted graph(s) %s (loaded=%s byte(s), max=%s)",
+                evicted_keys,
+                self.loaded_bytes,
+                self.max_bytes,
+            )
+
+        return evicted_keys
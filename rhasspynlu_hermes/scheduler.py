@@ -0,0 +1,186 @@
+"""Fair scheduling of queries waiting for recognition"""
+import asyncio
+import logging
+import time
+import typing
+from collections import OrderedDict, deque
+
+from .workers import QueueFullError
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+# -----------------------------------------------------------------------------
+
+
+class _Waiter:
+    """Query waiting to be admitted."""
+
+    def __init__(self, future: asyncio.Future, site_id: str, priority: bool):
+        self.future = future
+        self.site_id = site_id
+        self.priority = priority
+        self.enqueue_time = time.monotonic()
+        self.expire_handle: typing.Optional[asyncio.TimerHandle] = None
+
+
+class QueryScheduler:
+    """Admits up to max_active queries at a time, round-robin by site id.
+
+    Priority queries (e.g., session continuations with an intent filter) are
+    admitted before all others. Queries that wait longer than max_age seconds
+    are dropped (acquire returns False). If max_queued queries are already
+    waiting, new queries are dropped right away (acquire raises
+    QueueFullError).
+    """
+
+    def __init__(
+        self,
+        max_active: int = 1,
+        max_age: typing.Optional[float] = None,
+        max_queued: int = 0,
+    ):
+        self.max_active = max(1, max_active)
+        self.max_age = max_age
+        self.max_queued = max_queued
+
+        self.active = 0
+
+        # priority -> site id -> waiters (sites in round-robin order)
+        self.queues: typing.Dict[bool, "OrderedDict[str, typing.Deque[_Waiter]]"] = {
+            True: OrderedDict(),
+            False: OrderedDict(),
+        }
+
+        self.admitted = 0
+        self.dropped = 0
+
+    @property
+    def waiting(self) -> int:
+        """Number of queries waiting to be admitted."""
+        return sum(
+            len(waiters)
+            for site_queues in self.queues.values()
+            for waiters in site_queues.values()
+        )
+
+    async def acquire(self, site_id: str, priority: bool = False) -> bool:
+        """Wait until query is admitted (True) or dropped for being too old (False).
+
+        Raises QueueFullError if max_queued queries are already waiting.
+        Call release after an admitted query is finished.
+        """
+        waiting = self.waiting
+        if (self.active < self.max_active) and (waiting == 0):
+            self.active += 1
+            self.admitted += 1
+            return True
+
+        if self.max_queued and (waiting >= self.max_queued):
+            self.dropped += 1
+            raise QueueFullError(
+                f"Too many queued queries (max={self.max_queued}, waiting={waiting})"
+            )
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), site_id, priority)
+        self.queues[priority].setdefault(site_id, deque()).append(waiter)
+
+        if self.max_age is not None:
+            waiter.expire_handle = loop.call_later(self.max_age, self._expire, waiter)
+
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and (not waiter.future.cancelled()):
+                if waiter.future.result():
+                    # Admitted, but won't run
+                    self.release()
+            else:
+                self._remove(waiter)
+
+            raise
+
+    def release(self):
+        """Finish an admitted query and admit the next one."""
+        self.active -= 1
+        self._admit_next()
+
+    def _admit_next(self):
+        """Admit waiting queries while there's room."""
+        while self.active < self.max_active:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+
+            if waiter.expire_handle is not None:
+                waiter.expire_handle.cancel()
+
+            if (self.max_age is not None) and (
+                (time.monotonic() - waiter.enqueue_time) >= self.max_age
+            ):
+                self._drop(waiter)
+                continue
+
+            self.active += 1
+            self.admitted += 1
+            waiter.future.set_result(True)
+
+    def _next_waiter(self) -> typing.Optional[_Waiter]:
+        """Remove and return next waiter (priority first, round-robin by site)."""
+        for priority in (True, False):
+            site_queues = self.queues[priority]
+            while site_queues:
+                site_id, waiters = next(iter(site_queues.items()))
+                if not waiters:
+                    del site_queues[site_id]
+                    continue
+
+                waiter = waiters.popleft()
+
+                # Site goes to the back of the line
+                if waiters:
+                    site_queues.move_to_end(site_id)
+                else:
+                    del site_queues[site_id]
+
+                return waiter
+
+        return None
+
+    def _remove(self, waiter: _Waiter):
+        """Remove a waiter from its queue."""
+        if waiter.expire_handle is not None:
+            waiter.expire_handle.cancel()
+
+        site_queues = self.queues[waiter.priority]
+        waiters = site_queues.get(waiter.site_id)
+        if waiters is None:
+            return
+
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+
+        if not waiters:
+            del site_queues[waiter.site_id]
+
+    def _expire(self, waiter: _Waiter):
+        """Drop a waiter that is still queued after max_age."""
+        if waiter.future.done():
+            return
+
+        self._remove(waiter)
+        self._drop(waiter)
+
+    def _drop(self, waiter: _Waiter):
+        """Tell waiter its query is dropped."""
+        self.dropped += 1
+        _LOGGER.debug(
+            "Dropped query from %s after %s second(s) in queue",
+            waiter.site_id,
+            time.monotonic() - waiter.enqueue_time,
+        )
+
+        if not waiter.future.done():
+            waiter.future.set_result(False)
@@ -0,0 +1,310 @@
+"""Best-first intent graph search with early exit.
+
+rhasspynlu.recognize does a breadth-first search over the whole graph and
+converts every lowest-cost path before the first result is used. The
+search here expands states in order of fuzzy cost instead, so results come
+out best first and the search stops as soon as enough results are found.
+"""
+import heapq
+import itertools
+import time
+import typing
+
+from rhasspynlu.fsticuffs import (
+    FuzzyCostInput,
+    FuzzyCostOutput,
+    PathType,
+    default_fuzzy_cost,
+    path_to_recognition,
+    paths_strict,
+)
+from rhasspynlu.intent import Recognition, RecognitionResult
+
+# -----------------------------------------------------------------------------
+
+
+def paths_best_first(
+    tokens: typing.List[str],
+    graph: typing.Any,
+    start_node: typing.Optional[int] = None,
+    stop_words: typing.Optional[typing.Set[str]] = None,
+    cost_function: typing.Optional[
+        typing.Callable[[FuzzyCostInput], FuzzyCostOutput]
+    ] = None,
+    intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+    word_transform: typing.Optional[typing.Callable[[str], str]] = None,
+    yield_unproven: bool = False,
+) -> typing.Iterator[typing.Tuple[float, str, PathType, bool]]:
+    """Yield (cost, intent name, path, proven) for fuzzy matches, lowest cost first.
+
+    Costs are the same as rhasspynlu.fsticuffs.paths_fuzzy. Only the first
+    (lowest cost) path of each intent is yielded with proven=True. Paths with
+    the same cost come out in the order paths_fuzzy finds them (shorter
+    paths first, then breadth-first order), so the first path of an intent
+    is the same one rhasspynlu.recognize picks.
+
+    If yield_unproven is True, paths are also yielded with proven=False as
+    soon as they reach a final state (before cheaper states are expanded).
+    """
+    if not tokens:
+        return
+
+    intent_filter = intent_filter or (lambda x: True)
+    cost_function = cost_function or default_fuzzy_cost
+    stop_words = stop_words or set()
+
+    # node -> attrs
+    n_data = graph.nodes(data=True)
+
+    if start_node is None:
+        start_node = next((n for n, data in n_data if data.get("start")), None)
+        if start_node is None:
+            # Empty graph
+            return
+
+    intents_found: typing.Set[str] = set()
+    counter = itertools.count()
+
+    # (cost, path length, order, is_state, count, node, in_tokens, out_path,
+    #  out_count, intent)
+    # Finished paths are pushed back with is_state=False and yielded when
+    # popped, so no cheaper state is left unexpanded. Costs and path lengths
+    # never go down, so a finished path can't be beaten by a state popped
+    # after it. order is the tuple of edge indexes along the path: among
+    # paths with the same length, this is the order paths_fuzzy's
+    # breadth-first queue visits them in.
+    heap: typing.List[typing.Tuple[typing.Any, ...]] = [
+        (0.0, 0, (), True, next(counter), start_node, tokens, [], 0, "")
+    ]
+
+    while heap:
+        (
+            q_cost,
+            q_length,
+            q_order,
+            is_state,
+            _,
+            q_node,
+            q_in_tokens,
+            q_out_path,
+            q_out_count,
+            q_intent,
+        ) = heapq.heappop(heap)
+
+        if not is_state:
+            if q_intent not in intents_found:
+                intents_found.add(q_intent)
+                yield q_cost, q_intent, q_out_path, True
+
+            continue
+
+        # Don't bother reporting intents that failed to consume any tokens.
+        if (
+            n_data[q_node].get("final", False)
+            and (q_cost < q_out_count)
+            and (q_intent not in intents_found)
+        ):
+            # Remaining tokens count against
+            final_cost = q_cost + len(q_in_tokens)
+            if yield_unproven:
+                yield final_cost, q_intent, q_out_path, False
+
+            heapq.heappush(
+                heap,
+                (
+                    final_cost,
+                    q_length,
+                    q_order,
+                    False,
+                    next(counter),
+                    q_node,
+                    [],
+                    q_out_path,
+                    q_out_count,
+                    q_intent,
+                ),
+            )
+
+        # Process child edges
+        for edge_index, (next_node, edge_data) in enumerate(graph[q_node].items()):
+            in_label = edge_data.get("ilabel") or ""
+            out_label = edge_data.get("olabel") or ""
+            next_out_count = q_out_count
+            next_intent = q_intent
+
+            if out_label:
+                if out_label[:9] == "__label__":
+                    next_intent = out_label[9:]
+                    if (not intent_filter(next_intent)) or (
+                        next_intent in intents_found
+                    ):
+                        # Skip intent
+                        continue
+                elif out_label[:2] != "__":
+                    next_out_count += 1
+
+            next_in_tokens = list(q_in_tokens)
+            cost_output = cost_function(
+                FuzzyCostInput(
+                    ilabel=in_label,
+                    tokens=next_in_tokens,
+                    stop_words=stop_words,
+                    word_transform=word_transform,
+                )
+            )
+
+            if not cost_output.continue_search:
+                continue
+
+            heapq.heappush(
+                heap,
+                (
+                    q_cost + cost_output.cost,
+                    q_length + 1,
+                    q_order + (edge_index,),
+                    True,
+                    next(counter),
+                    next_node,
+                    next_in_tokens,
+                    q_out_path + [(q_node, cost_output.matching_tokens)],
+                    next_out_count,
+                    next_intent,
+                ),
+            )
+
+
+def recognize_best(
+    tokens: typing.Union[str, typing.List[str]],
+    graph: typing.Any,
+    n_best: int = 1,
+    confidence_threshold: typing.Optional[float] = None,
+    fuzzy: bool = True,
+    start_node: typing.Optional[int] = None,
+    stop_words: typing.Optional[typing.Set[str]] = None,
+    intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+    word_transform: typing.Optional[typing.Callable[[str], str]] = None,
+    converters: typing.Optional[
+        typing.Dict[str, typing.Callable[..., typing.Any]]
+    ] = None,
+    extra_converters: typing.Optional[
+        typing.Dict[str, typing.Callable[..., typing.Any]]
+    ] = None,
+) -> typing.List[Recognition]:
+    """Recognize up to n_best intents (one result per intent), best first.
+
+    If confidence_threshold is set, the search stops at the first recognition
+    with at least that confidence. Otherwise, it stops after n_best results.
+    """
+    start_time = time.perf_counter()
+
+    if isinstance(tokens, str):
+        # Assume whitespace separation
+        tokens = tokens.split()
+
+    if fuzzy:
+        paths: typing.Iterable[typing.Tuple[typing.Optional[float], PathType, bool]] = (
+            (cost, path, proven)
+            for cost, _, path, proven in paths_best_first(
+                tokens,
+                graph,
+                start_node=start_node,
+                stop_words=stop_words,
+                intent_filter=intent_filter,
+                word_transform=word_transform,
+                yield_unproven=(confidence_threshold is not None),
+            )
+        )
+    else:
+        paths = _paths_strict_lazy(
+            tokens,
+            graph,
+            stop_words=stop_words,
+            intent_filter=intent_filter,
+            word_transform=word_transform,
+        )
+
+    recognitions: typing.List[Recognition] = []
+    intents_found: typing.Set[str] = set()
+
+    # id(path) -> (path, recognition) for unproven paths
+    candidates: typing.Dict[int, typing.Tuple[PathType, typing.Any]] = {}
+
+    for cost, path, proven in paths:
+        if id(path) in candidates:
+            # Already converted
+            recognition = candidates.pop(id(path))[1]
+        else:
+            result, recognition = path_to_recognition(
+                path,
+                graph,
+                cost=cost,
+                converters=converters,
+                extra_converters=extra_converters,
+            )
+
+            if result != RecognitionResult.SUCCESS:
+                recognition = None
+
+        if recognition is None:
+            if not proven:
+                # Don't convert again
+                candidates[id(path)] = (path, None)
+
+            continue
+
+        recognition.recognize_seconds = time.perf_counter() - start_time
+        is_confident = (
+            (confidence_threshold is not None)
+            and (recognition.intent is not None)
+            and (recognition.intent.confidence >= confidence_threshold)
+        )
+
+        if not proven:
+            if is_confident:
+                # Good enough without checking cheaper paths
+                recognitions.append(recognition)
+                break
+
+            # Keep for when path is proven to be next best
+            candidates[id(path)] = (path, recognition)
+            continue
+
+        intent_name = recognition.intent.name if recognition.intent else ""
+        if intent_name in intents_found:
+            # Strict search can find many paths for an intent
+            continue
+
+        intents_found.add(intent_name)
+        recognitions.append(recognition)
+        if is_confident or (len(recognitions) >= n_best):
+            break
+
+    return recognitions
+
+
+def _paths_strict_lazy(
+    tokens: typing.List[str],
+    graph: typing.Any,
+    stop_words: typing.Optional[typing.Set[str]] = None,
+    intent_filter: typing.Optional[typing.Callable[[str], bool]] = None,
+    word_transform: typing.Optional[typing.Callable[[str], str]] = None,
+) -> typing.Iterator[typing.Tuple[typing.Optional[float], PathType, bool]]:
+    """Strict paths (consumed lazily), retrying without stop words like recognize."""
+    found_path = False
+    for path in paths_strict(
+        tokens, graph, intent_filter=intent_filter, word_transform=word_transform
+    ):
+        found_path = True
+        yield None, path, True
+
+    if (not found_path) and stop_words:
+        # Try again by excluding stop words
+        tokens = [t for t in tokens if t not in stop_words]
+        for path in paths_strict(
+            tokens,
+            graph,
+            exclude_tokens=stop_words,
+            intent_filter=intent_filter,
+            word_transform=word_transform,
+        ):
+            yield None, path, True
@@ -0,0 +1,193 @@
+"""Broker-free query handling over JSON lines (stdin/stdout or Unix socket)"""
+import asyncio
+import json
+import logging
+import sys
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from rhasspyhermes.nlu import NluQuery
+
+from . import NluHermesMqtt
+from .payloads import message_payload
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+LinesType = typing.AsyncIterator[bytes]
+WriteType = typing.Callable[[bytes], typing.Awaitable[None]]
+
+# Marks end of input
+_END = object()
+
+# -----------------------------------------------------------------------------
+
+
+def result_to_json(
+    result: typing.Any,
+    extra: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    hermes: typing.Optional[NluHermesMqtt] = None,
+) -> str:
+    """JSON line with MQTT topic and payload for an on_message result.
+
+    Fields in extra are added after the payload. If hermes is given, intent
+    messages reuse the intent and slots it encoded for them.
+    """
+    if isinstance(result, tuple):
+        message, topic_args = result
+    else:
+        message, topic_args = result, {}
+
+    if hermes is not None:
+        payload = hermes.message_payload(message)
+    else:
+        payload = message_payload(message)
+
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+
+    # Payload is already JSON
+    topic_json = json.dumps({"topic": message.topic(**topic_args)}, ensure_ascii=False)
+    line = topic_json[:-1] + ', "payload": ' + payload
+    if extra:
+        line += ", " + json.dumps(extra, ensure_ascii=False)[1:-1]
+
+    return line + "}"
+
+
+async def handle_stream(
+    hermes: NluHermesMqtt, lines: LinesType, write: WriteType, max_in_flight: int = 1
+):
+    """Handle NluQuery JSON lines, writing results in input order.
+
+    Up to max_in_flight queries are recognized while earlier results are
+    written and later lines are read.
+    """
+    # Tasks for queries in input order (_END at end of input)
+    pending: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_in_flight))
+
+    async def query_lines(query: NluQuery) -> bytes:
+        output_lines = [
+            result_to_json(result, hermes=hermes) + "\n"
+            async for result in hermes.on_message(query)
+        ]
+        return "".join(output_lines).encode()
+
+    async def read_queries():
+        line_number = 0
+        try:
+            async for line in lines:
+                line_number += 1
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    query = NluQuery.from_dict(json.loads(line))
+                except Exception as e:
+                    _LOGGER.error("Invalid query on line %s: %s", line_number, e)
+                    continue
+
+                if not hermes.valid_site_id(query.site_id):
+                    continue
+
+                await pending.put(asyncio.ensure_future(query_lines(query)))
+        finally:
+            await pending.put(_END)
+
+    async def write_results():
+        task = await pending.get()
+        while task is not _END:
+            output = [await task]
+            task = None
+
+            # Write all finished results at once
+            while not pending.empty():
+                task = pending.get_nowait()
+                if (task is _END) or (not task.done()):
+                    break
+
+                output.append(task.result())
+                task = None
+
+            await write(b"".join(output))
+
+            if task is None:
+                task = await pending.get()
+
+    await asyncio.gather(read_queries(), write_results())
+
+
+# -----------------------------------------------------------------------------
+
+
+async def run_stdio(hermes: NluHermesMqtt, max_in_flight: int = 1):
+    """Handle queries from stdin until end of input, writing results to stdout.
+
+    Reading and writing happen in their own threads so recognition never
+    waits on I/O (works with pipes, files and terminals).
+    """
+    loop = asyncio.get_running_loop()
+    line_queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_in_flight) * 2)
+
+    def read_stdin():
+        try:
+            for line in sys.stdin.buffer:
+                asyncio.run_coroutine_threadsafe(line_queue.put(line), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(line_queue.put(None), loop).result()
+
+    threading.Thread(target=read_stdin, daemon=True).start()
+
+    async def stdin_lines():
+        while True:
+            line = await line_queue.get()
+            if line is None:
+                break
+
+            yield line
+
+    with ThreadPoolExecutor(max_workers=1) as write_executor:
+
+        def write_stdout(data: bytes):
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+
+        async def write(data: bytes):
+            await loop.run_in_executor(write_executor, write_stdout, data)
+
+        await handle_stream(hermes, stdin_lines(), write, max_in_flight=max_in_flight)
+
+
+async def run_unix_socket(
+    hermes: NluHermesMqtt, socket_path: str, max_in_flight: int = 1
+):
+    """Handle queries from clients of a Unix socket (results go to same client)."""
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def client_lines():
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                yield line
+
+        async def write(data: bytes):
+            writer.write(data)
+            await writer.drain()
+
+        try:
+            await handle_stream(
+                hermes, client_lines(), write, max_in_flight=max_in_flight
+            )
+        except ConnectionError:
+            _LOGGER.debug("Client disconnected")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_client, path=socket_path)
+    _LOGGER.debug("Listening on %s", socket_path)
+
+    async with server:
+        await server.serve_forever()
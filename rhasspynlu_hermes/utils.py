@@ -1,23 +1,67 @@
 """Utility methods for rhasspy-nlu-hermes"""
+import importlib.util
 import io
 import json
 import logging
+import os
+import queue
 import subprocess
+import threading
+import time
 import typing
 from pathlib import Path
 
+from .cache import LruCache
+
 _LOGGER = logging.getLogger("rhasspynlu_hermes")
 
 
 # -----------------------------------------------------------------------------
 
 
+TIMEOUT_ACTIONS = ["error", "passthrough"]
+
+
+class ConverterError(Exception):
+    """Raised when a converter fails to produce values."""
+
+
+def converter_timed_out(
+    name: str, args: typing.Sequence[typing.Any], timeout: float, on_timeout: str
+) -> typing.List[typing.Any]:
+    """Raise error or return input values unchanged after a converter timeout."""
+    if on_timeout == "passthrough":
+        _LOGGER.warning(
+            "Converter %s timed out after %s second(s), using input values",
+            name,
+            timeout,
+        )
+        return list(args)
+
+    raise ConverterError(f"Converter {name} timed out after {timeout} second(s)")
+
+
 class CliConverter:
-    """Command-line converter for intent recognition"""
+    """Command-line converter for intent recognition.
+
+    If timeout is set, the program is killed after that many seconds and
+    on_timeout decides what happens: "error" or "passthrough" (return the
+    input values unchanged).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        command_path: Path,
+        timeout: typing.Optional[float] = None,
+        on_timeout: str = "error",
+    ):
+        assert on_timeout in TIMEOUT_ACTIONS, f"Unknown timeout action: {on_timeout}"
 
-    def __init__(self, name: str, command_path: Path):
         self.name = name
         self.command_path = command_path
+        self.timeout = timeout
+        self.on_timeout = on_timeout
 
     def __call__(self, *args, converter_args=None):
         """Runs external program to convert JSON values"""
@@ -37,19 +81,410 @@ class CliConverter:
                 # Multiple values as list
                 json.dump(args, input_file)
 
-            stdout, _ = proc.communicate(input=input_file.getvalue())
+            try:
+                stdout, _ = proc.communicate(
+                    input=input_file.getvalue(), timeout=self.timeout
+                )
+            except subprocess.TimeoutExpired:
+                # Kill and reap so no zombie is left behind
+                proc.kill()
+                proc.communicate()
+
+                assert self.timeout is not None
+                return converter_timed_out(
+                    self.name, args, self.timeout, self.on_timeout
+                )
 
             return [json.loads(line) for line in stdout.splitlines() if line.strip()]
 
 
-def load_converters(converters_dir: Path,) -> typing.Dict[str, typing.Any]:
-    """Load user-defined converters from a directory"""
-    converters = {}
+class PersistentCliConverter:
+    """Command-line converter that keeps a pool of long-lived processes.
+
+    Each process reads one JSON request per line on stdin:
+    {"args": [value, ...], "converter_args": [arg, ...]}
+
+    and writes one JSON list of converted values per line on stdout.
+    Crashed processes are restarted, and a process that takes longer than
+    timeout seconds is killed (see CliConverter for on_timeout). Waiting
+    longer than timeout seconds for a free process is an error.
+
+    Processes are started on first use in each OS process, so forked
+    recognition workers get their own pool.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        command_path: Path,
+        workers: int = 1,
+        timeout: typing.Optional[float] = None,
+        on_timeout: str = "error",
+    ):
+        assert on_timeout in TIMEOUT_ACTIONS, f"Unknown timeout action: {on_timeout}"
+
+        self.name = name
+        self.command_path = command_path
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+
+        self.idle_procs: "queue.Queue[_ConverterProcess]" = queue.Queue()
+        self.num_procs = 0
+        self.procs_lock = threading.Lock()
+
+        # Process that owns the pool
+        self.pid = os.getpid()
+
+    def __call__(self, *args, converter_args=None):
+        """Send values to a converter process and wait for its response"""
+        request = json.dumps(
+            {"args": list(args), "converter_args": converter_args or []}
+        )
+
+        # Retry once if process crashed before responding
+        for attempt in range(2):
+            proc = self._acquire()
+            try:
+                values = proc.request(request, timeout=self.timeout)
+                self.idle_procs.put(proc)
+                return values
+            except queue.Empty:
+                # Timed out
+                self._discard(proc)
+
+                assert self.timeout is not None
+                return converter_timed_out(
+                    self.name, args, self.timeout, self.on_timeout
+                )
+            except Exception:
+                self._discard(proc)
+                if attempt > 0:
+                    raise
+
+                _LOGGER.warning("Restarting converter %s", self.name)
+
+        raise ConverterError(f"Converter {self.name} failed")
+
+    def _acquire(self) -> "_ConverterProcess":
+        """Get an idle process, starting a new one if the pool isn't full."""
+        if self.pid != os.getpid():
+            # Forked: processes (and their reader threads) belong to the parent
+            self.idle_procs = queue.Queue()
+            self.num_procs = 0
+            self.procs_lock = threading.Lock()
+            self.pid = os.getpid()
+
+        deadline = (time.monotonic() + self.timeout) if self.timeout else None
+        while True:
+            with self.procs_lock:
+                if self.idle_procs.empty() and (self.num_procs < self.workers):
+                    self.num_procs += 1
+                    try:
+                        return _ConverterProcess(self.command_path)
+                    except Exception:
+                        # Free place in the pool for the next try
+                        self.num_procs -= 1
+                        raise
+
+            # Wake up periodically in case a failed process was discarded
+            wait_seconds = 0.1
+            if deadline is not None:
+                wait_seconds = min(wait_seconds, deadline - time.monotonic())
+                if wait_seconds <= 0:
+                    raise ConverterError(
+                        f"Converter {self.name} had no free process after {self.timeout} second(s) (workers={self.workers})"
+                    )
+
+            try:
+                return self.idle_procs.get(timeout=wait_seconds)
+            except queue.Empty:
+                pass
+
+    def _discard(self, proc: "_ConverterProcess"):
+        """Stop a failed process and free its place in the pool."""
+        proc.stop()
+        with self.procs_lock:
+            self.num_procs -= 1
+
+    def close(self):
+        """Stop all idle processes (started by this OS process)."""
+        if self.pid != os.getpid():
+            return
+
+        while not self.idle_procs.empty():
+            self._discard(self.idle_procs.get_nowait())
+
+
+class _ConverterProcess:
+    """Single long-lived converter process."""
+
+    def __init__(self, command_path: Path):
+        self.proc = subprocess.Popen(
+            [str(command_path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+        # Lines are read in a thread so requests can time out
+        self.lines: "queue.Queue[typing.Optional[str]]" = queue.Queue()
+        threading.Thread(target=self._read_lines, daemon=True).start()
+
+    def _read_lines(self):
+        assert self.proc.stdout is not None
+        for line in self.proc.stdout:
+            self.lines.put(line)
+
+        # End of output
+        self.lines.put(None)
+
+    def request(self, request: str, timeout: typing.Optional[float] = None):
+        """Write request line and read response line"""
+        assert self.proc.stdin is not None
+        self.proc.stdin.write(request + "\n")
+        self.proc.stdin.flush()
+
+        # Raises queue.Empty on timeout
+        line = self.lines.get(timeout=timeout)
+        if line is None:
+            raise EOFError("Converter process exited")
+
+        return json.loads(line)
+
+    def stop(self):
+        """Terminate process"""
+        if self.proc.poll() is None:
+            self.proc.kill()
+
+        self.proc.wait()
+
+
+class PythonConverter:
+    """In-process converter imported from a Python module on first use.
+
+    The module must have a convert(*values, converter_args=None) function
+    that returns an iterable of converted values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        module_path: typing.Optional[Path] = None,
+        entry_point: typing.Any = None,
+    ):
+        assert (module_path is not None) or (
+            entry_point is not None
+        ), "Need module path or entry point"
+
+        self.name = name
+        self.module_path = module_path
+        self.entry_point = entry_point
+
+        self.convert: typing.Optional[typing.Callable[..., typing.Any]] = None
+        self.load_lock = threading.Lock()
+
+    def __call__(self, *args, converter_args=None):
+        """Call convert function in module"""
+        if self.convert is None:
+            self._load()
+
+        assert self.convert is not None
+        return list(self.convert(*args, converter_args=converter_args))
+
+    def _load(self):
+        """Import module or entry point (once)."""
+        with self.load_lock:
+            if self.convert is not None:
+                return
+
+            if self.entry_point is not None:
+                _LOGGER.debug("Loading converter %s from entry point", self.name)
+                self.convert = self.entry_point.load()
+                return
+
+            _LOGGER.debug("Importing converter %s from %s", self.name, self.module_path)
+            spec = importlib.util.spec_from_file_location(
+                f"rhasspynlu_hermes.converters.{self.name}", self.module_path
+            )
+            assert spec is not None and spec.loader is not None
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)  # type: ignore
+
+            self.convert = getattr(module, "convert")
+
+
+class ConvertersDirWatcher:
+    """Detects changes to files in a converters directory.
+
+    The directory is scanned every check_seconds in a background thread
+    (started on first use in each OS process), so converter calls only read
+    the current version.
+    """
+
+    def __init__(self, converters_dir: Path, check_seconds: float = 1.0):
+        self.converters_dir = converters_dir
+        self.check_seconds = check_seconds
+
+        # Incremented each time the directory changes
+        self.version = 0
+
+        self.last_fingerprint = self.fingerprint()
+        self.lock = threading.Lock()
+
+        # Process that runs the background scans
+        self.watch_pid: typing.Optional[int] = None
+        self.stop_event = threading.Event()
+
+    def fingerprint(self) -> typing.FrozenSet[typing.Tuple[str, int, int]]:
+        """Path, modification time and size of all files."""
+        file_stats = set()
+        for file_path in self.converters_dir.glob("**/*"):
+            try:
+                file_stat = file_path.stat()
+                file_stats.add(
+                    (str(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+                )
+            except OSError:
+                # File was removed
+                pass
+
+        return frozenset(file_stats)
+
+    def check(self) -> int:
+        """Get directory version, starting background scans if needed."""
+        if self.watch_pid != os.getpid():
+            with self.lock:
+                if self.watch_pid != os.getpid():
+                    # First use (or forked without the scanning thread)
+                    self.watch_pid = os.getpid()
+                    self.stop_event = threading.Event()
+                    threading.Thread(target=self._watch, daemon=True).start()
+
+        return self.version
+
+    def scan(self) -> int:
+        """Re-scan directory now and return its version."""
+        fingerprint = self.fingerprint()
+        if fingerprint != self.last_fingerprint:
+            _LOGGER.debug("Converters directory changed")
+            self.last_fingerprint = fingerprint
+            self.version += 1
+
+        return self.version
+
+    def _watch(self):
+        """Scan directory until stopped."""
+        stop_event = self.stop_event
+        while not stop_event.wait(self.check_seconds):
+            try:
+                self.scan()
+            except Exception:
+                _LOGGER.exception("ConvertersDirWatcher")
+
+    def stop(self):
+        """Stop background scans."""
+        self.stop_event.set()
+
+
+class MemoizedConverter:
+    """Caches output of a pure converter by its arguments and input values.
+
+    Input values that can't be encoded as JSON (e.g., objects from an earlier
+    converter) are converted without caching. The cache is cleared when the
+    converters directory changes.
+    """
+
+    def __init__(
+        self,
+        converter: typing.Callable[..., typing.Any],
+        cache_size: int,
+        cache_ttl: typing.Optional[float] = None,
+        watcher: typing.Optional[ConvertersDirWatcher] = None,
+    ):
+        self.converter = converter
+        self.name = getattr(converter, "name", "")
+        self.cache = LruCache(cache_size, ttl=cache_ttl)
+        self.watcher = watcher
+        self.watcher_version = watcher.version if watcher else 0
+
+    def __call__(self, *args, converter_args=None):
+        """Get cached values or run converter"""
+        if self.watcher is not None:
+            version = self.watcher.check()
+            if version != self.watcher_version:
+                self.cache.clear()
+                self.watcher_version = version
+
+        try:
+            cache_key = (
+                tuple(converter_args or []),
+                json.dumps(args, sort_keys=True, ensure_ascii=False),
+            )
+        except (TypeError, ValueError):
+            # Not cacheable
+            return self._convert(args, converter_args)
+
+        values = self.cache.get(cache_key)
+        if values is None:
+            values = self._convert(args, converter_args)
+            self.cache.put(cache_key, values)
+
+        return list(values)
+
+    def _convert(
+        self,
+        args: typing.Sequence[typing.Any],
+        converter_args: typing.Optional[typing.List[str]],
+    ) -> typing.List[typing.Any]:
+        """Run wrapped converter"""
+        if converter_args:
+            return list(self.converter(*args, converter_args=converter_args))
+
+        return list(self.converter(*args))
+
+    def close(self):
+        """Close wrapped converter and stop watching directory"""
+        if self.watcher is not None:
+            self.watcher.stop()
+
+        close = getattr(self.converter, "close", None)
+        if close is not None:
+            close()
+
+
+# -----------------------------------------------------------------------------
+
+
+def load_converters(
+    converters_dir: Path,
+    timeout: typing.Optional[float] = None,
+    on_timeout: str = "error",
+    cache_size: int = 1000,
+    cache_ttl: typing.Optional[float] = None,
+) -> typing.Dict[str, typing.Any]:
+    """Load user-defined converters from a directory.
+
+    Python files (.py) that are not executable are imported in-process on
+    first use. Other files are run as external programs.
+
+    A converter may have a JSON manifest next to it with the same name and a
+    .json extension. If the manifest has "persistent": true, the converter is
+    run as a pool of long-lived processes ("workers", default 1).
+    A "timeout" in the manifest overrides the timeout for external programs.
+
+    If the manifest has "pure": true, the converter's output only depends on
+    its arguments and input values, and is cached ("cache_size" and
+    "cache_ttl" override the defaults).
+    """
+    converters: typing.Dict[str, typing.Any] = {}
 
     if converters_dir.is_dir():
         _LOGGER.debug("Loading converters from %s", converters_dir)
+        watcher: typing.Optional[ConvertersDirWatcher] = None
         for converter_path in converters_dir.glob("**/*"):
-            if not converter_path.is_file():
+            if (not converter_path.is_file()) or (converter_path.suffix == ".json"):
+                # Skip directories and manifests
                 continue
 
             # Retain directory structure in name
@@ -57,10 +492,46 @@ def load_converters(converters_dir: Path,) -> typing.Dict[str, typing.Any]:
                 converter_path.relative_to(converters_dir).with_suffix("")
             )
 
-            # Run converter as external program.
-            # Input arguments are encoded as JSON on individual lines.
-            # Output values should be encoded as JSON on individual lines.
-            converter = CliConverter(converter_name, converter_path)
+            manifest = load_manifest(converter_path)
+            if (converter_path.suffix == ".py") and (
+                not os.access(converter_path, os.X_OK)
+            ):
+                # Import module lazily and call directly
+                converter: typing.Any = PythonConverter(
+                    converter_name, module_path=converter_path
+                )
+            elif manifest.get("persistent"):
+                # Run converter as long-lived external programs.
+                # Requests and responses are JSON on individual lines.
+                converter = PersistentCliConverter(
+                    converter_name,
+                    converter_path,
+                    workers=int(manifest.get("workers", 1)),
+                    timeout=manifest.get("timeout", timeout),
+                    on_timeout=on_timeout,
+                )
+            else:
+                # Run converter as external program.
+                # Input arguments are encoded as JSON on individual lines.
+                # Output values should be encoded as JSON on individual lines.
+                converter = CliConverter(
+                    converter_name,
+                    converter_path,
+                    timeout=manifest.get("timeout", timeout),
+                    on_timeout=on_timeout,
+                )
+
+            if manifest.get("pure"):
+                # Cache output by arguments and input values
+                if watcher is None:
+                    watcher = ConvertersDirWatcher(converters_dir)
+
+                converter = MemoizedConverter(
+                    converter,
+                    cache_size=int(manifest.get("cache_size", cache_size)),
+                    cache_ttl=manifest.get("cache_ttl", cache_ttl),
+                    watcher=watcher,
+                )
 
             # Key off name without file extension
             converters[converter_name] = converter
@@ -68,3 +539,47 @@ def load_converters(converters_dir: Path,) -> typing.Dict[str, typing.Any]:
             _LOGGER.debug("Loaded converter %s from %s", converter_name, converter_path)
 
     return converters
+
+
+def load_entry_point_converters(
+    group: str = "rhasspynlu_hermes.converters",
+) -> typing.Dict[str, typing.Any]:
+    """Load converters declared by installed packages under an entry point group."""
+    try:
+        from importlib import metadata  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        # Python 3.7
+        return {}
+
+    all_entry_points = metadata.entry_points()
+    if hasattr(all_entry_points, "select"):
+        entry_points = all_entry_points.select(group=group)
+    else:
+        entry_points = all_entry_points.get(group, [])  # type: ignore
+
+    converters: typing.Dict[str, typing.Any] = {}
+    for entry_point in entry_points:
+        converters[entry_point.name] = PythonConverter(
+            entry_point.name, entry_point=entry_point
+        )
+        _LOGGER.debug("Found converter %s (%s)", entry_point.name, entry_point.value)
+
+    return converters
+
+
+def load_manifest(converter_path: Path) -> typing.Dict[str, typing.Any]:
+    """Load JSON manifest for a converter (empty if missing)."""
+    manifest_path = converter_path.with_suffix(".json")
+    if not manifest_path.is_file():
+        return {}
+
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def close_converters(converters: typing.Dict[str, typing.Any]):
+    """Stop long-lived converter processes."""
+    for converter in converters.values():
+        close = getattr(converter, "close", None)
+        if close is not None:
+            close()
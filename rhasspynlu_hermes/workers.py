@@ -0,0 +1,639 @@
+"""Worker pools for running intent recognition off the event loop"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import typing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import networkx as nx
+from rhasspynlu import recognize
+from rhasspynlu.intent import Recognition
+
+from .graph import CountingGraph, IntentIndex, graph_fingerprint, load_graph
+from .metrics import NluMetrics, take_worker_converter_seconds
+from .search import recognize_best
+
+_LOGGER = logging.getLogger("rhasspynlu_hermes")
+
+WORKER_TYPES = ["thread", "process"]
+
+# Indexed graphs by key with their generations, and index/recognize arguments
+# for process pool workers (key None is the default graph)
+_WORKER_INDEXES: "OrderedDict[typing.Optional[str], typing.Tuple[int, IntentIndex]]" = (
+    OrderedDict()
+)
+_WORKER_ARGS: typing.Dict[str, typing.Any] = {}
+
+# Replaced generations of indexed graphs by key, kept for older queries
+_WORKER_OLD_INDEXES: typing.Dict[
+    typing.Optional[str], typing.Dict[int, IntentIndex]
+] = {}
+_WORKER_INDEX_ARGS: typing.Dict[str, typing.Any] = {}
+
+# Shared by all workers of a pool so each one takes exactly one warm up task
+_WORKER_BARRIER: typing.Optional[threading.Barrier] = None
+
+# Seconds a warmed up worker waits for the others (busy with queries)
+WARM_TIMEOUT = 10.0
+
+
+class PoolGraph(typing.NamedTuple):
+    """Indexed graph in a recognizer pool."""
+
+    intent_index: IntentIndex
+    graph_path: typing.Optional[Path]
+    generation: int
+    digest: typing.Optional[str] = None
+
+
+class WorkerGraph(typing.NamedTuple):
+    """Graph for a process worker, loaded from graph_path if not current.
+
+    The digest of the file's contents (if known) must match what was loaded
+    in the parent process, so workers never mix contents under one generation.
+    At most max_graphs keyed graphs are kept in each worker.
+
+    Replaced generations from oldest_generation on are kept for queries
+    still in flight (None if there are none).
+    """
+
+    graph_key: typing.Optional[str]
+    generation: int
+    graph_path: typing.Optional[Path]
+    digest: typing.Optional[str]
+    max_graphs: int
+    oldest_generation: typing.Optional[int] = None
+
+
+# -----------------------------------------------------------------------------
+
+
+class QueueFullError(Exception):
+    """Raised when too many queries are waiting for a worker."""
+
+
+# -----------------------------------------------------------------------------
+
+
+def make_intent_filter(
+    intent_names: typing.Optional[typing.Iterable[str]],
+) -> typing.Callable[[str], bool]:
+    """Create an intent filter function from a list of allowed intents."""
+    if not intent_names:
+        return lambda intent_name: True
+
+    allowed_names = set(intent_names)
+    return lambda intent_name: intent_name in allowed_names
+
+
+def recognize_with_filter(
+    tokens: typing.Union[str, typing.List[str]],
+    intent_index: IntentIndex,
+    intent_names: typing.Optional[typing.List[str]] = None,
+    stats: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    **recognize_args,
+) -> typing.List[Recognition]:
+    """Run rhasspynlu.recognize on the part of the graph for intent names.
+
+    Input that exactly matches an indexed sentence skips graph search.
+    If n_best or confidence_threshold are in recognize_args, a best-first
+    search that stops early is used instead (see search.recognize_best).
+
+    If stats is given, the number of graph nodes expanded by the search is
+    stored in stats["nodes_explored"] (or stats["exact"] is set to True).
+    """
+    n_best = recognize_args.pop("n_best", None)
+    confidence_threshold = recognize_args.pop("confidence_threshold", None)
+
+    if (intent_index.exact_index is not None) and ((n_best or 1) == 1):
+        recognitions = intent_index.exact_index.recognize(
+            tokens,
+            intent_index.graph,
+            intent_names=intent_names,
+            fuzzy=recognize_args.get("fuzzy", True),
+            converters=recognize_args.get("converters"),
+            extra_converters=recognize_args.get("extra_converters"),
+        )
+
+        if recognitions is not None:
+            if stats is not None:
+                stats["exact"] = True
+
+            return recognitions
+
+    if (n_best is None) and (confidence_threshold is None):
+        recognize_func: typing.Callable[..., typing.List[Recognition]] = recognize
+    else:
+        recognize_func = functools.partial(
+            recognize_best,
+            n_best=(n_best or 1),
+            confidence_threshold=confidence_threshold,
+            start_node=intent_index.start_node,
+        )
+
+    if intent_names and (not intent_index.is_indexed):
+        # Intents are not on start edges, so filter during search
+        graph = intent_index.graph
+        recognize_args["intent_filter"] = make_intent_filter(intent_names)
+    else:
+        graph = intent_index.filter(intent_names)
+
+    if stats is None:
+        return recognize_func(tokens, graph, **recognize_args)
+
+    counting_graph = CountingGraph(graph)
+    recognitions = recognize_func(tokens, counting_graph, **recognize_args)
+    stats["nodes_explored"] = counting_graph.nodes_explored
+
+    return recognitions
+
+
+def _init_process_worker(
+    graph: typing.Optional[nx.DiGraph],
+    generation: int,
+    recognize_args: typing.Dict[str, typing.Any],
+    index_args: typing.Dict[str, typing.Any],
+    barrier: typing.Optional[threading.Barrier] = None,
+):
+    """Store graph snapshot and arguments in process worker (inherited when forked)."""
+    global _WORKER_ARGS, _WORKER_INDEX_ARGS, _WORKER_BARRIER  # pylint: disable=global-statement
+    _WORKER_INDEXES.clear()
+    _WORKER_OLD_INDEXES.clear()
+    if graph is not None:
+        _WORKER_INDEXES[None] = (generation, IntentIndex(graph, **index_args))
+
+    _WORKER_ARGS = recognize_args
+    _WORKER_INDEX_ARGS = index_args
+    _WORKER_BARRIER = barrier
+
+
+def _worker_index(worker_graph: WorkerGraph) -> IntentIndex:
+    """Get graph stored in this process worker, (re)loading it if needed.
+
+    Queries from an older generation run against the graph they were sent
+    for: replaced generations are kept until the parent has no more queries
+    in flight for them. If this worker never loaded that generation and its
+    file has since been rewritten, the newer graph is used instead. Keyed
+    graphs over max_graphs are dropped (least recently used first out).
+    """
+    graph_key = worker_graph.graph_key
+    generation = worker_graph.generation
+    stored = _WORKER_INDEXES.get(graph_key)
+    old_indexes = _WORKER_OLD_INDEXES.setdefault(graph_key, {})
+
+    oldest_generation = worker_graph.oldest_generation
+    if (stored is None) or (stored[0] <= generation):
+        # Drop replaced generations with no queries left (older queries were
+        # sent before they knew about newer generations)
+        for old_generation in list(old_indexes):
+            if (oldest_generation is None) or (old_generation < oldest_generation):
+                del old_indexes[old_generation]
+
+    intent_index: typing.Optional[IntentIndex] = None
+    if (stored is not None) and (stored[0] > generation):
+        # Query from before the graph was replaced
+        intent_index = old_indexes.get(generation)
+        if (intent_index is None) and (worker_graph.graph_path is not None):
+            try:
+                intent_index = _load_worker_index(worker_graph)
+                old_indexes[generation] = intent_index
+            except ValueError:
+                pass
+
+        if intent_index is None:
+            _LOGGER.debug(
+                "Graph replaced since query was sent (key=%s, generation=%s)",
+                graph_key,
+                generation,
+            )
+    elif (stored is None) or (stored[0] < generation):
+        if (stored is not None) and (oldest_generation is not None):
+            # Keep for queries still in flight
+            old_indexes[stored[0]] = stored[1]
+
+        stored = (generation, _load_worker_index(worker_graph))
+        _WORKER_INDEXES[graph_key] = stored
+
+    assert stored is not None
+    _WORKER_INDEXES.move_to_end(graph_key)
+    keyed_keys = [key for key in _WORKER_INDEXES if key is not None]
+    for key in keyed_keys[: max(0, len(keyed_keys) - worker_graph.max_graphs)]:
+        # Default graph is never dropped
+        del _WORKER_INDEXES[key]
+        _WORKER_OLD_INDEXES.pop(key, None)
+
+    return intent_index if intent_index is not None else stored[1]
+
+
+def _load_worker_index(worker_graph: WorkerGraph) -> IntentIndex:
+    """Load and index graph from its path in this process worker."""
+    graph_path = worker_graph.graph_path
+    assert graph_path is not None, "No graph path for worker"
+    _LOGGER.debug(
+        "Loading graph in worker (key=%s, generation=%s)",
+        worker_graph.graph_key,
+        worker_graph.generation,
+    )
+
+    if worker_graph.digest is not None:
+        digest = graph_fingerprint(graph_path).digest
+        if digest != worker_graph.digest:
+            raise ValueError(f"Graph file changed since it was loaded: {graph_path}")
+
+    return IntentIndex(load_graph(graph_path), **_WORKER_INDEX_ARGS)
+
+
+def _warm_process_worker(worker_graph: WorkerGraph) -> int:
+    """Load graph in this process worker ahead of queries. Returns process id.
+
+    Waits for the other workers afterwards so each one gets a warm up task.
+    """
+    _worker_index(worker_graph)
+
+    if _WORKER_BARRIER is not None:
+        try:
+            _WORKER_BARRIER.wait(WARM_TIMEOUT)
+        except threading.BrokenBarrierError:
+            # Another worker was busy; it will load the graph on its next query
+            pass
+
+    return os.getpid()
+
+
+def _recognize_in_process(
+    tokens: typing.Union[str, typing.List[str]],
+    intent_names: typing.Optional[typing.List[str]],
+    worker_graph: WorkerGraph,
+    with_stats: bool = False,
+) -> typing.Tuple[typing.List[Recognition], typing.Dict[str, typing.Any]]:
+    """Recognize using a graph stored in this process worker.
+
+    Only the query itself (and which graph to use) is sent for each call.
+
+    Returns recognitions and search stats (only if with_stats is True).
+    Time spent in timed converters is returned in stats["converter_seconds"].
+    """
+    stats: typing.Dict[str, typing.Any] = {}
+    recognitions = recognize_with_filter(
+        tokens,
+        _worker_index(worker_graph),
+        intent_names,
+        stats=(stats if with_stats else None),
+        **_WORKER_ARGS,
+    )
+
+    converter_seconds = take_worker_converter_seconds()
+    if converter_seconds:
+        stats["converter_seconds"] = converter_seconds
+
+    return recognitions, stats
+
+
+# -----------------------------------------------------------------------------
+
+
+class RecognizerPool:
+    """Runs rhasspynlu.recognize in a pool of thread or process workers.
+
+    With workers=0, recognition runs directly on the event loop.
+    At most max_queued queries may wait for a free worker (0 for no limit).
+
+    Besides the default graph, graphs may be added under a key and
+    recognized with graph_key. Keyed graphs must come from a file so process
+    workers can load them.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        worker_type: str = "thread",
+        max_queued: int = 0,
+        max_exact_sentences: int = 0,
+        metrics: typing.Optional[NluMetrics] = None,
+        **recognize_args,
+    ):
+        assert worker_type in WORKER_TYPES, f"Unknown worker type: {worker_type}"
+
+        self.workers = workers
+        self.worker_type = worker_type
+        self.max_queued = max_queued
+        self.recognize_args = recognize_args
+
+        # Receives converter time from process workers
+        self.metrics = metrics
+
+        # Graphs with up to max_exact_sentences sentences get an exact match index
+        self.index_args: typing.Dict[str, typing.Any] = {
+            "max_exact_sentences": max_exact_sentences,
+            "word_transform": recognize_args.get("word_transform"),
+        }
+
+        # key -> indexed graph (key None is the default graph)
+        self.graphs: typing.Dict[typing.Optional[str], PoolGraph] = {}
+
+        # Incremented each time a graph changes
+        self.generation = 0
+
+        self.executor: typing.Optional[Executor] = None
+
+        # Process workers wait for each other after warming up (see warm_workers)
+        self.warm_barrier: typing.Optional[threading.Barrier] = None
+        self.warm_lock: typing.Optional[asyncio.Lock] = None
+
+        # Number of queries submitted but not finished
+        self.pending = 0
+
+        # (key, generation) -> number of queries in process workers
+        self.in_flight: typing.Dict[typing.Tuple[typing.Optional[str], int], int] = {}
+
+        # Number of queries rejected with QueueFullError
+        self.dropped = 0
+
+        if (self.workers > 0) and (self.worker_type == "thread"):
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="rhasspynlu_hermes"
+            )
+
+    @property
+    def queued(self) -> int:
+        """Number of queries waiting for a free worker."""
+        return max(0, self.pending - self.workers)
+
+    @property
+    def max_in_flight(self) -> int:
+        """Queries to submit at once to keep all workers busy without filling queue."""
+        max_queries = 2 * max(1, self.workers)
+        if self.max_queued > 0:
+            max_queries = min(max_queries, max(1, self.workers) + self.max_queued)
+
+        return max_queries
+
+    @property
+    def graph(self) -> typing.Optional[nx.DiGraph]:
+        """Default graph used for recognition."""
+        intent_index = self.intent_index
+        return intent_index.graph if intent_index is not None else None
+
+    @property
+    def intent_index(self) -> typing.Optional[IntentIndex]:
+        """Index of default graph."""
+        return self.get_index(None)
+
+    @property
+    def graph_path(self) -> typing.Optional[Path]:
+        """Path of default graph (None if not from a file)."""
+        pool_graph = self.graphs.get(None)
+        return pool_graph.graph_path if pool_graph is not None else None
+
+    def get_index(
+        self, graph_key: typing.Optional[str]
+    ) -> typing.Optional[IntentIndex]:
+        """Index of graph with key (None if not set)."""
+        pool_graph = self.graphs.get(graph_key)
+        return pool_graph.intent_index if pool_graph is not None else None
+
+    def get_generation(self, graph_key: typing.Optional[str] = None) -> int:
+        """Generation of graph with key (-1 if not set)."""
+        pool_graph = self.graphs.get(graph_key)
+        return pool_graph.generation if pool_graph is not None else -1
+
+    def index_graph(self, graph: nx.DiGraph) -> IntentIndex:
+        """Index a graph for recognition (safe to run off the event loop).
+
+        Process workers build their own exact match index, so it is skipped
+        for the copy of the graph kept in this process.
+        """
+        index_args = self.index_args
+        if (self.workers > 0) and (self.worker_type == "process"):
+            index_args = {**index_args, "max_exact_sentences": 0}
+
+        return IntentIndex(graph, **index_args)
+
+    def set_graph(
+        self,
+        graph: typing.Optional[nx.DiGraph],
+        graph_path: typing.Optional[Path] = None,
+        graph_key: typing.Optional[str] = None,
+        intent_index: typing.Optional[IntentIndex] = None,
+        digest: typing.Optional[str] = None,
+    ):
+        """Set graph used for recognition (default graph if graph_key is None).
+
+        If intent_index is None, the graph is indexed here (see index_graph).
+
+        If graph_path is given, process workers reload the graph from it
+        (checking its contents against digest, if given). Otherwise, process
+        workers are restarted with a forked snapshot of the (default) graph.
+        Call warm_workers afterwards to load the graph in every worker.
+        """
+        self.generation += 1
+
+        if graph is None:
+            self.graphs.pop(graph_key, None)
+        else:
+            assert (graph_key is None) or (
+                graph_path is not None
+            ), "Keyed graphs must have a path"
+
+            if intent_index is None:
+                intent_index = self.index_graph(graph)
+
+            self.graphs[graph_key] = PoolGraph(
+                intent_index=intent_index,
+                graph_path=graph_path,
+                generation=self.generation,
+                digest=digest,
+            )
+
+        if (self.workers < 1) or (self.worker_type != "process"):
+            return
+
+        if (self.executor is not None) and (
+            (graph_key is not None) or (graph_path is not None)
+        ):
+            # Existing workers will reload from path
+            return
+
+        old_executor = self.executor
+        mp_context = _get_mp_context()
+        self.warm_barrier = mp_context.Barrier(self.workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp_context,
+            initializer=_init_process_worker,
+            initargs=(
+                graph if (graph_key is None) and (graph_path is None) else None,
+                self.generation,
+                self.recognize_args,
+                self.index_args,
+                self.warm_barrier,
+            ),
+        )
+
+        if old_executor is not None:
+            # Let in-flight queries finish on old workers
+            old_executor.shutdown(wait=False)
+
+    def worker_graph(self, graph_key: typing.Optional[str] = None) -> WorkerGraph:
+        """Graph with key as sent to process workers."""
+        pool_graph = self.graphs.get(graph_key)
+        assert pool_graph is not None, f"No graph (key={graph_key})"
+
+        return WorkerGraph(
+            graph_key=graph_key,
+            generation=pool_graph.generation,
+            graph_path=pool_graph.graph_path,
+            digest=pool_graph.digest,
+            max_graphs=max(1, sum(1 for key in self.graphs if key is not None)),
+            oldest_generation=min(
+                (
+                    generation
+                    for (key, generation) in self.in_flight
+                    if (key == graph_key) and (generation < pool_graph.generation)
+                ),
+                default=None,
+            ),
+        )
+
+    async def warm_workers(
+        self, graph_key: typing.Optional[str] = None
+    ) -> typing.Set[int]:
+        """Load graph with key in every process worker before queries need it.
+
+        Returns process ids of warmed up workers (empty for thread workers,
+        which share the graph in memory).
+        """
+        if (
+            (self.executor is None)
+            or (self.worker_type != "process")
+            or (graph_key not in self.graphs)
+        ):
+            return set()
+
+        if self.warm_lock is None:
+            self.warm_lock = asyncio.Lock()
+
+        # One round at a time, so no worker takes two tasks from the same round
+        async with self.warm_lock:
+            if self.warm_barrier is not None:
+                # Broken by a worker that was too busy last time
+                self.warm_barrier.reset()
+
+            loop = asyncio.get_running_loop()
+            worker_graph = self.worker_graph(graph_key)
+            pids = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        self.executor, _warm_process_worker, worker_graph
+                    )
+                    for _ in range(self.workers)
+                )
+            )
+
+        _LOGGER.debug(
+            "Warmed up %s process worker(s) (key=%s, generation=%s)",
+            len(set(pids)),
+            graph_key,
+            worker_graph.generation,
+        )
+
+        return set(pids)
+
+    async def recognize(
+        self,
+        tokens: typing.Union[str, typing.List[str]],
+        intent_names: typing.Optional[typing.List[str]] = None,
+        stats: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        graph_key: typing.Optional[str] = None,
+    ) -> typing.List[Recognition]:
+        """Recognize intents from tokens, optionally limited to intent names.
+
+        If stats is given, search stats are stored in it.
+        """
+        pool_graph = self.graphs.get(graph_key)
+        assert pool_graph is not None, f"No graph (key={graph_key})"
+
+        if (self.executor is None) or (self.workers < 1):
+            # Run on event loop
+            return recognize_with_filter(
+                tokens,
+                pool_graph.intent_index,
+                intent_names,
+                stats=stats,
+                **self.recognize_args,
+            )
+
+        if self.max_queued and (self.queued >= self.max_queued):
+            self.dropped += 1
+            raise QueueFullError(
+                f"Too many queued queries (max={self.max_queued}, pending={self.pending})"
+            )
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            if self.worker_type == "process":
+                flight_key = (graph_key, pool_graph.generation)
+                self.in_flight[flight_key] = self.in_flight.get(flight_key, 0) + 1
+                try:
+                    recognitions, worker_stats = await loop.run_in_executor(
+                        self.executor,
+                        functools.partial(
+                            _recognize_in_process,
+                            tokens,
+                            intent_names,
+                            self.worker_graph(graph_key),
+                            stats is not None,
+                        ),
+                    )
+                finally:
+                    self.in_flight[flight_key] -= 1
+                    if self.in_flight[flight_key] < 1:
+                        del self.in_flight[flight_key]
+
+                converter_seconds = worker_stats.pop("converter_seconds", [])
+                if self.metrics is not None:
+                    for seconds in converter_seconds:
+                        self.metrics.stage_seconds.observe(seconds, stage="converter")
+
+                if stats is not None:
+                    # Stats are returned from the worker process
+                    stats.update(worker_stats)
+            else:
+                recognitions = await loop.run_in_executor(
+                    self.executor,
+                    functools.partial(
+                        recognize_with_filter,
+                        tokens,
+                        pool_graph.intent_index,
+                        intent_names,
+                        stats=stats,
+                        **self.recognize_args,
+                    ),
+                )
+        finally:
+            self.pending -= 1
+
+        return recognitions
+
+    def shutdown(self):
+        """Stop all workers."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+# -----------------------------------------------------------------------------
+
+
+def _get_mp_context():
+    """Prefer fork so workers inherit the graph and converters without pickling."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+
+    return multiprocessing.get_context()
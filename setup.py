@@ -29,6 +29,7 @@ setuptools.setup(
     url="https://github.com/rhasspy/rhasspy-nlu-hermes",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    extras_require={"fast-json": ["orjson"]},
     entry_points={
         "console_scripts": ["rhasspy-nlu-hermes = rhasspynlu_hermes.__main__:main"]
     },
@@ -0,0 +1,34 @@
+"""Unit tests for rhasspynlu_hermes caches"""
+import time
+import unittest
+
+from rhasspynlu_hermes.cache import LruCache
+
+
+class LruCacheTestCase(unittest.TestCase):
+    """Tests for LruCache"""
+
+    def test_eviction(self):
+        """Verify least recently used entries are evicted."""
+        cache = LruCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # Make "a" most recently used
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+    def test_ttl(self):
+        """Verify entries expire."""
+        cache = LruCache(10, ttl=0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
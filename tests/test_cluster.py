@@ -0,0 +1,177 @@
+"""Tests for running several service instances"""
+import asyncio
+import shutil
+import socket
+import subprocess
+import time
+import unittest
+import uuid
+from unittest.mock import MagicMock
+
+from rhasspyhermes.nlu import NluIntentParsed, NluQuery
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes import NluHermesMqtt
+from rhasspynlu_hermes.cluster import parse_partition, site_partition
+
+_LOOP = asyncio.get_event_loop()
+
+INI_TEXT = """
+[GetTime]
+what time is it
+"""
+
+
+class ClusterTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.cluster"""
+
+    def setUp(self):
+        self.graph = intents_to_graph(parse_ini(INI_TEXT))
+
+    def test_parse_partition(self):
+        """Verify INDEX/COUNT partitions are parsed and checked."""
+        self.assertEqual(parse_partition("1/3"), (1, 3))
+
+        for value in ["3/3", "-1/3", "0/0", "1"]:
+            with self.assertRaises(ValueError):
+                parse_partition(value)
+
+    def test_shared_subscription(self):
+        """Verify queries use a shared subscription and training does not."""
+        hermes = NluHermesMqtt(MagicMock(), self.graph, shared_group="nlu")
+        self.assertEqual(
+            hermes.pending_mqtt_topics,
+            {"$share/nlu/hermes/nlu/query", "rhasspy/nlu/+/train"},
+        )
+        self.assertIn(NluQuery, hermes.subscribed_types)
+
+        hermes.recognizer.shutdown()
+
+    async def async_test_partitions(self):
+        """Verify each query is answered by exactly one partition."""
+        instances = [
+            NluHermesMqtt(MagicMock(), self.graph, partition=(index, 3))
+            for index in range(3)
+        ]
+
+        for site_number in range(20):
+            site_id = f"site{site_number}"
+            query = NluQuery(input="what time is it", site_id=site_id)
+
+            answered = []
+            for index, hermes in enumerate(instances):
+                results = [result async for result in hermes.on_message(query)]
+                if results:
+                    self.assertIsInstance(results[0], NluIntentParsed)
+                    answered.append(index)
+
+            self.assertEqual(answered, [site_partition(site_id, 3)])
+
+        for hermes in instances:
+            hermes.recognizer.shutdown()
+
+    def test_partitions(self):
+        """Call async_test_partitions."""
+        _LOOP.run_until_complete(self.async_test_partitions())
+
+
+# -----------------------------------------------------------------------------
+
+
+@unittest.skipIf(shutil.which("mosquitto") is None, "mosquitto is not installed")
+class MosquittoClusterTestCase(unittest.TestCase):
+    """Tests for shared subscriptions with a local Mosquitto broker"""
+
+    def setUp(self):
+        with socket.socket() as port_socket:
+            port_socket.bind(("localhost", 0))
+            self.port = port_socket.getsockname()[1]
+
+        self.broker = subprocess.Popen(
+            ["mosquitto", "-p", str(self.port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        # Wait for broker to start
+        for _ in range(50):
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        self.graph = intents_to_graph(parse_ini(INI_TEXT))
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+
+        self.broker.terminate()
+        self.broker.wait()
+
+    def connect(self):
+        """Connected paho client."""
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client()
+        client.connect("localhost", self.port)
+        client.loop_start()
+        self.clients.append(client)
+
+        return client
+
+    async def async_test_answered_once(self):
+        """Verify each query is answered by one instance in a shared group."""
+        instances = [
+            NluHermesMqtt(self.connect(), self.graph, shared_group="nlu")
+            for _ in range(2)
+        ]
+        tasks = [
+            asyncio.ensure_future(hermes.handle_messages_async())
+            for hermes in instances
+        ]
+
+        answers = []
+        listener = self.connect()
+        listener.on_message = lambda client, userdata, msg: answers.append(
+            NluIntentParsed.from_json(msg.payload).id
+        )
+        listener.subscribe(NluIntentParsed.topic())
+
+        # Wait for subscriptions
+        for _ in range(50):
+            if all(hermes.subscribed_topics for hermes in instances):
+                break
+
+            await asyncio.sleep(0.1)
+
+        await asyncio.sleep(0.5)
+
+        query_ids = [str(uuid.uuid4()) for _ in range(20)]
+        publisher = self.connect()
+        for query_id in query_ids:
+            query = NluQuery(input="what time is it", id=query_id, site_id="default")
+            publisher.publish(query.topic(), query.payload())
+
+        for _ in range(50):
+            if len(answers) >= len(query_ids):
+                break
+
+            await asyncio.sleep(0.1)
+
+        # Give duplicates time to arrive
+        await asyncio.sleep(0.5)
+        self.assertEqual(sorted(answers), sorted(query_ids))
+
+        for task in tasks:
+            task.cancel()
+
+        for hermes in instances:
+            hermes.recognizer.shutdown()
+
+    def test_answered_once(self):
+        """Call async_test_answered_once."""
+        _LOOP.run_until_complete(self.async_test_answered_once())
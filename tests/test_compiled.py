@@ -0,0 +1,61 @@
+"""Unit tests for compiled intent graphs"""
+import io
+import tempfile
+import unittest
+
+from rhasspynlu import intents_to_graph, parse_ini, recognize
+
+from rhasspynlu_hermes.compiled import CompiledGraph, graph_to_compiled
+from rhasspynlu_hermes.graph import load_valid_graph
+
+
+class CompiledGraphTestCase(unittest.TestCase):
+    """Tests for compiled intent graphs"""
+
+    def setUp(self):
+        ini_text = """
+        [SetLightColor]
+        set the (bedroom | living room){name} light to (red | green | blue){color}
+
+        [GetTime]
+        what time is it
+        """
+
+        self.graph = intents_to_graph(parse_ini(ini_text))
+
+        with io.BytesIO() as compiled_file:
+            graph_to_compiled(self.graph, compiled_file)
+            self.compiled_bytes = compiled_file.getvalue()
+
+    def test_same_recognitions(self):
+        """Verify compiled graph gives the same results as networkx graph."""
+        compiled_graph = CompiledGraph(self.compiled_bytes)
+        self.assertEqual(len(compiled_graph), len(self.graph))
+        self.assertEqual(compiled_graph.number_of_edges(), self.graph.number_of_edges())
+
+        for text in [
+            "set the living room light to blue",
+            "what time is it",
+            "please set the bedroom light to green now",
+            "not a valid sentence",
+        ]:
+            for fuzzy in [True, False]:
+                expected = recognize(text, self.graph, fuzzy=fuzzy)
+                actual = recognize(text, compiled_graph, fuzzy=fuzzy)
+
+                for recognition in expected + actual:
+                    recognition.recognize_seconds = 0
+
+                self.assertEqual(actual, expected, text)
+
+    def test_load_mmap(self):
+        """Verify compiled graph file is detected and memory-mapped."""
+        with tempfile.NamedTemporaryFile(mode="wb+") as graph_file:
+            graph_file.write(self.compiled_bytes)
+            graph_file.flush()
+
+            compiled_graph = load_valid_graph(graph_file.name)
+            self.assertIsInstance(compiled_graph, CompiledGraph)
+
+            recognitions = recognize("what time is it", compiled_graph)
+            self.assertEqual(recognitions[0].intent.name, "GetTime")
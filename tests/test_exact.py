@@ -0,0 +1,103 @@
+"""Tests for exact sentence lookup"""
+import unittest
+
+import rhasspynlu
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes.exact import ExactIndex
+from rhasspynlu_hermes.workers import RecognizerPool
+
+
+class ExactIndexTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.exact"""
+
+    def setUp(self):
+        ini_text = """
+        [SetLightColor]
+        set the (bedroom | living room){name} light to (red | green | blue){color}
+
+        [SetTemperature]
+        set temperature to (one:1 | two:2 | 42){temp!int} [degrees]
+
+        [GetTime]
+        what time is it
+
+        [GetTimeAgain]
+        what time is it
+        """
+
+        self.graph = intents_to_graph(parse_ini(ini_text))
+        self.index = ExactIndex(self.graph)
+
+    def assert_same(self, text: str, **recognize_args):
+        """Verify recognitions match rhasspynlu.recognize."""
+        expected = rhasspynlu.recognize(text, self.graph, **recognize_args)
+        actual = self.index.recognize(
+            text,
+            self.graph,
+            fuzzy=recognize_args.get("fuzzy", True),
+            intent_names=recognize_args.get("intent_names"),
+        )
+
+        self.assertIsNotNone(actual)
+        self.assertEqual(len(actual), len(expected))
+        for actual_rec, expected_rec in zip(actual, expected):
+            self.assertEqual(actual_rec.intent, expected_rec.intent)
+            self.assertEqual(actual_rec.text, expected_rec.text)
+            self.assertEqual(actual_rec.raw_text, expected_rec.raw_text)
+            self.assertEqual(actual_rec.entities, expected_rec.entities)
+
+    def test_same_as_recognize(self):
+        """Verify exact matches are recognized like graph search."""
+        self.assertTrue(self.index.is_complete)
+
+        for fuzzy in [True, False]:
+            for text in [
+                "set the living room light to green",
+                "set temperature to two degrees",
+                "set temperature to 42",
+            ]:
+                self.assert_same(text, fuzzy=fuzzy)
+
+        # Converted value
+        recognitions = self.index.recognize("set temperature to two", self.graph)
+        self.assertEqual(recognitions[0].entities[0].value, 2)
+
+    def test_miss(self):
+        """Verify inexact input is left to graph search."""
+        self.assertIsNone(self.index.recognize("set the light to red", self.graph))
+
+        # Wrong intent
+        self.assertIsNone(
+            self.index.recognize(
+                "set temperature to 42", self.graph, intent_names=["GetTime"]
+            )
+        )
+
+    def test_ambiguous(self):
+        """Verify input matching more than one intent is left to graph search."""
+        self.assertIsNone(self.index.recognize("what time is it", self.graph))
+
+        # Filter leaves one intent
+        recognitions = self.index.recognize(
+            "what time is it", self.graph, intent_names=["GetTimeAgain"]
+        )
+        self.assertEqual([r.intent.name for r in recognitions], ["GetTimeAgain"])
+
+    def test_too_many_sentences(self):
+        """Verify index is empty when graph has more than max sentences."""
+        index = ExactIndex(self.graph, max_sentences=2)
+        self.assertFalse(index.is_complete)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.recognize("what time is it", self.graph))
+
+    def test_pool_index(self):
+        """Verify exact index is only built where recognition runs."""
+        thread_pool = RecognizerPool(max_exact_sentences=100)
+        self.assertIsNotNone(thread_pool.index_graph(self.graph).exact_index)
+        thread_pool.shutdown()
+
+        # Process workers build their own index
+        process_pool = RecognizerPool(worker_type="process", max_exact_sentences=100)
+        self.assertIsNone(process_pool.index_graph(self.graph).exact_index)
+        process_pool.shutdown()
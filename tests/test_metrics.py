@@ -0,0 +1,96 @@
+"""Unit tests for rhasspynlu_hermes.metrics"""
+import asyncio
+import unittest
+import urllib.request
+
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes.metrics import Counter, Histogram, NluMetrics, TimedConverter
+from rhasspynlu_hermes.workers import RecognizerPool
+
+_LOOP = asyncio.get_event_loop()
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for metrics"""
+
+    def test_counter(self):
+        """Verify counter text format."""
+        counter = Counter("test_total", "Test counter")
+        counter.inc(result="intent", site_id="default")
+        counter.inc(result="intent", site_id="default")
+
+        self.assertEqual(
+            counter.render().splitlines(),
+            [
+                "# HELP test_total Test counter",
+                "# TYPE test_total counter",
+                'test_total{result="intent",site_id="default"} 2',
+            ],
+        )
+
+    def test_counter_function(self):
+        """Verify counter can be read from a function."""
+        counter = Counter("test_total", "Test counter", function=lambda: 3)
+        self.assertEqual(counter.render().splitlines()[-1], "test_total 3")
+
+    async def async_test_process_converter(self):
+        """Verify converter time is sent back from process workers."""
+        metrics = NluMetrics()
+        converter = TimedConverter(lambda *args: [len(args)], metrics)
+        graph = intents_to_graph(parse_ini("[Count]\n(a b){count!count}"))
+
+        pool = RecognizerPool(
+            workers=1,
+            worker_type="process",
+            metrics=metrics,
+            extra_converters={"count": converter},
+        )
+
+        try:
+            pool.set_graph(graph)
+            recognitions = await pool.recognize("a b")
+            self.assertEqual(recognitions[0].entities[0].value, 2)
+        finally:
+            pool.shutdown()
+
+        self.assertEqual(metrics.stage_seconds.values[(("stage", "converter"),)][2], 1)
+
+    def test_process_converter(self):
+        """Call async_test_process_converter."""
+        _LOOP.run_until_complete(self.async_test_process_converter())
+
+    def test_histogram(self):
+        """Verify histogram buckets are cumulative."""
+        histogram = Histogram("test_seconds", "Test histogram", buckets=[0.1, 1.0])
+        histogram.observe(0.05, stage="a")
+        histogram.observe(0.5, stage="a")
+
+        samples = {(name, labels): value for name, labels, value in histogram.samples()}
+        self.assertEqual(
+            samples[("test_seconds_bucket", (("stage", "a"), ("le", "0.1")))], 1
+        )
+        self.assertEqual(
+            samples[("test_seconds_bucket", (("stage", "a"), ("le", "1.0")))], 2
+        )
+        self.assertEqual(
+            samples[("test_seconds_bucket", (("stage", "a"), ("le", "+Inf")))], 2
+        )
+        self.assertEqual(samples[("test_seconds_count", (("stage", "a"),))], 2)
+
+    def test_serve(self):
+        """Verify metrics are served over HTTP."""
+        metrics = NluMetrics()
+        metrics.results.inc(result="error", intent="", site_id="default")
+        server = metrics.serve(0)
+
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                text = response.read().decode()
+
+            self.assertIn(
+                'nlu_results_total{intent="",result="error",site_id="default"} 1', text
+            )
+        finally:
+            server.shutdown()
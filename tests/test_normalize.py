@@ -0,0 +1,56 @@
+"""Tests for query input normalization"""
+import unittest
+
+from rhasspyhermes.nlu import NluQuery
+
+from rhasspynlu_hermes.normalize import normalize_tokens, query_tokens
+from rhasspynlu_hermes.numbers import NumberTable
+
+
+class NormalizeTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.normalize"""
+
+    def test_query_tokens(self):
+        """Verify input is split on whitespace."""
+        self.assertEqual(
+            query_tokens(NluQuery(input="set  a timer")), ["set", "a", "timer"]
+        )
+
+    def test_normalize_tokens(self):
+        """Verify numbers are replaced with offsets back to original tokens."""
+        table = NumberTable("en")
+        normalized = normalize_tokens(
+            "set a timer for 75 minutes".split(), number_table=table
+        )
+
+        self.assertEqual(normalized.text, "set a timer for seventy five minutes")
+        self.assertEqual(normalized.raw_indexes, [0, 1, 2, 3, 4, 4, 5])
+        self.assertFalse(normalized.has_failure_token)
+
+        # "seventy five" -> "75"
+        self.assertEqual(normalized.raw_span(4, 6), (16, 18))
+        self.assertEqual(normalized.raw_span(6, 7), (19, 26))
+
+    def test_matched_span(self):
+        """Verify ranges of matched tokens are found in the original input."""
+        table = NumberTable("en")
+        raw_text = "um set a timer for  75 minutes"
+        normalized = normalize_tokens(raw_text.split(), number_table=table)
+
+        # "um" was skipped
+        matched_tokens = "set a timer for seventy five minutes".split()
+        span = normalized.matched_span(matched_tokens, 16, 28, raw_text=raw_text)
+        self.assertEqual(span, (20, 22))
+        self.assertEqual(raw_text[20:22], "75")
+
+        self.assertIsNone(normalized.matched_span(["not", "there"], 0, 3))
+
+    def test_failure_token(self):
+        """Verify failure token is found in normalized tokens."""
+        normalized = normalize_tokens(
+            ["turn", "on", "<unk>"], number_table=None, failure_token="<unk>"
+        )
+        self.assertTrue(normalized.has_failure_token)
+
+        normalized = normalize_tokens(["turn", "on"], failure_token="<unk>")
+        self.assertFalse(normalized.has_failure_token)
@@ -0,0 +1,67 @@
+"""Tests for precomputed number replacement"""
+import unittest
+
+import rhasspynlu
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes.numbers import NumberTable, graph_number_range
+
+
+class NumberTableTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.numbers"""
+
+    def test_graph_number_range(self):
+        """Verify range of numbers in graph labels."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [SetTimer]
+                set a timer for (five:5 | 90 | twelve:12){minutes!int} minutes
+                """
+            )
+        )
+
+        self.assertEqual(graph_number_range(graph), (5, 90))
+
+        graph = intents_to_graph(parse_ini("[GetTime]\nwhat time is it"))
+        self.assertIsNone(graph_number_range(graph))
+
+    def test_replace(self):
+        """Verify replacements match rhasspynlu.replace_numbers."""
+        table = NumberTable("en")
+        table.add_range(0, 100)
+        self.assertEqual(len(table.words), 101)
+
+        for text in [
+            "set a timer for 75 minutes",
+            "set temperature to 5 degrees",
+            "play 2 songs from 1999",
+            "count down from -3",
+            "007 is not 7.5",
+        ]:
+            tokens = text.split()
+            self.assertEqual(
+                table.replace(tokens), list(rhasspynlu.replace_numbers(tokens, "en")),
+            )
+
+    def test_max_size(self):
+        """Verify table doesn't grow past max size."""
+        table = NumberTable("en", max_size=10)
+        table.add_range(0, 100)
+        self.assertEqual(len(table.words), 10)
+
+        # Converted without table
+        self.assertEqual(table.replace(["42"]), ["forty", "two"])
+
+    def test_with_graph(self):
+        """Verify graph words are added to a copy of the table."""
+        graph = intents_to_graph(
+            parse_ini("[SetTimer]\nset a timer for (5 | 7){minutes!int} minutes")
+        )
+
+        table = NumberTable("en")
+        table.add_range(0, 1)
+
+        graph_table = table.with_graph(graph)
+        self.assertEqual(set(graph_table.words), {"0", "1", "5", "6", "7"})
+        self.assertEqual(set(table.words), {"0", "1"})
@@ -0,0 +1,89 @@
+"""Tests for fast intent message payloads"""
+import json
+import unittest
+from unittest.mock import patch
+
+from rhasspyhermes.intent import Intent, Slot, SlotRange
+from rhasspyhermes.nlu import (
+    AsrToken,
+    AsrTokenTime,
+    NluIntent,
+    NluIntentNotRecognized,
+    NluIntentParsed,
+)
+
+from rhasspynlu_hermes import payloads
+from rhasspynlu_hermes.payloads import message_payload, shared_fields
+
+
+class PayloadsTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.payloads"""
+
+    def setUp(self):
+        intent = Intent(intent_name="SetTemperature", confidence_score=0.75)
+        slots = [
+            Slot(
+                entity="temperature",
+                value={"kind": "Number", "value": 21},
+                raw_value="twenty one",
+                confidence=1.0,
+                range=SlotRange(start=19, end=21, raw_start=19, raw_end=29),
+            ),
+            Slot(entity="room", confidence=1.0, value={"value": "küche"}),
+        ]
+
+        self.messages = [
+            NluIntentParsed(
+                input="set temperature to 21",
+                id="abc",
+                site_id="kitchen",
+                intent=intent,
+                slots=slots,
+            ),
+            NluIntent(
+                input="set temperature to 21",
+                site_id="kitchen",
+                session_id="session",
+                intent=intent,
+                slots=slots,
+                asr_tokens=[
+                    [
+                        AsrToken(
+                            value="set",
+                            confidence=0.5,
+                            range_start=0,
+                            range_end=3,
+                            time=AsrTokenTime(start=0.0, end=0.25),
+                        )
+                    ]
+                ],
+                raw_input="set temperature to twenty one",
+                lang="de",
+                custom_data='{"a": 1}',
+            ),
+            NluIntentNotRecognized(input="nothing", site_id="kitchen"),
+        ]
+
+    def assert_same_payloads(self):
+        """Verify fast payloads decode to the same JSON as dataclass payloads."""
+        intent_message = self.messages[0]
+        shared = shared_fields(intent_message.intent, intent_message.slots)
+
+        for message in self.messages:
+            expected = json.loads(message.payload())
+            self.assertEqual(json.loads(message_payload(message)), expected)
+
+            if isinstance(message, (NluIntentParsed, NluIntent)):
+                # Intent and slots encoded once for both messages
+                self.assertEqual(
+                    json.loads(message_payload(message, shared=shared)), expected
+                )
+
+    def test_same_payloads(self):
+        """Verify payloads with default encoder."""
+        self.assert_same_payloads()
+
+    def test_same_payloads_json(self):
+        """Verify payloads with standard library encoder."""
+        with patch.object(payloads, "orjson", new=None):
+            self.assert_same_payloads()
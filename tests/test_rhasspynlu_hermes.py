@@ -1,7 +1,10 @@
 """Unit tests for rhasspynlu_hermes"""
 import asyncio
+import gc
+import json
 import logging
 import tempfile
+import threading
 import unittest
 import uuid
 from pathlib import Path
@@ -17,9 +20,13 @@ from rhasspyhermes.nlu import (
     NluTrain,
     NluTrainSuccess,
 )
-from rhasspynlu import intents_to_graph, parse_ini
+from rhasspynlu import graph_to_gzip_pickle, intents_to_graph, parse_ini
 
+import rhasspynlu_hermes
 from rhasspynlu_hermes import NluHermesMqtt
+from rhasspynlu_hermes.graph import graph_fingerprint
+from rhasspynlu_hermes.metrics import NluMetrics
+from rhasspynlu_hermes.workers import WorkerGraph, _worker_index
 
 _LOGGER = logging.getLogger(__name__)
 _LOOP = asyncio.get_event_loop()
@@ -111,6 +118,91 @@ class RhasspyNluHermesTestCase(unittest.TestCase):
         """Call async_test_handle_query."""
         _LOOP.run_until_complete(self.async_test_handle_query())
 
+    async def async_test_publish_payload_fields(self):
+        """Verify intent messages are published with intent and slots encoded once."""
+        query = NluQuery(input="set the bedroom light to red", site_id=self.site_id)
+        results = [result async for result in self.hermes.on_message(query)]
+
+        intent_parsed = results[0]
+        nlu_intent, topic_args = results[1]
+        self.assertIn(id(intent_parsed), self.hermes.payload_fields)
+        self.assertIn(id(nlu_intent), self.hermes.payload_fields)
+
+        for message, message_args in [(intent_parsed, {}), (nlu_intent, topic_args)]:
+            self.client.publish.reset_mock()
+            self.hermes.publish(message, **message_args)
+
+            topic, payload = self.client.publish.call_args[0]
+            self.assertEqual(topic, message.topic(**message_args))
+            self.assertEqual(json.loads(payload), message.to_dict())
+
+        # Entries go away with their messages
+        del results, intent_parsed, nlu_intent, message
+        gc.collect()
+        self.assertEqual(self.hermes.payload_fields, {})
+
+    def test_publish_payload_fields(self):
+        """Call async_test_publish_payload_fields."""
+        _LOOP.run_until_complete(self.async_test_publish_payload_fields())
+
+    async def async_test_raw_slot_range(self):
+        """Verify slot raw ranges are for the original input."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [SetVolume]
+                set [volume] to (five:5 | (seventy five):75){volume!int}
+                """
+            )
+        )
+        # Default is rhasspynlu's range in the matched text
+        hermes = NluHermesMqtt(self.client, graph, replace_numbers=True)
+        query = NluQuery(input="set to 5 please", site_id=self.site_id)
+        results = [result async for result in hermes.on_message(query)]
+        slot = results[1][0].slots[0]
+        self.assertEqual(slot.raw_value, "five")
+        self.assertEqual((slot.range.raw_start, slot.range.raw_end), (7, 11))
+        hermes.recognizer.shutdown()
+
+        hermes = NluHermesMqtt(
+            self.client, graph, replace_numbers=True, original_slot_ranges=True
+        )
+
+        queries = [
+            NluQuery(input="set to 5 please", site_id=self.site_id),
+            NluQuery(input="um set  volume to 75", site_id=self.site_id),
+        ]
+        expected = [("5", 7, 8), ("75", 18, 20)]
+
+        batch_results = await hermes.recognize_batch(
+            [NluQuery(input=query.input, site_id=query.site_id) for query in queries]
+        )
+
+        for query, query_batch_results, (raw_value, raw_start, raw_end) in zip(
+            queries, batch_results, expected
+        ):
+            original_input = query.input
+            results = [result async for result in hermes.on_message(query)]
+
+            for query_results in [results, query_batch_results]:
+                nlu_intent = query_results[1][0]
+                self.assertIsInstance(nlu_intent, NluIntent)
+                self.assertEqual(nlu_intent.raw_input, original_input)
+
+                slot = nlu_intent.slots[0]
+                self.assertEqual(slot.value["value"], int(raw_value))
+                self.assertEqual(slot.raw_value, raw_value)
+                self.assertEqual(
+                    (slot.range.raw_start, slot.range.raw_end), (raw_start, raw_end)
+                )
+                self.assertEqual(original_input[raw_start:raw_end], raw_value)
+
+        hermes.recognizer.shutdown()
+
+    def test_raw_slot_range(self):
+        """Call async_test_raw_slot_range."""
+        _LOOP.run_until_complete(self.async_test_raw_slot_range())
+
     # -------------------------------------------------------------------------
 
     async def async_test_intent_filter(self):
@@ -197,7 +289,7 @@ class RhasspyNluHermesTestCase(unittest.TestCase):
         train_id = str(uuid.uuid4())
 
         def fake_read_graph(*args, **kwargs):
-            return MagicMock()
+            return self.graph
 
         # Create temporary file for "open"
         with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
@@ -219,6 +311,34 @@ class RhasspyNluHermesTestCase(unittest.TestCase):
 
     # -------------------------------------------------------------------------
 
+    async def async_test_train_invalid_graph(self):
+        """Verify an invalid graph does not replace the current graph."""
+        generation = self.hermes.recognizer.generation
+
+        def fake_read_graph(*args, **kwargs):
+            return MagicMock()
+
+        with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
+            train = NluTrain(id=self.session_id, graph_path=graph_file.name)
+
+            with patch("rhasspynlu.gzip_pickle_to_graph", new=fake_read_graph):
+                results = []
+                async for result in self.hermes.on_message(train, site_id=self.site_id):
+                    results.append(result)
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], NluError)
+
+        # Old graph is still in use
+        self.assertIs(self.hermes.intent_graph, self.graph)
+        self.assertEqual(self.hermes.recognizer.generation, generation)
+
+    def test_train_invalid_graph(self):
+        """Call async_test_train_invalid_graph."""
+        _LOOP.run_until_complete(self.async_test_train_invalid_graph())
+
+    # -------------------------------------------------------------------------
+
     async def async_test_train_error(self):
         """Verify training error."""
         train = NluTrain(id=self.session_id, graph_path=Path("fake-graph.pickle.gz"))
@@ -237,3 +357,789 @@ class RhasspyNluHermesTestCase(unittest.TestCase):
     def test_train_error(self):
         """Call async_test_train_error."""
         _LOOP.run_until_complete(self.async_test_train_error())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_process_workers(self):
+        """Verify recognition in process workers."""
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            site_ids=[self.site_id],
+            workers=2,
+            worker_type="process",
+        )
+
+        try:
+            query = NluQuery(
+                input="what time is it",
+                id=str(uuid.uuid4()),
+                site_id=self.site_id,
+                session_id=self.session_id,
+            )
+
+            results = []
+            async for result in hermes.on_message(query):
+                results.append(result)
+
+            self.assertEqual(len(results), 2)
+            nlu_intent = results[1][0]
+            self.assertIsInstance(nlu_intent, NluIntent)
+            self.assertEqual(nlu_intent.intent.intent_name, "GetTime")
+        finally:
+            hermes.recognizer.shutdown()
+
+    def test_process_workers(self):
+        """Call async_test_process_workers."""
+        _LOOP.run_until_complete(self.async_test_process_workers())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_process_workers_train(self):
+        """Verify process workers reload graph after training."""
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            site_ids=[self.site_id],
+            workers=2,
+            worker_type="process",
+        )
+
+        new_graph = intents_to_graph(parse_ini("[GetWeather]\nwhat is the weather"))
+
+        try:
+            with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
+                graph_to_gzip_pickle(new_graph, graph_file)
+                graph_file.flush()
+
+                train = NluTrain(id=str(uuid.uuid4()), graph_path=graph_file.name)
+                async for result in hermes.on_message(train, site_id=self.site_id):
+                    self.assertIsInstance(result[0], NluTrainSuccess)
+
+            # Every worker loaded the graph during training (file is now gone)
+            self.assertEqual(len(await hermes.recognizer.warm_workers()), 2)
+
+            query = NluQuery(
+                input="what is the weather",
+                id=str(uuid.uuid4()),
+                site_id=self.site_id,
+                session_id=self.session_id,
+            )
+
+            results = []
+            async for result in hermes.on_message(query):
+                results.append(result)
+
+            self.assertEqual(len(results), 2)
+            nlu_intent = results[1][0]
+            self.assertIsInstance(nlu_intent, NluIntent)
+            self.assertEqual(nlu_intent.intent.intent_name, "GetWeather")
+
+            # No queries left in flight
+            self.assertEqual(hermes.recognizer.in_flight, {})
+        finally:
+            hermes.recognizer.shutdown()
+
+    def test_process_workers_train(self):
+        """Call async_test_process_workers_train."""
+        _LOOP.run_until_complete(self.async_test_process_workers_train())
+
+    def test_worker_graph_changed(self):
+        """Verify workers don't load a graph file whose contents changed."""
+        with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
+            graph_to_gzip_pickle(self.graph, graph_file)
+            graph_file.flush()
+
+            worker_graph = WorkerGraph(
+                graph_key="changed",
+                generation=1,
+                graph_path=Path(graph_file.name),
+                digest="not the digest",
+                max_graphs=1,
+            )
+
+            with self.assertRaises(ValueError):
+                _worker_index(worker_graph)
+
+            digest = graph_fingerprint(graph_file.name).digest
+            intent_index = _worker_index(worker_graph._replace(digest=digest))
+            self.assertEqual(
+                set(intent_index.intent_edges), {"SetLightColor", "GetTime"}
+            )
+
+    def test_worker_graph_in_flight(self):
+        """Verify older queries use their own graph until they drain."""
+        new_graph = intents_to_graph(parse_ini("[GetWeather]\nhow is the weather\n"))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            old_path = Path(temp_dir) / "old.pickle.gz"
+            new_path = Path(temp_dir) / "new.pickle.gz"
+            with open(old_path, "wb") as graph_file:
+                graph_to_gzip_pickle(self.graph, graph_file)
+
+            with open(new_path, "wb") as graph_file:
+                graph_to_gzip_pickle(new_graph, graph_file)
+
+            old_worker = WorkerGraph(
+                graph_key="in_flight",
+                generation=1,
+                graph_path=old_path,
+                digest=graph_fingerprint(old_path).digest,
+                max_graphs=1,
+            )
+            new_worker = WorkerGraph(
+                graph_key="in_flight",
+                generation=2,
+                graph_path=new_path,
+                digest=graph_fingerprint(new_path).digest,
+                max_graphs=1,
+                oldest_generation=1,
+            )
+
+            old_index = _worker_index(old_worker)
+            self.assertEqual(
+                set(_worker_index(new_worker).intent_edges), {"GetWeather"}
+            )
+
+            # Generation 1 query still in flight
+            self.assertIs(_worker_index(old_worker), old_index)
+
+            # Generation 1 drained, then its file was rewritten
+            self.assertEqual(
+                set(
+                    _worker_index(
+                        new_worker._replace(oldest_generation=None)
+                    ).intent_edges
+                ),
+                {"GetWeather"},
+            )
+            with open(old_path, "wb") as graph_file:
+                graph_to_gzip_pickle(
+                    intents_to_graph(parse_ini("[Other]\nsomething else\n")), graph_file
+                )
+
+            self.assertEqual(
+                set(_worker_index(old_worker).intent_edges), {"GetWeather"}
+            )
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_queue_full(self):
+        """Verify error when too many queries are waiting for a worker."""
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            site_ids=[self.site_id],
+            workers=1,
+            max_queued_queries=1,
+        )
+
+        # Simulate busy worker with one query already waiting
+        hermes.recognizer.pending = 2
+
+        query = NluQuery(
+            input="what time is it",
+            id=str(uuid.uuid4()),
+            site_id=self.site_id,
+            session_id=self.session_id,
+        )
+
+        results = []
+        async for result in hermes.on_message(query):
+            results.append(result)
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], NluError)
+
+    def test_queue_full(self):
+        """Call async_test_queue_full."""
+        _LOOP.run_until_complete(self.async_test_queue_full())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_graph_load_once(self):
+        """Verify concurrent queries share a single background graph load."""
+        graph_loads = []
+
+        def fake_load_graph(graph_path):
+            graph_loads.append(graph_path)
+            return self.graph
+
+        with tempfile.NamedTemporaryFile(mode="wb+", suffix=".gz") as graph_file:
+            hermes = NluHermesMqtt(
+                self.client, graph_path=Path(graph_file.name), site_ids=[self.site_id]
+            )
+
+            async def get_results(text):
+                query = NluQuery(
+                    input=text,
+                    id=str(uuid.uuid4()),
+                    site_id=self.site_id,
+                    session_id=self.session_id,
+                )
+                return [result async for result in hermes.on_message(query)]
+
+            with patch("rhasspynlu_hermes.load_valid_graph", new=fake_load_graph):
+                hermes.load_graph()
+                all_results = await asyncio.gather(
+                    get_results("what time is it"),
+                    get_results("set the bedroom light to red"),
+                )
+
+        self.assertEqual(len(graph_loads), 1)
+        for results in all_results:
+            self.assertEqual(len(results), 2)
+            self.assertIsInstance(results[1][0], NluIntent)
+
+    def test_graph_load_once(self):
+        """Call async_test_graph_load_once."""
+        _LOOP.run_until_complete(self.async_test_graph_load_once())
+
+    # -------------------------------------------------------------------------
+
+    def test_intent_index(self):
+        """Verify filtered graph views only contain allowed intents."""
+        intent_index = self.hermes.recognizer.intent_index
+        self.assertEqual(set(intent_index.intent_edges), {"SetLightColor", "GetTime"})
+
+        filtered_graph = intent_index.filter(["GetTime"])
+        self.assertEqual(len(filtered_graph[intent_index.start_node]), 1)
+
+        # Views are reused for the same filter set
+        self.assertIs(intent_index.filter(["GetTime"]), filtered_graph)
+        self.assertIs(intent_index.filter(None), self.graph)
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_recognition_cache(self):
+        """Verify recognition results are cached until the graph changes."""
+        hermes = NluHermesMqtt(
+            self.client, self.graph, site_ids=[self.site_id], recognition_cache_size=10,
+        )
+
+        async def get_results():
+            query = NluQuery(
+                input="what time is it",
+                id=str(uuid.uuid4()),
+                site_id=self.site_id,
+                session_id=self.session_id,
+            )
+            return [result async for result in hermes.on_message(query)]
+
+        first_results = await get_results()
+        second_results = await get_results()
+        self.assertEqual(hermes.recognition_cache.misses, 1)
+        self.assertEqual(hermes.recognition_cache.hits, 1)
+        self.assertEqual(first_results[1][0].intent, second_results[1][0].intent)
+
+        # New graph clears cache
+        hermes.intent_graph = intents_to_graph(parse_ini("[Other]\nwhat time is it"))
+        results = await get_results()
+        self.assertEqual(results[1][0].intent.intent_name, "Other")
+        self.assertEqual(hermes.recognition_cache.misses, 2)
+
+    def test_recognition_cache(self):
+        """Call async_test_recognition_cache."""
+        _LOOP.run_until_complete(self.async_test_recognition_cache())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_uncached_converter(self):
+        """Verify intents with non-deterministic converters are not cached."""
+        graph = intents_to_graph(parse_ini("[Roll]\nroll (a die):!random"))
+        hermes = NluHermesMqtt(
+            self.client,
+            graph,
+            site_ids=[self.site_id],
+            extra_converters={"random": lambda *args: [str(uuid.uuid4())]},
+            recognition_cache_size=10,
+            uncached_converters=["random"],
+        )
+
+        values = []
+        for _ in range(2):
+            query = NluQuery(input="roll a die", site_id=self.site_id)
+            async for result in hermes.on_message(query):
+                if isinstance(result, NluIntentParsed):
+                    values.append(result.input)
+
+        self.assertEqual(len(values), 2)
+        self.assertNotEqual(values[0], values[1])
+        self.assertEqual(len(hermes.recognition_cache), 0)
+
+    def test_uncached_converter(self):
+        """Call async_test_uncached_converter."""
+        _LOOP.run_until_complete(self.async_test_uncached_converter())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_metrics(self):
+        """Verify query results and stage times are recorded."""
+        metrics = NluMetrics()
+        hermes = NluHermesMqtt(
+            self.client, self.graph, site_ids=[self.site_id], metrics=metrics
+        )
+
+        for text in ["what time is it", "not a valid sentence at all"]:
+            query = NluQuery(input=text, site_id=self.site_id)
+            async for _ in hermes.on_message(query):
+                pass
+
+        self.assertEqual(
+            metrics.results.values,
+            {
+                (
+                    ("intent", "GetTime"),
+                    ("result", "intent"),
+                    ("site_id", self.site_id),
+                ): 1,
+                (
+                    ("intent", ""),
+                    ("result", "not_recognized"),
+                    ("site_id", self.site_id),
+                ): 1,
+            },
+        )
+        self.assertEqual(metrics.queries_in_flight.values, {(): 0})
+        self.assertEqual(metrics.stage_seconds.values[(("stage", "recognize"),)][2], 2)
+        self.assertEqual(metrics.graph_nodes.values[()], len(self.graph))
+
+    def test_metrics(self):
+        """Call async_test_metrics."""
+        _LOOP.run_until_complete(self.async_test_metrics())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_trace_custom_data(self):
+        """Verify sampled query traces are added to custom data."""
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            site_ids=[self.site_id],
+            trace_sample_rate=1.0,
+            trace_custom_data=True,
+        )
+
+        query = NluQuery(
+            input="what time is it",
+            site_id=self.site_id,
+            custom_data=json.dumps({"user": "data"}),
+        )
+
+        results = []
+        async for result in hermes.on_message(query):
+            results.append(result)
+
+        nlu_intent, _ = results[1]
+        custom_data = json.loads(nlu_intent.custom_data)
+        self.assertEqual(custom_data["user"], "data")
+
+        trace = custom_data["nluTrace"]
+        self.assertEqual(trace["intent"], "GetTime")
+        self.assertIn("recognize", trace["stages"])
+        self.assertIn("slots", trace["stages"])
+        self.assertGreater(trace["search"]["nodes_explored"], 0)
+
+        # Non-JSON custom data is left alone
+        query = NluQuery(
+            input="not a valid sentence", site_id=self.site_id, custom_data="plain"
+        )
+        results = []
+        async for result in hermes.on_message(query):
+            results.append(result)
+
+        self.assertIsInstance(results[0], NluIntentNotRecognized)
+        self.assertEqual(results[0].custom_data, "plain")
+
+    def test_trace_custom_data(self):
+        """Call async_test_trace_custom_data."""
+        _LOOP.run_until_complete(self.async_test_trace_custom_data())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_recognize_batch(self):
+        """Verify batch results match handle_query."""
+        texts = [
+            ("set the bedroom light to red", None),
+            ("what time is it", None),
+            ("what time is it", ["SetLightColor"]),
+            ("not a valid sentence", None),
+            ("set the bedroom light to red", None),
+        ]
+
+        def make_queries():
+            return [
+                NluQuery(
+                    input=text,
+                    id=str(query_index),
+                    site_id=self.site_id,
+                    intent_filter=intent_filter,
+                )
+                for query_index, (text, intent_filter) in enumerate(texts)
+            ]
+
+        expected = []
+        for query in make_queries():
+            expected.append([result async for result in self.hermes.on_message(query)])
+
+        hermes = NluHermesMqtt(self.client, self.graph, workers=2)
+        with patch.object(
+            hermes, "recognize", wraps=hermes.recognize
+        ) as mock_recognize:
+            results = await hermes.recognize_batch(make_queries())
+
+        self.assertEqual(results, expected)
+
+        # Duplicate input/filter pairs are only recognized once
+        self.assertEqual(mock_recognize.call_count, 4)
+
+    def test_recognize_batch(self):
+        """Call async_test_recognize_batch."""
+        _LOOP.run_until_complete(self.async_test_recognize_batch())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_site_lang_graphs(self):
+        """Verify graphs are chosen by site id/language, evicted and retrained."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_paths = {}
+            for name, ini_text in [
+                ("kitchen", "[MakeCoffee]\nmake coffee"),
+                ("kitchen2", "[MakeTea]\nmake tea"),
+                ("de", "[GetTimeGerman]\nwie spät ist es"),
+            ]:
+                graph_paths[name] = Path(temp_dir) / f"{name}.pickle.gz"
+                with open(graph_paths[name], "wb") as graph_file:
+                    graph_to_gzip_pickle(
+                        intents_to_graph(parse_ini(ini_text)), graph_file
+                    )
+
+            # Only one extra graph fits in memory
+            hermes = NluHermesMqtt(
+                self.client,
+                self.graph,
+                site_graphs={"kitchen": graph_paths["kitchen"]},
+                lang_graphs={"de": graph_paths["de"]},
+                max_graph_bytes=1,
+            )
+
+            async def intent_name(text, site_id="default", lang=None):
+                query = NluQuery(input=text, site_id=site_id, lang=lang)
+                async for result in hermes.on_message(query):
+                    if isinstance(result, NluIntentParsed):
+                        return result.intent.intent_name
+
+                return None
+
+            self.assertEqual(await intent_name("make coffee", "kitchen"), "MakeCoffee")
+            self.assertEqual(
+                await intent_name("wie spät ist es", lang="de"), "GetTimeGerman"
+            )
+            self.assertEqual(await intent_name("what time is it"), "GetTime")
+            self.assertIsNone(await intent_name("make coffee"))
+
+            # Kitchen graph was evicted and is loaded again
+            self.assertEqual(await intent_name("make coffee", "kitchen"), "MakeCoffee")
+            self.assertEqual(hermes.profiles.evictions, 2)
+            self.assertEqual(hermes.profiles.reloads, 1)
+
+            # Only kitchen graph is retrained
+            train = NluTrain(
+                id=self.session_id, graph_path=str(graph_paths["kitchen2"])
+            )
+            results = [result async for result in hermes.on_message(train, "kitchen")]
+            self.assertIsInstance(results[0][0], NluTrainSuccess)
+
+            self.assertEqual(await intent_name("make tea", "kitchen"), "MakeTea")
+            self.assertIs(hermes.intent_graph, self.graph)
+
+            hermes.recognizer.shutdown()
+
+    def test_site_lang_graphs(self):
+        """Call async_test_site_lang_graphs."""
+        _LOOP.run_until_complete(self.async_test_site_lang_graphs())
+
+    async def async_test_stale_site_graph_load(self):
+        """Verify a background load that started before training is dropped."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "kitchen.pickle.gz"
+
+            def write_graph(ini_text):
+                with open(graph_path, "wb") as graph_file:
+                    graph_to_gzip_pickle(
+                        intents_to_graph(parse_ini(ini_text)), graph_file
+                    )
+
+            write_graph("[MakeCoffee]\nmake coffee")
+            hermes = NluHermesMqtt(
+                self.client, self.graph, site_graphs={"kitchen": graph_path}
+            )
+
+            # First load finishes after training
+            real_load_graph = rhasspynlu_hermes.load_valid_graph
+            load_started = threading.Event()
+            training_done = threading.Event()
+
+            def slow_load_graph(path):
+                graph = real_load_graph(path)
+                if not load_started.is_set():
+                    load_started.set()
+                    training_done.wait(timeout=5)
+
+                return graph
+
+            with patch("rhasspynlu_hermes.load_valid_graph", new=slow_load_graph):
+                load_task = hermes.load_profile_graph("site:kitchen")
+                while not load_started.is_set():
+                    await asyncio.sleep(0.01)
+
+                # Retrain with the same path
+                write_graph("[MakeTea]\nmake tea")
+                self.assertTrue(await hermes.reload_graph(graph_path, "site:kitchen"))
+                training_done.set()
+                await load_task
+
+            query = NluQuery(input="make tea", site_id="kitchen")
+            results = [result async for result in hermes.on_message(query)]
+            self.assertEqual(results[0].intent.intent_name, "MakeTea")
+
+            hermes.recognizer.shutdown()
+
+    def test_stale_site_graph_load(self):
+        """Call async_test_stale_site_graph_load."""
+        _LOOP.run_until_complete(self.async_test_stale_site_graph_load())
+
+    async def async_test_lang_graph_numbers(self):
+        """Verify numbers are replaced with words in the query's language."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "de.pickle.gz"
+            with open(graph_path, "wb") as graph_file:
+                graph_to_gzip_pickle(
+                    intents_to_graph(
+                        parse_ini("[SetTimerGerman]\ntimer (fünf:5){n!int}")
+                    ),
+                    graph_file,
+                )
+
+            hermes = NluHermesMqtt(
+                self.client,
+                self.graph,
+                lang_graphs={"de": graph_path},
+                replace_numbers=True,
+                language="en",
+            )
+
+            query = NluQuery(input="timer 5", site_id=self.site_id, lang="de")
+            results = [result async for result in hermes.on_message(query)]
+            self.assertEqual(results[0].intent.intent_name, "SetTimerGerman")
+            self.assertEqual(hermes.graph_number_table("lang:de").language, "de")
+
+            # Default graph still uses default language
+            self.assertEqual(hermes.graph_number_table().language, "en")
+
+            hermes.recognizer.shutdown()
+
+    def test_lang_graph_numbers(self):
+        """Call async_test_lang_graph_numbers."""
+        _LOOP.run_until_complete(self.async_test_lang_graph_numbers())
+
+    async def async_test_site_graphs_only(self):
+        """Verify site id graphs without a default graph (process and evicted)."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            site_graphs = {}
+            for site_id, ini_text in [
+                ("kitchen", "[MakeCoffee]\nmake coffee"),
+                ("bedroom", "[TurnOffLight]\nturn off the light"),
+            ]:
+                site_graphs[site_id] = Path(temp_dir) / f"{site_id}.pickle.gz"
+                with open(site_graphs[site_id], "wb") as graph_file:
+                    graph_to_gzip_pickle(
+                        intents_to_graph(parse_ini(ini_text)), graph_file
+                    )
+
+            async def intent_names(hermes, queries):
+                results = await hermes.recognize_batch(
+                    NluQuery(input=text, site_id=site_id) for text, site_id in queries
+                )
+                return [
+                    result[0].intent.intent_name
+                    if isinstance(result[0], NluIntentParsed)
+                    else None
+                    for result in results
+                ]
+
+            queries = [("make coffee", "kitchen"), ("turn off the light", "bedroom")]
+            expected = ["MakeCoffee", "TurnOffLight"]
+
+            # Both graphs stay loaded in process workers
+            hermes = NluHermesMqtt(
+                self.client, site_graphs=site_graphs, workers=1, worker_type="process"
+            )
+
+            try:
+                self.assertEqual(await intent_names(hermes, queries), expected)
+
+                # Workers can't load graphs from disk anymore
+                for graph_path in site_graphs.values():
+                    graph_path.unlink()
+
+                for _ in range(3):
+                    for query in queries:
+                        self.assertEqual(
+                            await intent_names(hermes, [query]),
+                            [expected[queries.index(query)]],
+                        )
+
+                self.assertEqual(hermes.profiles.loads, 2)
+            finally:
+                hermes.recognizer.shutdown()
+
+            # Only one graph fits, so loading one evicts the other
+            for site_id, graph_path in site_graphs.items():
+                with open(graph_path, "wb") as graph_file:
+                    graph_to_gzip_pickle(self.graph, graph_file)
+
+            hermes = NluHermesMqtt(
+                self.client, site_graphs=site_graphs, max_graph_bytes=1
+            )
+
+            results = await asyncio.gather(
+                *(
+                    hermes.handle_query(
+                        NluQuery(input="what time is it", site_id=site_id)
+                    ).__anext__()
+                    for site_id in ["kitchen", "bedroom", "kitchen", "bedroom"]
+                )
+            )
+
+            for result in results:
+                self.assertIsInstance(result, NluIntentParsed)
+
+            hermes.recognizer.shutdown()
+
+    def test_site_graphs_only(self):
+        """Call async_test_site_graphs_only."""
+        _LOOP.run_until_complete(self.async_test_site_graphs_only())
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_unchanged_graph(self):
+        """Verify unchanged graph files are not reloaded and changes are watched."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            graph_path = Path(temp_dir) / "intent_graph.pickle.gz"
+
+            def write_graph(ini_text):
+                with open(graph_path, "wb") as graph_file:
+                    graph_to_gzip_pickle(
+                        intents_to_graph(parse_ini(ini_text)), graph_file
+                    )
+
+            write_graph("[GetTime]\nwhat time is it")
+            hermes = NluHermesMqtt(self.client, graph_path=graph_path)
+
+            async def train():
+                train = NluTrain(id=self.session_id, graph_path=str(graph_path))
+                results = [
+                    result async for result in hermes.on_message(train, "default")
+                ]
+                self.assertIsInstance(results[0][0], NluTrainSuccess)
+
+            await train()
+            generation = hermes.recognizer.generation
+
+            # Same content (rewritten)
+            write_graph("[GetTime]\nwhat time is it")
+            await train()
+            self.assertEqual(hermes.recognizer.generation, generation)
+
+            # Changed file is picked up by watcher
+            watch_task = asyncio.ensure_future(hermes.watch_graphs(0.01))
+            try:
+                write_graph("[GetTemperature]\nhow hot is it")
+                for _ in range(100):
+                    await asyncio.sleep(0.01)
+                    if hermes.recognizer.generation > generation:
+                        break
+            finally:
+                watch_task.cancel()
+
+            self.assertEqual(
+                set(hermes.recognizer.intent_index.intent_edges), {"GetTemperature"}
+            )
+
+            hermes.recognizer.shutdown()
+
+    def test_unchanged_graph(self):
+        """Call async_test_unchanged_graph."""
+        _LOOP.run_until_complete(self.async_test_unchanged_graph())
+
+    async def async_test_expired_query(self):
+        """Verify queries waiting past max query age are dropped."""
+        metrics = NluMetrics()
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            metrics=metrics,
+            max_query_age=0.01,
+            expired_query_result="error",
+        )
+
+        # Occupy the only worker
+        self.assertTrue(await hermes.scheduler.acquire("busy"))
+
+        query = NluQuery(input="what time is it", site_id=self.site_id)
+        results = [result async for result in hermes.on_message(query)]
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], NluError)
+        self.assertEqual(hermes.scheduler.dropped, 1)
+        self.assertEqual(metrics.queries_dropped.samples()[0][2], 1)
+
+        hermes.scheduler.release()
+
+        # Recognized once worker is free
+        results = [result async for result in hermes.on_message(query)]
+        self.assertIsInstance(results[0], NluIntentParsed)
+
+        hermes.recognizer.shutdown()
+
+    def test_expired_query(self):
+        """Call async_test_expired_query."""
+        _LOOP.run_until_complete(self.async_test_expired_query())
+
+    async def async_test_max_queued_queries(self):
+        """Verify queries past max queued queries get an error."""
+        metrics = NluMetrics()
+        hermes = NluHermesMqtt(
+            self.client,
+            self.graph,
+            metrics=metrics,
+            fair_scheduling=True,
+            max_queued_queries=1,
+        )
+
+        # Occupy the only worker and fill the queue
+        self.assertTrue(await hermes.scheduler.acquire("busy"))
+        waiting = asyncio.ensure_future(hermes.scheduler.acquire("waiting"))
+        await asyncio.sleep(0)
+
+        query = NluQuery(input="what time is it", site_id=self.site_id)
+        results = [result async for result in hermes.on_message(query)]
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], NluError)
+        self.assertEqual(hermes.queries_dropped(), 1)
+        self.assertEqual(
+            metrics.queries_dropped.render().splitlines()[-1],
+            "nlu_queries_dropped_total 1",
+        )
+
+        hermes.scheduler.release()
+        self.assertTrue(await waiting)
+        hermes.scheduler.release()
+
+        hermes.recognizer.shutdown()
+
+    def test_max_queued_queries(self):
+        """Call async_test_max_queued_queries."""
+        _LOOP.run_until_complete(self.async_test_max_queued_queries())
@@ -0,0 +1,151 @@
+"""Tests for fair query scheduling"""
+import asyncio
+import unittest
+
+from rhasspynlu_hermes.scheduler import QueryScheduler
+from rhasspynlu_hermes.workers import QueueFullError
+
+_LOOP = asyncio.get_event_loop()
+
+
+class QuerySchedulerTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.scheduler"""
+
+    async def run_queries(self, scheduler, queries):
+        """Queue queries behind a busy scheduler and return admission order."""
+        order = []
+
+        async def run_query(name, site_id, priority):
+            if await scheduler.acquire(site_id, priority=priority):
+                order.append(name)
+                await asyncio.sleep(0)
+                scheduler.release()
+            else:
+                order.append(f"dropped:{name}")
+
+        # Occupy the only slot until all queries are queued
+        self.assertTrue(await scheduler.acquire("busy"))
+
+        tasks = [
+            asyncio.ensure_future(run_query(name, site_id, priority))
+            for name, site_id, priority in queries
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, len(queries))
+
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.waiting, 0)
+
+        return order
+
+    # -------------------------------------------------------------------------
+
+    async def async_test_round_robin(self):
+        """Verify queries are admitted round-robin by site id."""
+        order = await self.run_queries(
+            QueryScheduler(),
+            [
+                ("a1", "a", False),
+                ("a2", "a", False),
+                ("a3", "a", False),
+                ("b1", "b", False),
+                ("c1", "c", False),
+                ("b2", "b", False),
+            ],
+        )
+
+        self.assertEqual(order, ["a1", "b1", "c1", "a2", "b2", "a3"])
+
+    def test_round_robin(self):
+        """Call async_test_round_robin."""
+        _LOOP.run_until_complete(self.async_test_round_robin())
+
+    async def async_test_priority(self):
+        """Verify priority queries are admitted first."""
+        order = await self.run_queries(
+            QueryScheduler(),
+            [("a1", "a", False), ("b1", "b", False), ("session", "a", True)],
+        )
+
+        self.assertEqual(order, ["session", "a1", "b1"])
+
+    def test_priority(self):
+        """Call async_test_priority."""
+        _LOOP.run_until_complete(self.async_test_priority())
+
+    async def async_test_max_age(self):
+        """Verify queries waiting longer than max age are dropped."""
+        scheduler = QueryScheduler(max_age=0.01)
+        self.assertTrue(await scheduler.acquire("busy"))
+
+        # Waits too long
+        self.assertFalse(await scheduler.acquire("a"))
+        self.assertEqual(scheduler.dropped, 1)
+        self.assertEqual(scheduler.waiting, 0)
+
+        # Admitted in time
+        task = asyncio.ensure_future(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        scheduler.release()
+        self.assertTrue(await task)
+
+        scheduler.release()
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.admitted, 2)
+
+    def test_max_age(self):
+        """Call async_test_max_age."""
+        _LOOP.run_until_complete(self.async_test_max_age())
+
+    async def async_test_max_queued(self):
+        """Verify new queries are dropped when too many are waiting."""
+        scheduler = QueryScheduler(max_queued=2)
+        self.assertTrue(await scheduler.acquire("busy"))
+
+        # Queued across sites
+        tasks = [
+            asyncio.ensure_future(scheduler.acquire(site_id)) for site_id in ["a", "b"]
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, 2)
+
+        with self.assertRaises(QueueFullError):
+            await scheduler.acquire("c")
+
+        self.assertEqual(scheduler.dropped, 1)
+        self.assertEqual(scheduler.waiting, 2)
+
+        # Queued queries are still admitted
+        for task in tasks:
+            scheduler.release()
+            self.assertTrue(await task)
+
+        scheduler.release()
+        self.assertEqual(scheduler.active, 0)
+
+    def test_max_queued(self):
+        """Call async_test_max_queued."""
+        _LOOP.run_until_complete(self.async_test_max_queued())
+
+    async def async_test_cancel(self):
+        """Verify cancelled waiters leave the queue."""
+        scheduler = QueryScheduler()
+        self.assertTrue(await scheduler.acquire("busy"))
+
+        task = asyncio.ensure_future(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.waiting, 1)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(scheduler.waiting, 0)
+
+        scheduler.release()
+        self.assertEqual(scheduler.active, 0)
+
+    def test_cancel(self):
+        """Call async_test_cancel."""
+        _LOOP.run_until_complete(self.async_test_cancel())
@@ -0,0 +1,132 @@
+"""Tests for best-first graph search"""
+import unittest
+
+import rhasspynlu
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes.search import recognize_best
+
+
+class SearchTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.search"""
+
+    def setUp(self):
+        ini_text = """
+        [SetLightColor]
+        set the (bedroom | living room){name} light to (red | green | blue){color}
+
+        [SetLightState]
+        set the (bedroom | living room){name} light (on | off){state}
+
+        [ToggleLight]
+        set the (bedroom | living room){name} light
+
+        [GetTime]
+        what time is it
+        """
+
+        self.graph = intents_to_graph(parse_ini(ini_text))
+
+    def assert_same_best(self, text: str, **search_args):
+        """Verify first recognition matches rhasspynlu.recognize."""
+        expected = rhasspynlu.recognize(text, self.graph, **search_args)
+        actual = recognize_best(text, self.graph, **search_args)
+
+        if not expected:
+            self.assertEqual(actual, [])
+            return
+
+        self.assertEqual(len(actual), 1)
+        self.assertEqual(actual[0].intent, expected[0].intent)
+        self.assertEqual(actual[0].text, expected[0].text)
+        self.assertEqual(actual[0].entities, expected[0].entities)
+
+    def test_same_as_recognize(self):
+        """Verify results match full search for exact and fuzzy input."""
+        for fuzzy in [True, False]:
+            for text in [
+                "set the bedroom light to red",
+                "set the living room light off",
+                "what time is it",
+                "um set the bedroom light to blue please",
+                "what is the time",
+                "nothing matches here",
+            ]:
+                self.assert_same_best(text, fuzzy=fuzzy)
+
+    def test_ambiguous(self):
+        """Verify intents with the same cost come out in recognize order."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [A]
+                turn on [the] light
+
+                [B]
+                turn on light
+
+                [C]
+                turn (on | up) light
+                """
+            )
+        )
+
+        for text in ["turn on light", "turn on a light", "turn on the light"]:
+            # Only intents with the lowest cost are recognized
+            expected = rhasspynlu.recognize(text, graph)
+            actual = recognize_best(text, graph, n_best=3)[: len(expected)]
+
+            self.assertEqual(
+                [r.intent.name for r in actual], [r.intent.name for r in expected]
+            )
+            self.assertEqual(
+                [r.entities for r in actual], [r.entities for r in expected]
+            )
+
+    def test_same_intent_ties(self):
+        """Verify equal cost paths of one intent resolve like recognize."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [Play]
+                play some song in the kitchen
+                play the song in the kitchen
+                """
+            )
+        )
+
+        text = "play the some song in the kitchen"
+        expected = rhasspynlu.recognize(text, graph)
+        actual = recognize_best(text, graph)
+
+        self.assertEqual([r.text for r in actual], [expected[0].text])
+
+    def test_no_start(self):
+        """Verify a graph without a start node recognizes nothing."""
+        graph = intents_to_graph(parse_ini(""))
+        graph.remove_nodes_from(list(graph.nodes))
+
+        self.assertEqual(recognize_best("turn on the light", graph), [])
+
+    def test_n_best(self):
+        """Verify one result per intent, best first."""
+        recognitions = recognize_best(
+            "set the bedroom light to red", self.graph, n_best=3
+        )
+
+        self.assertEqual(
+            [r.intent.name for r in recognitions], ["SetLightColor", "ToggleLight"]
+        )
+        self.assertEqual(recognitions[0].intent.confidence, 1.0)
+        self.assertLess(recognitions[1].intent.confidence, 1.0)
+
+    def test_confidence_threshold(self):
+        """Verify search stops at first confident result."""
+        recognitions = recognize_best(
+            "set the bedroom light to red",
+            self.graph,
+            n_best=3,
+            confidence_threshold=1.0,
+        )
+
+        self.assertEqual([r.intent.name for r in recognitions], ["SetLightColor"])
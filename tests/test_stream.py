@@ -0,0 +1,186 @@
+"""Tests for broker-free JSON lines handling"""
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock
+
+from rhasspynlu import intents_to_graph, parse_ini
+
+from rhasspynlu_hermes import NluHermesMqtt
+from rhasspynlu_hermes.__main__ import run_batch
+from rhasspynlu_hermes.cluster import site_partition
+from rhasspynlu_hermes.stream import handle_stream, run_unix_socket
+
+_LOOP = asyncio.get_event_loop()
+
+
+class StreamTestCase(unittest.TestCase):
+    """Tests for rhasspynlu_hermes.stream"""
+
+    def setUp(self):
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [GetTime]
+                what time is it
+
+                [GetTemperature]
+                whats the temperature
+                """
+            )
+        )
+        self.graph = graph
+        self.hermes = NluHermesMqtt(MagicMock(), graph, workers=2)
+
+        texts = ["what time is it", "not valid", "whats the temperature"]
+        self.lines = [
+            json.dumps({"input": text, "id": str(i)}).encode() + b"\n"
+            for i, text in enumerate(texts)
+        ]
+
+    def check_output(self, output: bytes):
+        """Verify results are in input order."""
+        results = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(
+            [result["topic"] for result in results],
+            [
+                "hermes/nlu/intentParsed",
+                "hermes/intent/GetTime",
+                "hermes/nlu/intentNotRecognized",
+                "hermes/nlu/intentParsed",
+                "hermes/intent/GetTemperature",
+            ],
+        )
+        self.assertEqual(
+            [result["payload"]["id"] for result in results], ["0", "0", "1", "2", "2"]
+        )
+
+    async def async_test_handle_stream(self):
+        """Verify JSON lines are handled in order (with invalid lines skipped)."""
+        output = []
+
+        async def lines():
+            for line in self.lines[:2] + [b"not json\n"] + self.lines[2:]:
+                yield line
+
+        async def write(data):
+            output.append(data)
+
+        await handle_stream(self.hermes, lines(), write, max_in_flight=3)
+        self.check_output(b"".join(output))
+
+    def test_handle_stream(self):
+        """Call async_test_handle_stream."""
+        _LOOP.run_until_complete(self.async_test_handle_stream())
+
+    async def async_test_unix_socket(self):
+        """Verify results are written back to socket client."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            socket_path = str(Path(temp_dir) / "nlu.sock")
+            server_task = asyncio.ensure_future(
+                run_unix_socket(self.hermes, socket_path, max_in_flight=2)
+            )
+
+            try:
+                while not Path(socket_path).exists():
+                    await asyncio.sleep(0.01)
+
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                writer.write(b"".join(self.lines))
+                writer.write_eof()
+
+                self.check_output(await reader.read())
+                writer.close()
+            finally:
+                server_task.cancel()
+
+    def test_unix_socket(self):
+        """Call async_test_unix_socket."""
+        _LOOP.run_until_complete(self.async_test_unix_socket())
+
+    def test_run_batch(self):
+        """Verify batch skips queries for other site ids and partitions."""
+        other_site_id = next(
+            site_id
+            for site_id in (f"site{i}" for i in range(100))
+            if site_partition(site_id, 2) != site_partition("default", 2)
+        )
+
+        hermes = NluHermesMqtt(
+            MagicMock(),
+            self.graph,
+            site_ids=["default", other_site_id],
+            partition=(site_partition("default", 2), 2),
+            workers=0,
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = Path(temp_dir) / "queries.jsonl"
+            output_path = Path(temp_dir) / "results.jsonl"
+
+            queries = [
+                {"input": "what time is it", "id": "0", "siteId": "default"},
+                {"input": "what time is it", "id": "1", "siteId": other_site_id},
+                {"input": "what time is it", "id": "2", "siteId": "unknown"},
+            ]
+            input_path.write_text(
+                "".join(json.dumps(query) + "\n" for query in queries)
+            )
+
+            try:
+                run_batch(hermes, str(input_path), str(output_path))
+            finally:
+                # asyncio.run clears the current event loop
+                asyncio.set_event_loop(_LOOP)
+
+            results = [
+                json.loads(line) for line in output_path.read_text().splitlines()
+            ]
+
+        self.assertEqual(
+            [result["topic"] for result in results],
+            ["hermes/nlu/intentParsed", "hermes/intent/GetTime"],
+        )
+        self.assertEqual({result["payload"]["id"] for result in results}, {"0"})
+
+    def test_run_batch_alternatives(self):
+        """Verify n-best intents are written as alternatives."""
+        graph = intents_to_graph(
+            parse_ini(
+                """
+                [TurnOn]
+                turn on the light
+
+                [TurnOnShort]
+                turn on light
+                """
+            )
+        )
+        hermes = NluHermesMqtt(MagicMock(), graph, workers=0, n_best=2)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = Path(temp_dir) / "queries.jsonl"
+            output_path = Path(temp_dir) / "results.jsonl"
+            input_path.write_text(json.dumps({"input": "turn on the light"}) + "\n")
+
+            try:
+                run_batch(hermes, str(input_path), str(output_path))
+            finally:
+                # asyncio.run clears the current event loop
+                asyncio.set_event_loop(_LOOP)
+
+            results = [
+                json.loads(line) for line in output_path.read_text().splitlines()
+            ]
+
+        self.assertEqual(
+            [result["topic"] for result in results],
+            ["hermes/nlu/intentParsed", "hermes/intent/TurnOn"],
+        )
+        self.assertNotIn("alternatives", results[0])
+        self.assertEqual(
+            [alternative["intentName"] for alternative in results[1]["alternatives"]],
+            ["TurnOnShort"],
+        )
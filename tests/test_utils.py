@@ -0,0 +1,248 @@
+"""Unit tests for rhasspynlu_hermes.utils"""
+import json
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+
+from rhasspynlu_hermes.utils import (
+    CliConverter,
+    ConverterError,
+    MemoizedConverter,
+    PersistentCliConverter,
+    PythonConverter,
+    close_converters,
+    load_converters,
+)
+
+ONE_SHOT_SCRIPT = """#!/usr/bin/env python3
+import json
+import sys
+import time
+
+value = json.load(sys.stdin)
+if value == "sleep":
+    time.sleep(10)
+
+print(json.dumps(value.upper()))
+"""
+
+PERSISTENT_SCRIPT = """#!/usr/bin/env python3
+import json
+import os
+import sys
+import time
+
+for line in sys.stdin:
+    request = json.loads(line)
+    values = request["args"]
+    if values == ["crash"] and not os.path.exists(sys.argv[0] + ".crashed"):
+        open(sys.argv[0] + ".crashed", "w").close()
+        sys.exit(1)
+
+    if values == ["sleep"]:
+        time.sleep(10)
+
+    print(json.dumps([str(v).upper() for v in values] + request["converter_args"]))
+    sys.stdout.flush()
+"""
+
+PYTHON_PLUGIN = """
+def convert(*values, converter_args=None):
+    suffix = "-".join(converter_args or [])
+    return [f"{value}-{suffix}" for value in values]
+"""
+
+COUNTING_SCRIPT = """#!/usr/bin/env python3
+import json
+import sys
+
+with open(sys.argv[0] + ".calls", "a") as calls_file:
+    print("call", file=calls_file)
+
+value = json.load(sys.stdin)
+print(json.dumps(value.upper()))
+"""
+
+
+def write_script(path: Path, text: str) -> Path:
+    """Write an executable script."""
+    path.write_text(text)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+class ConvertersTestCase(unittest.TestCase):
+    """Tests for command-line converters"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.converters_dir = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load_converters(self):
+        """Verify one-shot and persistent converters are loaded."""
+        write_script(self.converters_dir / "upper.py", ONE_SHOT_SCRIPT)
+        write_script(self.converters_dir / "persistent.py", PERSISTENT_SCRIPT)
+        (self.converters_dir / "persistent.json").write_text(
+            json.dumps({"persistent": True, "workers": 2})
+        )
+
+        (self.converters_dir / "plugin.py").write_text(PYTHON_PLUGIN)
+
+        converters = load_converters(self.converters_dir)
+        try:
+            self.assertEqual(set(converters), {"upper", "persistent", "plugin"})
+            self.assertIsInstance(converters["upper"], CliConverter)
+            self.assertIsInstance(converters["persistent"], PersistentCliConverter)
+
+            self.assertEqual(converters["upper"]("abc"), ["ABC"])
+            self.assertEqual(
+                converters["persistent"]("a", "b", converter_args=["x"]),
+                ["A", "B", "x"],
+            )
+
+            # Python plugin is imported on first use
+            plugin = converters["plugin"]
+            self.assertIsInstance(plugin, PythonConverter)
+            self.assertIsNone(plugin.convert)
+            self.assertEqual(plugin("a", "b", converter_args=["x"]), ["a-x", "b-x"])
+        finally:
+            close_converters(converters)
+
+    def test_persistent_restart(self):
+        """Verify crashed persistent converter is restarted."""
+        script_path = write_script(
+            self.converters_dir / "persistent.py", PERSISTENT_SCRIPT
+        )
+        converter = PersistentCliConverter("persistent", script_path)
+
+        try:
+            self.assertEqual(converter("crash"), ["CRASH"])
+            self.assertEqual(converter.num_procs, 1)
+        finally:
+            converter.close()
+
+    def test_persistent_timeout(self):
+        """Verify slow persistent converter is killed."""
+        script_path = write_script(
+            self.converters_dir / "persistent.py", PERSISTENT_SCRIPT
+        )
+        converter = PersistentCliConverter("persistent", script_path, timeout=0.5)
+
+        try:
+            with self.assertRaises(ConverterError):
+                converter("sleep")
+
+            self.assertEqual(converter.num_procs, 0)
+            self.assertEqual(converter("ok"), ["OK"])
+        finally:
+            converter.close()
+
+    def test_persistent_busy(self):
+        """Verify waiting too long for a free persistent process is an error."""
+        script_path = write_script(
+            self.converters_dir / "persistent.py", PERSISTENT_SCRIPT
+        )
+        converter = PersistentCliConverter("persistent", script_path, timeout=0.2)
+
+        try:
+            # Only process is busy
+            proc = converter._acquire()
+            with self.assertRaises(ConverterError):
+                converter("ok")
+
+            converter.idle_procs.put(proc)
+            self.assertEqual(converter("ok"), ["OK"])
+        finally:
+            converter.close()
+
+    def test_persistent_spawn_failed(self):
+        """Verify a failed start doesn't use up a place in the pool."""
+        script_path = self.converters_dir / "persistent.py"
+        converter = PersistentCliConverter("persistent", script_path, timeout=0.5)
+
+        try:
+            # Script doesn't exist yet
+            with self.assertRaises(OSError):
+                converter("ok")
+
+            self.assertEqual(converter.num_procs, 0)
+
+            write_script(script_path, PERSISTENT_SCRIPT)
+            self.assertEqual(converter("ok"), ["OK"])
+        finally:
+            converter.close()
+
+    def test_persistent_fork(self):
+        """Verify a forked process starts its own persistent processes."""
+        script_path = write_script(
+            self.converters_dir / "persistent.py", PERSISTENT_SCRIPT
+        )
+        converter = PersistentCliConverter("persistent", script_path)
+
+        self.assertEqual(converter("a"), ["A"])
+        parent_proc = converter.idle_procs.get_nowait()
+
+        try:
+            # Pretend to be a forked child
+            converter.pid = -1
+            self.assertEqual(converter("b"), ["B"])
+            self.assertEqual(converter.num_procs, 1)
+
+            child_proc = converter.idle_procs.get_nowait()
+            converter.idle_procs.put(child_proc)
+            self.assertIsNot(child_proc, parent_proc)
+        finally:
+            parent_proc.stop()
+            converter.close()
+
+    def test_one_shot_timeout(self):
+        """Verify slow one-shot converter is killed."""
+        script_path = write_script(self.converters_dir / "upper.py", ONE_SHOT_SCRIPT)
+
+        converter = CliConverter("upper", script_path, timeout=0.5)
+        with self.assertRaises(ConverterError):
+            converter("sleep")
+
+        # Input values are used instead
+        converter = CliConverter(
+            "upper", script_path, timeout=0.5, on_timeout="passthrough"
+        )
+        self.assertEqual(converter("sleep"), ["sleep"])
+
+    def test_pure_converter_cache(self):
+        """Verify pure converter output is cached until the directory changes."""
+        script_path = write_script(self.converters_dir / "count", COUNTING_SCRIPT)
+        (self.converters_dir / "count.json").write_text(json.dumps({"pure": True}))
+        calls_path = Path(str(script_path) + ".calls")
+
+        converters = load_converters(self.converters_dir)
+        converter = converters["count"]
+        self.assertIsInstance(converter, MemoizedConverter)
+
+        self.assertEqual(converter("abc"), ["ABC"])
+        self.assertEqual(converter("abc"), ["ABC"])
+        self.assertEqual(len(calls_path.read_text().splitlines()), 1)
+
+        # Different input is not cached
+        self.assertEqual(converter("def"), ["DEF"])
+        self.assertEqual(len(calls_path.read_text().splitlines()), 2)
+
+        # Directory change clears cache (scanned in background)
+        assert converter.watcher is not None
+        (self.converters_dir / "new.py").write_text(PYTHON_PLUGIN)
+        converter.watcher.scan()
+        self.assertEqual(converter("abc"), ["ABC"])
+        self.assertEqual(len(calls_path.read_text().splitlines()), 3)
+
+        # Values that aren't JSON are converted without caching
+        type_converter = MemoizedConverter(
+            lambda *values: [type(value).__name__ for value in values], cache_size=10
+        )
+        self.assertEqual(type_converter({1, 2}), ["set"])
+        self.assertEqual(len(type_converter.cache), 0)
+
+        close_converters(converters)